@@ -6,55 +6,237 @@ import json
 
 import argparse
 
-from PIL import Image
-
 import log
-from card import CardTemplate
-from content import ContentGenerator
-from tiler import CardTiler
 
-def generate(template, deck, output_prefix):
+def generate(template, deck, output_prefix, prefetch=8, preview_scale=1.0, cards=None, shard=None,
+             cache_dir=None, optimize=False, quantize=None, watch=False, queue_size=8, stream=False, coordinator=None, batch_size=16,
+             max_memory=None, archive=None, progress=None, cancel=None):
+  # Imaging, fonts and the rest are only loaded once there's something to render,
+  # so --help and argument errors come back right away.
+  from compiler import compile_template, TemplateCache
+  from deckindex import DeckIndex, RecordingGenerator
+  from pipeline import render_deck, select_cards
+  import shard as sharding
+  from sheets import SheetWriter
+  import imagecache
+  import layoutcache
+  import memory
+  import deckfiles
+
   template_dir = os.path.dirname(template.name)
+  log.reset()
+
+  if (not deckfiles.is_deck(deck)):
+    log.error("usage", "Supplied --deck is not a directory or .zip archive.")
+    return 1
+
+  if (preview_scale <= 0):
+    log.error("usage", "Supplied --preview-scale must be positive.")
+    return 1
 
-  if (not os.path.isdir(deck)):
-    log.log.write("Supplied --deck is not a directory.")
+  if (cards is not None and shard is not None):
+    log.error("usage", "Can't combine --cards and --shard.")
+    return 1
+
+  if (watch and coordinator is not None):
+    log.error("usage", "--watch renders on this machine, it can't be combined with --coordinator.")
+    return 1
+
+  if (watch and max_memory is not None):
+    log.error("usage", "--watch keeps every card in memory, it can't be combined with --max-memory.")
+    return 1
+
+  if (watch and (cards is not None or shard is not None)):
+    log.error("usage", "--watch always renders the whole deck, it can't be combined with --cards or --shard.")
+    return 1
+
+  if (watch and deckfiles.is_archive(deck)):
+    log.error("usage", "--watch needs a deck directory to watch, not an archive.")
+    return 1
+
+  if (archive is not None and (watch or shard is not None)):
+    log.error("usage", "--watch and --shard keep sheets as files, they can't be combined with --archive.")
     return 1
 
   if (output_prefix == ""):
     # Generate a nice default name for the output images
     template_name = os.path.splitext(os.path.basename(template.name))[0]
-    deck_name = os.path.basename(deck)
+    deck_name = deckfiles.deck_name(deck)
     output_prefix = template_name + "_" + deck_name + "_"
+    if (preview_scale != 1.0):
+      output_prefix += "preview_"
+    if (cards is not None):
+      output_prefix += "cards%d-%d_" % (cards[0], cards[-1])
 
-  # Keeps track of the next piece of text in each opened file.
-  textgen = ContentGenerator(deck)
+  transforms_dir = None
+  layouts_path = None
+  if (cache_dir is not None):
+    transforms_dir = os.path.join(cache_dir, "transforms")
+    layouts_path = os.path.join(cache_dir, "layouts.sqlite")
+
+  if (watch):
+    # Stays loaded, re-rendering whatever changes until interrupted
+    from watch import DeckWatcher
+    imagecache.configure(transforms_dir)
+    layoutcache.configure(layouts_path)
+    watcher = DeckWatcher(template.name, deck, output_prefix,
+                          preview_scale=preview_scale, cache_dir=cache_dir,
+                          optimize=optimize, quantize=quantize, stream=stream)
+    try:
+      watcher.run(cancel=cancel)
+    except KeyboardInterrupt:
+      pass
+    layoutcache.disable()
+    return 0
 
   # Load the JSON template
   try:
     spec = json.load(template)
   except ValueError as e:
-    log.log.write("JSON error in %s: %s\n" % (template.name, e))
+    log.error("template-json", "JSON error in %s: %s", template.name, e)
     return 2
 
-  # Generates card fronts
-  tmpl = CardTemplate(spec, template_dir)
+  # Generates card fronts. Reuses the compiled template from an earlier run, if it's still valid.
+  cache = None
+  if (cache_dir is not None):
+    cache = TemplateCache(cache_dir)
+  tmpl = compile_template(spec, template_dir, scale=preview_scale, cache=cache)
+  if (tmpl is None):
+    return 2
+
+  # Scaled and rotated deck images, kept between runs unless caching is off
+  transforms = imagecache.configure(transforms_dir)
+
+  # Line breaks and sizes of texts, also kept between runs
+  layouts = layoutcache.configure(layouts_path)
 
-  cards = []
-  while (True):
-    face = tmpl.make_card(textgen)
-    if (face is None): break
-    cards.append(face)
+  # Within a memory budget, caches give way and fewer cards are in flight at once
+  governor = None
+  if (max_memory is not None):
+    governor = memory.configure(max_memory)
+    governor.register("transformed images", transforms)
+    stream, queue_size, prefetch = governor.plan(tmpl, stream, not (optimize or quantize is not None), queue_size, prefetch)
 
-  log.log.write("Generated %d cards.\n" % len(cards))
+  if (archive is not None):
+    # Sheets and their manifest go straight into a single archive (or out to a pipe)
+    from archive import ArchiveWriter
+    try:
+      writer = ArchiveWriter(archive, output_prefix, tmpl.hidden,
+                             optimize=optimize, quantize=quantize, stream=stream)
+    except OSError as e:
+      log.error("archive", "Unable to write %s: %s", archive, e)
+      return 2
+  else:
+    # Sheets which are identical to the ones from the last run aren't encoded again
+    writer = SheetWriter(output_prefix, tmpl.hidden, merge=(shard is not None),
+                         optimize=optimize, quantize=quantize, stream=stream)
 
-  tiler = CardTiler()
-  tilings = tiler.tile(cards, tmpl.hidden)
+  first_sheet = 0
+  plan = None
+  if (cards is None and shard is None):
+    # Keeps track of the next piece of text in each opened file,
+    # and remembers it until the card is rendered.
+    index = RecordingGenerator(deck)
 
-  serial = 1
-  for img in tilings:
-    filename = output_prefix + str(serial).zfill(2) + ".png"
-    img.save(filename)
-    serial += 1
+    # Which content goes on which card only depends on the deck and the size and fonts of the labels.
+    # With the plan of an earlier run, a restyled template goes straight to rendering.
+    plans = None
+    if (cache_dir is not None):
+      from plan import CardPlan, PlanCache
+      plans = PlanCache(cache_dir)
+      plan_key = plans.key(tmpl, deck)
+      plan = plans.load(plan_key, deck)
+
+    if (plan is not None):
+      log.info("progress", "Reusing the card plan of an earlier run (%d cards).", len(plan.cards))
+      selected = plan.items()
+      plans = None
+    elif (plans is not None):
+      plan = CardPlan()
+      selected = plan.record(select_cards(tmpl, index))
+    else:
+      selected = select_cards(tmpl, index)
+
+  else:
+    # Work out which content goes on which card, then render only the requested ones
+    index = DeckIndex(deck)
+    total = index.build(tmpl)
+    log.info("progress", "Indexed %d cards.", total)
+
+    if (shard is not None):
+      # Only the cards on this shard's sheets. They start on a fresh sheet,
+      # so the tiling (and numbering) matches a render of the whole deck.
+      first_sheet, end_sheet = sharding.shard_sheets(shard, total)
+      cards = sharding.shard_cards(shard, total)
+      log.info("progress", "Shard %d of %d renders sheets %d-%d.", shard[0], shard[1], first_sheet + 1, end_sheet)
+
+    for number in cards:
+      if (number > total):
+        log.warning("card-range", "Warning: Deck only has %d cards, skipping card %d.", total, number)
+    selected = [ (n, index.cards[n - 1], None) for n in cards if n <= total ]
+
+  # Cards are rendered by workers on other machines, which connect to us
+  workers = None
+  if (coordinator is not None):
+    from distributed import Coordinator
+    try:
+      workers = Coordinator(coordinator, batch_size=batch_size)
+      workers.start(spec, tmpl, index)
+    except (OSError, ValueError) as e:
+      log.error("worker", "Unable to coordinate workers: %s", e)
+      if (archive is not None):
+        writer.discard()
+      return 2
+
+  # Selecting, rendering, tiling and writing all run at once, each on its own thread
+  result = render_deck(tmpl, index, selected, writer, first_sheet=first_sheet,
+                       fill_missing=(shard is not None), prefetch=prefetch, depth=queue_size,
+                       cancel=cancel, progress=progress, coordinator=workers)
+
+  layoutcache.disable()
+  memory.disable()
+  if (governor is not None):
+    governor.report()
+
+  if (result is None):
+    if (archive is not None):
+      writer.discard()
+    log.info("progress", "Cancelled after %d sheets.", writer.written + writer.skipped)
+    log.summary()
+    return 3
+
+  count, filenames = result
+  if (plan is not None and plans is not None):
+    plan.finish(index)
+    plans.store(plan_key, plan)
+
+  log.info("progress", "Generated %d cards.", count)
+  if (archive is not None):
+    log.info("progress", "Wrote %d sheets and their manifest to %s.", writer.written,
+             "standard output" if archive == "-" else archive)
+  if (transforms.hits + transforms.misses > 0):
+    log.debug("transform-cache", "Transformed images: %d reused, %d computed.", transforms.hits, transforms.misses)
+  if (layouts.hits + layouts.misses > 0):
+    log.debug("layout-cache", "Text layouts: %d reused, %d computed.", layouts.hits, layouts.misses)
+
+  if (shard is not None):
+    fingerprint = sharding.deck_fingerprint(spec, index, preview_scale)
+    manifest = sharding.write_manifest(output_prefix, shard, total, fingerprint, filenames)
+    log.info("progress", "Wrote shard manifest %s", manifest)
+
+  log.summary()
+
+
+def write_trace():
+  """ Write the --trace file, if there is one """
+  import tracing
+  if (tracing.tracer is None):
+    return
+  try:
+    path = tracing.close()
+    log.info("trace", "Wrote the trace of this run to %s", path)
+  except OSError as e:
+    log.error("trace", "Unable to write the trace: %s", e)
 
 
 def main():
@@ -65,13 +247,155 @@ def main():
                       help="A JSON file defining the layout of each card.")
 
   parser.add_argument("--deck", "-d", default=None,
-                      help="A directory with text files, as named in the JSON template")
+                      help="A directory (or .zip archive) with text files and images, as named in the JSON template")
 
   parser.add_argument("--output-prefix", "-o", metavar="output_prefix", default="",
                       help="Name prefix for the generated deck JPEGs. A serial number will be appended. By default, will contain the template name and the deck name.")
 
+  parser.add_argument("--prefetch", metavar="N", default=8, type=int,
+                      help="Decode the images needed by the next N cards on background threads. 0 disables prefetching.")
+
+  parser.add_argument("--queue-size", metavar="N", default=8, type=int,
+                      help="How many cards (or sheets) each rendering stage may get ahead of the next one.")
+
+  parser.add_argument("--preview-scale", metavar="SCALE", default=1.0, type=float,
+                      help="Render a quick draft of the deck, scaled down by this factor (e.g. 0.25). Warns wherever the full-size layout would differ.")
+
+  parser.add_argument("--cards", metavar="RANGES", default=None,
+                      help="Only render the given cards of the deck, numbered from 1 (e.g. 1400-1410 or 3,7,12-15).")
+
+  parser.add_argument("--shard", metavar="i/N", default=None,
+                      help="Render only the i:th of N equal parts of the deck, e.g. to spread a deck over several machines. Writes a shard manifest next to the sheets.")
+
+  parser.add_argument("--check-shards", metavar="output_prefix", default=None,
+                      help="Check that the shard manifests and sheets with the given prefix make up a complete deck.")
+
+  parser.add_argument("--query-param", metavar="NAME=VALUE", default=[], action="append",
+                      help="A value for a :NAME parameter in the deck's database queries (e.g. --query-param pack=base). May be repeated.")
+
+  parser.add_argument("--optimize", action="store_true",
+                      help="Save each sheet in the smallest lossless image mode (grayscale, palette or RGB).")
+
+  parser.add_argument("--quantize", metavar="COLORS", default=None, type=int,
+                      help="Reduce each sheet to a palette of at most this many colors (2-256). Lossy, implies --optimize.")
+
+  parser.add_argument("--stream-sheets", action="store_true",
+                      help="Tile and encode sheets one row of cards at a time, so a whole sheet is never held in memory.")
+
+  parser.add_argument("--archive", metavar="FILE", default=None,
+                      help="Write the sheets and their manifest into a single .tar, .tar.gz or .zip file as they're finished, instead of as separate files. - writes a tar stream to standard output.")
+
+  parser.add_argument("--max-memory", metavar="SIZE", default=None,
+                      help="Keep the run within about this much memory (e.g. 512M or 2G) by dropping cached images, streaming sheets and rendering fewer cards ahead.")
+
+  parser.add_argument("--coordinator", metavar="HOST:PORT", default=None,
+                      help="Have the cards rendered by workers (see --worker), which connect to this address. Selecting the content of each card and writing the sheets still happens here. With just a PORT, only workers on this machine can connect; use 0.0.0.0:PORT to take workers from other machines.")
+
+  parser.add_argument("--worker", metavar="HOST:PORT", default=None,
+                      help="Render cards for the coordinator at this address until the deck is done. No template or deck is needed, they come from the coordinator.")
+
+  parser.add_argument("--batch-size", metavar="N", default=16, type=int,
+                      help="How many cards the coordinator hands a worker at a time.")
+
+  parser.add_argument("--watch", action="store_true",
+                      help="Keep running, and re-render the cards (and rewrite the sheets) affected whenever the template or deck files change.")
+
+  parser.add_argument("--cache-dir", metavar="DIR", default=None,
+                      help="Keep compiled templates, transformed deck images, text layouts and card plans here, so later runs redo less work. Transformed images are pruned, least recently used first, beyond 1 GiB. Defaults to ~/.cache/cardcinogen.")
+
+  parser.add_argument("--no-cache", action="store_true",
+                      help="Don't read or write any cache (templates, transformed images, text layouts or card plans).")
+
+  parser.add_argument("--log-level", default="info", choices=sorted(log.LEVELS, key=log.LEVELS.get),
+                      help="Only show messages of at least this severity.")
+
+  parser.add_argument("--log-limit", metavar="N", default=10, type=int,
+                      help="Show at most N messages of each kind (e.g. overflowing texts), and only count the rest. 0 shows all of them.")
+
+  parser.add_argument("--trace", metavar="FILE", default=None,
+                      help="Record when each step of the run (compiling, selecting and rendering each card, tiling, encoding) started and ended, on which thread, and write it to this file for a trace viewer such as chrome://tracing or ui.perfetto.dev.")
+
+  parser.add_argument("--log-detail", metavar="FILE", default=None,
+                      help="Write every message, including the ones hidden by --log-limit, to this file.")
+
   conf = parser.parse_args()
 
+  log.configure(log.LEVELS[conf.log_level], conf.log_limit or None, conf.log_detail)
+
+  if (conf.trace is not None):
+    import tracing
+    tracing.configure(conf.trace)
+
+  if (conf.check_shards is not None):
+    import shard as sharding
+    return sharding.check_manifests(conf.check_shards)
+
+  try:
+    if (conf.coordinator is not None):
+      from distributed import parse_address
+      conf.coordinator = parse_address(conf.coordinator)
+    if (conf.worker is not None):
+      from distributed import parse_address
+      conf.worker = parse_address(conf.worker, "localhost")
+  except ValueError as e:
+    parser.error(str(e))
+
+  if (conf.max_memory is not None):
+    from memory import parse_size
+    try:
+      conf.max_memory = parse_size(conf.max_memory)
+    except ValueError as e:
+      parser.error("--max-memory: " + str(e))
+
+  if (conf.batch_size < 1):
+    parser.error("--batch-size must be at least 1")
+
+  if (conf.worker is not None):
+    from distributed import run_worker
+    try:
+      rendered = run_worker(conf.worker)
+    except (OSError, ValueError) as e:
+      log.error("worker", "Lost the coordinator: %s", e)
+      write_trace()
+      log.close()
+      return 1
+    log.info("worker", "Rendered %d cards.", rendered)
+    write_trace()
+    log.close()
+    return 0
+
+  # These are parsed here rather than by argparse, to keep their modules out of --help
+  try:
+    if (conf.cards is not None):
+      from deckindex import parse_card_ranges
+      conf.cards = parse_card_ranges(conf.cards)
+    if (conf.shard is not None):
+      from shard import parse_shard
+      conf.shard = parse_shard(conf.shard)
+  except ValueError as e:
+    parser.error(str(e))
+
+  if (len(conf.query_param) > 0):
+    import sqlsource
+    for param in conf.query_param:
+      if ("=" not in param):
+        parser.error("--query-param must be of the form NAME=VALUE")
+      name, value = param.split("=", 1)
+      sqlsource.parameters[name] = value
+
+  if (conf.stream_sheets and (conf.optimize or conf.quantize is not None)):
+    parser.error("--optimize and --quantize need whole sheets, they can't be combined with --stream-sheets")
+
+  if (conf.queue_size < 1):
+    parser.error("--queue-size must be at least 1")
+
+  if (conf.quantize is not None and not 2 <= conf.quantize <= 256):
+    parser.error("--quantize must be between 2 and 256 colors")
+
+  if (conf.cache_dir is None):
+    import util
+    conf.cache_dir = util.default_cache_dir()
+
   if (conf.template is None and
       conf.deck is None and
       conf.output_prefix == ""):
@@ -87,7 +411,24 @@ def main():
       parser.print_help()
       return 2
   else:
-    return generate(conf.template, conf.deck, conf.output_prefix)
+    ret = generate(conf.template, conf.deck, conf.output_prefix,
+                   prefetch=conf.prefetch,
+                   queue_size=conf.queue_size,
+                   preview_scale=conf.preview_scale,
+                   cards=conf.cards,
+                   shard=conf.shard,
+                   cache_dir=None if conf.no_cache else conf.cache_dir,
+                   optimize=conf.optimize,
+                   quantize=conf.quantize,
+                   watch=conf.watch,
+                   stream=conf.stream_sheets,
+                   coordinator=conf.coordinator,
+                   batch_size=conf.batch_size,
+                   max_memory=conf.max_memory,
+                   archive=conf.archive)
+    write_trace()
+    log.close()
+    return ret
 
 
 if __name__ == '__main__':
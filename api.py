@@ -0,0 +1,212 @@
+import unittest
+
+import io
+import os
+import json
+import queue
+import tempfile
+import threading
+
+from PIL import Image
+
+import log
+import imagecache
+import layoutcache
+import deckfiles
+import tracing
+from card import CardTemplate
+from compiler import compile_template, validate_template, TemplateCache
+from deckindex import RecordingGenerator
+from pipeline import render_deck, select_cards
+from sheets import SheetWriter, optimize_sheet
+from tiler import CARDS_PER_SHEET
+
+
+# Put on the queue of finished sheets once the render is over
+DONE = object()
+
+class Sheet:
+  """ A finished sheet, as yielded by render_sheets """
+
+  def __init__(self, entry, image, data):
+    self.serial = entry["serial"]
+    self.filename = entry["filename"]
+
+    # Which card is in which slot, counted left to right and top to bottom:
+    # [ { "slot": 0, "card": 1, "hash": "..." }, ... ]. The hidden card is in the last slot.
+    self.cards = entry["cards"]
+    self.hidden_slot = CARDS_PER_SHEET
+
+    # The entry of the sheet in a manifest (see SheetWriter.finish)
+    self.entry = entry
+
+    # The sheet as a PIL image, or encoded (PNG or JPEG bytes) if an encoding was asked for
+    self.image = image
+    self.data = data
+
+
+class SheetQueue(SheetWriter):
+  """ Hands sheets over to render_sheets instead of saving them. Encoding still happens
+      on the pipeline's write threads, and waits while the caller is behind. """
+
+  def __init__(self, hidden, stop, name="sheet", encoding=None, optimize=False, quantize=None):
+    super().__init__(name, hidden, encoding=encoding or "png", optimize=optimize, quantize=quantize)
+    self.format = { "jpg": "jpeg" }.get(encoding, encoding)
+    self.stop = stop
+    self.queue = queue.Queue(2)
+
+  def load_previous(self):
+    # Nothing on disk to compare against
+    return {}
+
+  def put(self, item):
+    while (not self.stop.is_set()):
+      try:
+        self.queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def save(self, filename, entry, img):
+    data = None
+    with tracing.span("encode sheet", "write", sheet=entry["filename"]):
+      if (self.optimize):
+        img, description = optimize_sheet(img, self.quantize)
+        log.debug("sheets", "%s: %s", entry["filename"], description)
+      mode, size = img.mode, img.size
+
+      if (self.format is not None):
+        buffer = io.BytesIO()
+        img.save(buffer, self.format)
+        data = buffer.getvalue()
+        img = None
+
+    self.record(entry, mode, size, len(data) if data is not None else None)
+    self.put(Sheet(entry, img, data))
+
+  def finish(self):
+    return None
+
+
+def load_template(template, template_dir=None):
+  """ A parsed template and the directory its images are relative to, from a dict or a JSON file """
+  if (isinstance(template, dict)):
+    return (template, template_dir or ".")
+
+  with open(template, "r", encoding="utf-8-sig") as handle:
+    try:
+      spec = json.load(handle)
+    except ValueError as e:
+      raise ValueError("JSON error in %s: %s" % (template, e))
+  return (spec, template_dir or os.path.dirname(template))
+
+
+def render_sheets(template, deck, template_dir=None, encoding=None, preview_scale=1.0,
+                  optimize=False, quantize=None, cache_dir=None, prefetch=8, queue_size=8):
+  """ Render a deck, yielding each sheet (see Sheet) as soon as it is complete, in order.
+      The template is a parsed JSON template or the filename of one. Images it names are
+      relative to template_dir, which defaults to the template's own directory. deck is
+      the deck directory or .zip archive. With an encoding ("png" or "jpeg") the sheets come as bytes,
+      otherwise as PIL images. Caches are only used with a cache_dir, and are then shared
+      by the whole process. Stopping early (closing the generator) stops the render.
+      Raises ValueError if the template or deck can't be used. """
+  spec, template_dir = load_template(template, template_dir)
+
+  _, errors = validate_template(spec)
+  if (len(errors) > 0):
+    raise ValueError("Template errors: " + "; ".join(errors))
+
+  if (not deckfiles.is_deck(deck)):
+    raise ValueError("%s is not a deck directory or .zip archive" % deck)
+
+  cache = None
+  if (cache_dir is not None):
+    cache = TemplateCache(cache_dir)
+    imagecache.configure(os.path.join(cache_dir, "transforms"))
+    layoutcache.configure(os.path.join(cache_dir, "layouts.sqlite"))
+  tmpl = compile_template(spec, template_dir, scale=preview_scale, cache=cache)
+
+  stop = threading.Event()
+  sheets = SheetQueue(tmpl.hidden, stop, encoding=encoding, optimize=optimize, quantize=quantize)
+
+  outcome = {}
+  def run():
+    try:
+      content_gen = RecordingGenerator(deck)
+      render_deck(tmpl, content_gen, select_cards(tmpl, content_gen), sheets,
+                  prefetch=prefetch, depth=queue_size, cancel=stop)
+    except BaseException as e:
+      outcome["error"] = e
+    finally:
+      if (cache_dir is not None):
+        layoutcache.disable()
+      sheets.put(DONE)
+
+  thread = threading.Thread(target=run, name="render_sheets", daemon=True)
+  thread.start()
+
+  try:
+    # Two sheets can be encoded at once, so they may finish out of order
+    waiting = {}
+    serial = 1
+    while (True):
+      item = sheets.queue.get()
+      if (item is DONE):
+        break
+      waiting[item.serial] = item
+      while (serial in waiting):
+        yield waiting.pop(serial)
+        serial += 1
+
+    if ("error" in outcome):
+      raise outcome["error"]
+  finally:
+    stop.set()
+    thread.join()
+
+
+#
+# Unit tests
+#
+class TestApi(unittest.TestCase):
+
+  def make_deck(self, count):
+    deck = tempfile.mkdtemp()
+    with open(os.path.join(deck, "images.txt"), "w", encoding="utf-8") as handle:
+      for i in range(count):
+        name = "img%d.png" % i
+        Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, name))
+        handle.write(name + "\n")
+    return deck
+
+  def test_sheets(self):
+    deck = self.make_deck(CARDS_PER_SHEET + 3)
+    spec = { "layouts": [ { "images": [ { "source": "images.txt", "x": 0, "y": 0 } ] } ] }
+
+    sheets = list(render_sheets(spec, deck))
+    self.assertEqual([ s.serial for s in sheets ], [ 1, 2 ])
+    self.assertEqual(len(sheets[0].cards), CARDS_PER_SHEET)
+    self.assertEqual(sheets[1].cards[2]["card"], CARDS_PER_SHEET + 3)
+
+    # The same pixels as the command line would write
+    tmpl = CardTemplate(spec, ".")
+    writer = SheetWriter(os.path.join(tempfile.mkdtemp(), "deck_"), tmpl.hidden)
+    content_gen = RecordingGenerator(deck)
+    _, filenames = render_deck(tmpl, content_gen, select_cards(tmpl, content_gen), writer)
+    self.assertEqual(sheets[1].image.tobytes(), Image.open(filenames[1]).tobytes())
+
+    # Encoded
+    sheet = next(render_sheets(spec, deck, encoding="png"))
+    self.assertEqual(sheet.image, None)
+    self.assertEqual(Image.open(io.BytesIO(sheet.data)).tobytes(), Image.open(filenames[0]).tobytes())
+
+    # Stopping early ends the render
+    sheets = render_sheets(spec, self.make_deck(3 * CARDS_PER_SHEET))
+    next(sheets)
+    sheets.close()
+
+    self.assertRaises(ValueError, lambda: list(render_sheets({ "layouts": {} }, deck)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import zipfile
+import tempfile
+
+from PIL import Image
+
+import tracing
+from sheets import SheetWriter, manifest_name
+from tiler import CARDS_PER_SHEET
+
+
+class TarArchive:
+  """ A tar file, or a tar stream (to standard output for "-") which is never seeked """
+
+  def __init__(self, path):
+    if (path == "-"):
+      self.tar = tarfile.open(fileobj=sys.stdout.buffer, mode="w|")
+    elif (path.endswith(".tar.gz") or path.endswith(".tgz")):
+      self.tar = tarfile.open(path, "w:gz")
+    else:
+      self.tar = tarfile.open(path, "w")
+
+  def member(self, name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    return info
+
+  def add(self, name, data):
+    self.tar.addfile(self.member(name, len(data)), io.BytesIO(data))
+
+  def add_file(self, name, path):
+    with open(path, "rb") as handle:
+      self.tar.addfile(self.member(name, os.path.getsize(path)), handle)
+
+  def close(self):
+    self.tar.close()
+    if (self.tar.fileobj is sys.stdout.buffer):
+      sys.stdout.buffer.flush()
+
+
+class ZipArchive:
+  """ A zip file. Sheets are stored as they are, since PNG and JPEG don't compress any further. """
+
+  def __init__(self, path):
+    self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+
+  def add(self, name, data):
+    compression = zipfile.ZIP_DEFLATED if name.endswith(".json") else zipfile.ZIP_STORED
+    self.zip.writestr(name, data, compress_type=compression)
+
+  def add_file(self, name, path):
+    self.zip.write(path, name)
+
+  def close(self):
+    self.zip.close()
+
+
+def open_archive(path):
+  """ A zip archive for .zip files, a tar archive otherwise (and for "-", standard output) """
+  if (path.lower().endswith(".zip")):
+    return ZipArchive(path)
+  return TarArchive(path)
+
+
+class ArchiveWriter(SheetWriter):
+  """ Puts each sheet into a single archive as soon as it's encoded, and the manifest last,
+      instead of writing loose files. Sheets go in the order they're finished. Every sheet is
+      encoded, as there are no files from an earlier run to keep. With stream, a sheet is
+      encoded a row at a time into a scratch file, which is copied in and removed. """
+
+  def __init__(self, path, output_prefix, hidden, encoding="png", optimize=False, quantize=None, stream=False):
+    super().__init__(output_prefix, hidden, encoding=encoding, optimize=optimize, quantize=quantize, stream=stream)
+    self.path = path
+    self.format = { "jpg": "jpeg" }.get(encoding, encoding)
+    self.archive = open_archive(path)
+    self.scratch = tempfile.mkdtemp(prefix="cardcinogen-") if stream else None
+
+  def load_previous(self):
+    return {}
+
+  def filename(self, serial):
+    name = super().filename(serial)
+    if (self.scratch is None):
+      return name
+    return os.path.join(self.scratch, os.path.basename(name))
+
+  def store(self, filename, entry, img):
+    buffer = io.BytesIO()
+    img.save(buffer, self.format)
+    data = buffer.getvalue()
+    with self.lock:
+      self.archive.add(entry["filename"], data)
+    return len(data)
+
+  def place(self, temporary, filename, entry, mode, size):
+    length = os.path.getsize(temporary)
+    with tracing.span("archive sheet", "write", sheet=entry["filename"]):
+      with self.lock:
+        self.archive.add_file(entry["filename"], temporary)
+    os.remove(temporary)
+    self.record(entry, mode, size, length)
+
+  def finish(self):
+    """ Add the manifest and complete the archive """
+    name = os.path.basename(manifest_name(self.output_prefix))
+    with self.lock:
+      self.archive.add(name, json.dumps(self.manifest(), indent=2).encode("utf-8"))
+      self.archive.close()
+    self.remove_scratch()
+    self.report()
+    return self.path
+
+  def discard(self):
+    """ Give up on the archive, when the run was cancelled """
+    try:
+      self.archive.close()
+    except (OSError, tarfile.TarError):
+      pass
+    self.remove_scratch()
+    if (self.path != "-" and os.path.exists(self.path)):
+      os.remove(self.path)
+
+  def remove_scratch(self):
+    if (self.scratch is not None):
+      shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+#
+# Unit tests
+#
+class TestArchive(unittest.TestCase):
+
+  def write(self, path, stream=False):
+    from sheets import write_sheets
+    hidden = Image.new("RGB", (6, 8), (255, 0, 255))
+    faces = [ Image.new("RGB", (6, 8), (i, 0, 0)) for i in range(CARDS_PER_SHEET + 2) ]
+    writer = ArchiveWriter(path, "deck_", hidden, stream=stream)
+    write_sheets(writer, faces, list(range(1, len(faces) + 1)))
+    return writer
+
+  def test_tar(self):
+    for stream in [ False, True ]:
+      path = os.path.join(tempfile.mkdtemp(), "deck.tar")
+      writer = self.write(path, stream)
+      self.assertEqual(writer.written, 2)
+
+      with tarfile.open(path) as tar:
+        self.assertEqual(sorted(tar.getnames()), [ "deck_01.png", "deck_02.png", "deck_manifest.json" ])
+        manifest = json.load(tar.extractfile("deck_manifest.json"))
+        data = tar.extractfile("deck_02.png").read()
+      sheet = Image.open(io.BytesIO(data))
+      self.assertEqual(sheet.getpixel((6, 0)), (CARDS_PER_SHEET + 1, 0, 0))
+      self.assertEqual(manifest["sheets"][1]["cards"][1]["card"], CARDS_PER_SHEET + 2)
+      self.assertEqual(manifest["sheets"][1]["bytes"], len(data))
+      if (stream):
+        self.assertFalse(os.path.exists(writer.scratch))
+
+  def test_zip(self):
+    path = os.path.join(tempfile.mkdtemp(), "deck.zip")
+    self.write(path)
+    with zipfile.ZipFile(path) as archive:
+      self.assertEqual(archive.namelist()[-1], "deck_manifest.json")
+      sheet = Image.open(io.BytesIO(archive.read("deck_01.png")))
+    self.assertEqual(sheet.getpixel((0, 0)), (0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
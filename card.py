@@ -6,6 +6,7 @@ import sys
 
 import util
 import log
+import tracing
 
 from PIL import Image
 from layout import SimpleLayout, ComplexLayout
@@ -14,7 +15,7 @@ from layout import SimpleLayout, ComplexLayout
 
 class CardTemplate:
   """ Parsed version of a JSON card template """
-  def __init__(self, json, rootdir="."):
+  def __init__(self, json, rootdir=".", scale=1.0):
     self.front_name =   util.get_default(json, "front-image", "front.png")
     self.hidden_name =  util.get_default(json, "hidden-image", "hidden.png")
 
@@ -22,24 +23,55 @@ class CardTemplate:
     for j in util.get_default(json, "layouts", []):
       self.type = util.get_default(j, "type", "simple")
       if (self.type == "complex"):
-        self.layouts.append(ComplexLayout(j, rootdir))
+        self.layouts.append(ComplexLayout(j, rootdir, scale))
       else:
-        self.layouts.append(SimpleLayout(j, rootdir))
+        self.layouts.append(SimpleLayout(j, rootdir, scale))
 
-    front_path  = os.path.join(rootdir, self.front_name)
-    hidden_path = os.path.join(rootdir, self.hidden_name)
+    self.front_path  = os.path.join(rootdir, self.front_name)
+    self.hidden_path = os.path.join(rootdir, self.hidden_name)
 
     # Make sure we have valid images and they all have matching sizes
-    self.front   = util.default_image(front_path, (372, 520))
-    self.hidden  = util.default_image(hidden_path, self.front.size, self.front.size)
+    self.front   = util.default_image(self.front_path, (372, 520))
+    self.hidden  = util.default_image(self.hidden_path, self.front.size, self.front.size)
+
+    # A preview render shrinks everything, cards included
+    self.scale = scale
+    if (scale != 1.0):
+      self.front  = util.scaled_image(self.front, scale)
+      self.hidden = util.scaled_image(self.hidden, scale)
+
+  def dependencies(self):
+    """ All the files (images, fonts) this template was built from """
+    files = [ self.front_path, self.hidden_path ]
+    for l in self.layouts:
+      files += l.dependencies()
+    return files
+
+  def locate_fonts(self, fonts=None):
+    """ Look up the font file of every text label, without opening any.
+        Or use the given font files (None for the built-in font), one per label in layout order. """
+    labels = [ label for l in self.layouts for label in l.text_labels() ]
+    if (fonts is None):
+      for label in labels:
+        label.locate_font()
+      return
+
+    if (len(fonts) != len(labels)):
+      raise ValueError("Expected %d font files, got %d" % (len(labels), len(fonts)))
+    for label, fontfile in zip(labels, fonts):
+      label.use_font(fontfile)
 
   def make_card(self, textgen):
     """ Generate a single card """
 
     if (len(self.layouts) == 0):
-      log.log.write("Warning: No layouts specified.")
+      log.warning("no-layouts", "Warning: No layouts specified.")
       return None
 
+    if (textgen.prefetcher is not None):
+      # Start decoding images for upcoming cards while we render this one
+      textgen.prefetcher.look_ahead(self.layouts)
+
     face = self.front.copy()
     for l in self.layouts:
 
@@ -56,6 +88,33 @@ class CardTemplate:
     # None of the layouts can generate any cards. We're done.
     return None
 
+  def select_card(self, textgen):
+    """ Pick the layout and contents of the next card, like make_card, without rendering it """
+
+    if (len(self.layouts) == 0):
+      log.warning("no-layouts", "Warning: No layouts specified.")
+      return None
+
+    for i,l in enumerate(self.layouts):
+      content = l.select(self.front.size, textgen)
+      if (content is not None):
+        content["layout"] = i
+        return content
+
+    return None
+
+  def render_card(self, layout, textgen):
+    """ Generate a single card using a specific layout """
+    face = self.front.copy()
+
+    overlay = self.layouts[layout].render(face.size, textgen)
+    if (overlay is None):
+      return None
+
+    with tracing.span("composite"):
+      face.paste(overlay, mask=overlay)
+    return face
+
 
 
 #
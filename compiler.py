@@ -0,0 +1,267 @@
+import unittest
+
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+import PIL
+from PIL import Image
+
+import log
+import util
+import tracing
+from card import CardTemplate
+
+
+# Bump this whenever the pickled classes change shape
+CACHE_VERSION = 5
+
+INT_FIELDS = [ "x", "y", "width", "height", "font-size", "min-font-size", "line-spacing", "rotation" ]
+
+CHOICES = {
+  "justify":      [ "left", "center", "right" ],
+  "x-align":      [ "left", "center", "right" ],
+  "y-align":      [ "top", "center", "bottom" ],
+  "font-weight":  [ "regular", "bold", "italic" ],
+  "rasterizer":   [ "freetype", "atlas" ],
+}
+
+
+def validate_label(spec, where):
+  """ Check a single text or image label. Returns (warnings, errors) """
+  warnings = []
+  errors = []
+
+  if (not isinstance(spec, dict)):
+    return ([], [ "%s is not an object" % where ])
+
+  for key in INT_FIELDS:
+    if (key in spec):
+      try:
+        int(spec[key])
+      except (TypeError, ValueError):
+        errors.append("%s: \"%s\" must be a number, not %r" % (where, key, spec[key]))
+
+  for key, choices in CHOICES.items():
+    if (key in spec and spec[key] not in choices):
+      warnings.append("%s: \"%s\" should be one of %s, not %r" % (where, key, ", ".join(choices), spec[key]))
+
+  return (warnings, errors)
+
+def validate_template(spec):
+  """ Check a parsed JSON template for mistakes. Returns (warnings, errors) """
+  warnings = []
+  errors = []
+
+  if (not isinstance(spec, dict)):
+    return ([], [ "The template is not a JSON object" ])
+
+  layouts = util.get_default(spec, "layouts", [])
+  if (not isinstance(layouts, list)):
+    return ([], [ "\"layouts\" must be a list" ])
+
+  if (len(layouts) == 0):
+    warnings.append("The template has no layouts")
+
+  for i, layout in enumerate(layouts):
+    where = "Layout %d" % (i + 1)
+    if (not isinstance(layout, dict)):
+      errors.append("%s is not an object" % where)
+      continue
+
+    kind = util.get_default(layout, "type", "simple")
+    if (kind not in [ "simple", "complex" ]):
+      warnings.append("%s: unknown type %r, treating it as simple" % (where, kind))
+
+    for field in [ "texts", "images" ]:
+      labels = util.get_default(layout, field, [])
+      if (not isinstance(labels, list)):
+        errors.append("%s: \"%s\" must be a list" % (where, field))
+        continue
+
+      for j, label in enumerate(labels):
+        label_where = "%s, %s %d" % (where, field, j + 1)
+        w, e = validate_label(label, label_where)
+        warnings += w
+        errors += e
+
+        if (kind == "complex" and isinstance(label, dict) and "name" not in label):
+          warnings.append("%s has no \"name\" in a complex layout" % label_where)
+
+  return (warnings, errors)
+
+
+def stamp(path):
+  """ Identify a version of a file, cheaply """
+  try:
+    st = os.stat(path)
+  except OSError:
+    return (path, None, None)
+  return (path, st.st_size, st.st_mtime_ns)
+
+
+class TemplateCache:
+  """ Stores compiled (parsed, validated, fully loaded) card templates between runs """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def key(self, spec, rootdir, scale):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(spec, sort_keys=True).encode("utf-8"))
+    digest.update(os.path.abspath(rootdir).encode("utf-8"))
+    digest.update(repr((scale, CACHE_VERSION, PIL.__version__)).encode("utf-8"))
+    return digest.hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.directory, "templates", key + ".pickle")
+
+  def load(self, key):
+    """ Fetch a compiled template, if it is still up to date """
+    try:
+      with open(self.path(key), "rb") as handle:
+        entry = pickle.load(handle)
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      # Truncated, or written by something else entirely
+      log.debug("template-cache", "Unable to read the compiled template, recompiling it: %s", e)
+      return None
+
+    try:
+      # The template itself is part of the key, but the images and fonts it uses may have changed
+      for dependency in entry["dependencies"]:
+        if (stamp(dependency[0]) != tuple(dependency)):
+          log.debug("template-cache", "%s has changed, recompiling the template", dependency[0])
+          return None
+      template = entry["template"]
+    except Exception as e:
+      log.debug("template-cache", "Unable to read the compiled template, recompiling it: %s", e)
+      return None
+
+    if (not isinstance(template, CardTemplate)):
+      log.debug("template-cache", "%s doesn't hold a compiled template, recompiling it", self.path(key))
+      return None
+    return template
+
+  def store(self, key, template):
+    entry = {
+      "dependencies": [ stamp(path) for path in template.dependencies() ],
+      "template": template
+    }
+
+    try:
+      util.write_replacing(self.path(key), lambda handle: pickle.dump(entry, handle, pickle.HIGHEST_PROTOCOL))
+    except (OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+      # Not being able to cache (e.g. with the built-in bitmap font) is no reason to fail the run
+      log.debug("template-cache", "Unable to cache the compiled template: %s", e)
+
+
+def compile_template(spec, rootdir=".", scale=1.0, cache=None, fonts=None):
+  """ Validate a JSON template and build a CardTemplate from it, going through the cache if there is one.
+      fonts, if given, are the font files to use instead of looking them up, one for each of the
+      template's text labels (see CardTemplate.locate_fonts). Returns None if the template is broken. """
+  warnings, errors = validate_template(spec)
+  for problem in warnings:
+    log.warning("template", "Template warning: %s", problem)
+  for problem in errors:
+    log.error("template", "Template error: %s", problem)
+  if (len(errors) > 0):
+    return None
+
+  key = None
+  if (cache is not None):
+    key = cache.key(spec, rootdir, scale)
+    tmpl = cache.load(key)
+    if (tmpl is not None):
+      log.debug("template-cache", "Using the compiled template from %s", cache.path(key))
+      return tmpl
+
+  with tracing.span("compile template", "template"):
+    tmpl = CardTemplate(spec, rootdir, scale=scale)
+    # Font files are only looked up here, so a cached template needs no font listing
+    # and a changed font file invalidates it. They're opened on first use.
+    tmpl.locate_fonts(fonts)
+
+  if (cache is not None):
+    cache.store(key, tmpl)
+
+  return tmpl
+
+
+#
+# Unit tests
+#
+class TestCompiler(unittest.TestCase):
+
+  def test_validate(self):
+    self.assertEqual(validate_template({ "layouts": [ { "texts": [ { "x": 3 } ] } ] }), ([], []))
+
+    warnings, errors = validate_template({ "layouts": [ { "type": "fancy", "texts": [ { "justify": "middle" } ] } ] })
+    self.assertEqual(len(warnings), 2)
+    self.assertEqual(errors, [])
+
+    warnings, errors = validate_template({ "layouts": [ { "images": [ { "x": "left" } ] }, 3 ] })
+    self.assertEqual(len(errors), 2)
+
+    _, errors = validate_template({ "layouts": {} })
+    self.assertEqual(len(errors), 1)
+
+  def test_cache(self):
+    rootdir = tempfile.mkdtemp()
+    cache = TemplateCache(tempfile.mkdtemp())
+    front = os.path.join(rootdir, "front.png")
+    Image.new("RGB", (20, 30), (1, 2, 3)).save(front)
+    spec = { "layouts": [ { "images": [ { "source": "images.txt" } ] } ] }
+
+    first = compile_template(spec, rootdir, cache=cache)
+    second = compile_template(spec, rootdir, cache=cache)
+    self.assertTrue(first is not second)
+    self.assertEqual(second.front.tobytes(), first.front.tobytes())
+    self.assertEqual(len(second.layouts), 1)
+
+    # A cached template is used as long as nothing changes
+    key = cache.key(spec, rootdir, 1.0)
+    self.assertNotEqual(cache.load(key), None)
+
+    # Changing an image invalidates it
+    Image.new("RGB", (20, 31), (1, 2, 3)).save(front)
+    self.assertEqual(cache.load(key), None)
+    self.assertEqual(compile_template(spec, rootdir, cache=cache).front.size, (20, 31))
+
+    # And so does a different preview scale
+    self.assertEqual(cache.load(cache.key(spec, rootdir, 0.5)), None)
+
+    # Broken or foreign cache files are just misses
+    for entry in [ b"\x80\x04", pickle.dumps([ 1, 2 ]), pickle.dumps({ "dependencies": 3 }), pickle.dumps({ "dependencies": [], "template": "x" }) ]:
+      with open(cache.path(key), "wb") as handle:
+        handle.write(entry)
+      self.assertEqual(cache.load(key), None)
+
+    # Compiling looks up the font files of the labels, without opening them
+    spec = { "layouts": [ { "texts": [ { "source": "texts.txt" } ] } ] }
+    key = cache.key(spec, rootdir, 1.0)
+    label = compile_template(spec, rootdir, cache=cache).layouts[0].textlabels[0]
+    self.assertTrue(label._font_located)
+    self.assertEqual(label._font, None)
+    cached = cache.load(key).layouts[0].textlabels[0]
+    self.assertTrue(cached._font_located)
+    self.assertEqual(cached.fontfile, label.fontfile)
+
+    # Those font files are dependencies, too
+    font = os.path.join(rootdir, "font.ttf")
+    with open(font, "wb") as handle:
+      handle.write(b"a font")
+    tmpl = compile_template(spec, rootdir)
+    tmpl.layouts[0].textlabels[0]._fontfile = font
+    cache.store(key, tmpl)
+    self.assertNotEqual(cache.load(key), None)
+    with open(font, "ab") as handle:
+      handle.write(b", changed")
+    self.assertEqual(cache.load(key), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,11 +4,26 @@ import log
 
 import sys
 import os
+import io
 import json
+import hashlib
+import math
+import itertools
 import textwrap
+import tempfile
+import threading
+import weakref
+import zipfile
+from collections import deque
 import sysfont
 import util
-from PIL import Image, ImageDraw, ImageFont
+import deckfiles
+import imagecache
+import layoutcache
+import sqlsource
+import tracing
+from memory import image_bytes
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
 
 def wrap_pixel_width(text, maxwidth, font, linesep='\n'):
@@ -24,12 +39,17 @@ def wrap_pixel_width(text, maxwidth, font, linesep='\n'):
       ret += [" "]
       continue
 
+    # Successive attempts mostly produce the same lines, so only measure each one once
+    widths = {}
     for chars in range(len(paragraph), 1, -1):
       lines = textwrap.wrap(paragraph, chars)
       too_wide = False
       for l in lines:
-        lw, _ = font.getsize(l)
-        if (lw > maxwidth): too_wide = True
+        if (l not in widths):
+          widths[l], _ = font.getsize(l)
+        if (widths[l] > maxwidth):
+          too_wide = True
+          break
 
       if (not too_wide):
         ret += lines
@@ -75,10 +95,202 @@ def render_lines(lines, font, color="#000000", justify="left", spacing=4):
   return image.crop(image.getbbox())
 
 
+class GlyphAtlas:
+  """ Alpha masks and metrics of the glyphs of one font (face and size), rasterized once each """
+
+  def __init__(self, font):
+    self.font = font
+
+    # char -> (mask, (left, top)) or None for blank glyphs
+    self.glyphs = {}
+
+    # char -> box of the glyph's ink, or None for blank glyphs
+    self.inks = {}
+
+    # char -> advance width, (char, char) -> kerning adjustment
+    self.advances = {}
+    self.kerning = {}
+
+  def glyph(self, char):
+    if (char not in self.glyphs):
+      left, top, right, bottom = self.font.getbbox(char)
+      if (right <= left or bottom <= top):
+        self.glyphs[char] = None
+      else:
+        mask = Image.new("L", (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text((-left, -top), char, font=self.font, fill=255)
+        self.glyphs[char] = (mask, (left, top))
+    return self.glyphs[char]
+
+  def advance(self, char):
+    if (char not in self.advances):
+      self.advances[char] = self.font.getlength(char)
+    return self.advances[char]
+
+  def ink(self, char):
+    """ The box of a glyph's ink relative to the pen position, or None for blank glyphs """
+    if (char not in self.inks):
+      glyph = self.glyph(char)
+      box = None
+      if (glyph is not None):
+        # Pasted through itself as in draw(), the faintest edge pixels come out blank
+        image, (left, top) = glyph
+        pasted = Image.new("L", image.size, 0)
+        pasted.paste(image, (0, 0), image)
+        box = pasted.getbbox()
+        if (box is not None):
+          box = (left + box[0], top + box[1], left + box[2], top + box[3])
+      self.inks[char] = box
+    return self.inks[char]
+
+  def kern(self, previous, char):
+    pair = (previous, char)
+    if (pair not in self.kerning):
+      self.kerning[pair] = self.font.getlength(previous + char) - self.advance(previous) - self.advance(char)
+    return self.kerning[pair]
+
+  def draw(self, mask, xy, line):
+    """ Blit a line of text onto an "L" mask, with the pen starting at xy """
+    pen, y = xy
+    previous = None
+    for char in line:
+      if (previous is not None):
+        pen += self.kern(previous, char)
+
+      glyph = self.glyph(char)
+      if (glyph is not None):
+        image, (left, top) = glyph
+        mask.paste(image, (round(pen) + left, int(y) + top), image)
+
+      pen += self.advance(char)
+      previous = char
+
+_atlases = weakref.WeakKeyDictionary()
+
+def glyph_atlas(font):
+  atlas = _atlases.get(font, None)
+  if (atlas is None):
+    atlas = GlyphAtlas(font)
+    _atlases[font] = atlas
+  return atlas
+
+# Same as render_lines, but drawing each glyph from a cache instead of rasterizing the text.
+# Glyph positions may be off by a pixel here and there, since every glyph is rasterized on the pixel grid.
+def render_lines_atlas(lines, font, color="#000000", justify="left", spacing=4):
+  if (not hasattr(font, "getbbox")):
+    # Bitmap fonts are cheap to draw anyway
+    return render_lines(lines, font, color, justify, spacing)
+
+  atlas = glyph_atlas(font)
+
+  _, lineheight = font.getsize("M")
+  widths = [ font.getsize(l)[0] for l in lines ]
+  width = max(widths)
+  height = len(lines) * (lineheight + spacing)
+
+  mask = Image.new("L", (width*2, height*2), 0)
+
+  y = 0
+  for l,w in zip(lines, widths):
+    x = 0
+    if (justify == "center"): x = (width - w) / 2
+    if (justify == "right"): x = width - w
+
+    atlas.draw(mask, (x, y), l)
+    y += lineheight + spacing
+
+  # Color the text through the mask, in one go
+  mask = mask.crop(mask.getbbox())
+  image = Image.new("RGBA", mask.size, (0,0,0,0))
+  image.paste(color, (0, 0) + mask.size, mask)
+  return image
+
+
+def union_box(bounds, box, canvas):
+  """ Grow bounds (or None) by a box of ink, clipped to the canvas the text is drawn on """
+  box = (max(box[0], 0), max(box[1], 0), min(box[2], canvas[0]), min(box[3], canvas[1]))
+  if (box[0] >= box[2] or box[1] >= box[3]):
+    return bounds
+  if (bounds is None):
+    return box
+  return (min(bounds[0], box[0]), min(bounds[1], box[1]),
+          max(bounds[2], box[2]), max(bounds[3], box[3]))
+
+# Compute the size of the label render_lines() would produce, without drawing it.
+# Each line's glyphs are rasterized into a mask, placed the way ImageDraw.text places them,
+# so the size is exact. Nothing is composited, colored or cropped.
+def measure_lines(lines, font, justify="left", spacing=4):
+  _, lineheight = font.getsize("M")
+  widths = [ font.getsize(l)[0] for l in lines ]
+  width = max(widths)
+  canvas = (width*2, len(lines) * (lineheight + spacing) * 2)
+
+  if (not hasattr(font, "getmask2")):
+    # Bitmap fonts. Fall back to the unmargined layout size.
+    return (width, canvas[1] // 2)
+
+  bounds = None
+  y = 0
+  for l,w in zip(lines, widths):
+    x = 0
+    if (justify == "center"): x = (width - w) / 2
+    if (justify == "right"): x = width - w
+
+    mask, offset = font.getmask2(l, "L", start=(math.modf(x)[0], 0))
+    ink = mask.getbbox()
+    if (ink is not None):
+      left, top = int(x) + offset[0], y + offset[1]
+      bounds = union_box(bounds, (left + ink[0], top + ink[1], left + ink[2], top + ink[3]), canvas)
+
+    y += lineheight + spacing
+
+  if (bounds is None):
+    return (0, 0)
+  return (bounds[2] - bounds[0], bounds[3] - bounds[1])
+
+# Same as measure_lines, for the labels render_lines_atlas() produces
+def measure_lines_atlas(lines, font, justify="left", spacing=4):
+  if (not hasattr(font, "getbbox")):
+    return measure_lines(lines, font, justify, spacing)
+
+  atlas = glyph_atlas(font)
+
+  _, lineheight = font.getsize("M")
+  widths = [ font.getsize(l)[0] for l in lines ]
+  width = max(widths)
+  canvas = (width*2, len(lines) * (lineheight + spacing) * 2)
+
+  bounds = None
+  y = 0
+  for l,w in zip(lines, widths):
+    x = 0
+    if (justify == "center"): x = (width - w) / 2
+    if (justify == "right"): x = width - w
+
+    # The pen moves like in GlyphAtlas.draw
+    pen = x
+    previous = None
+    for char in l:
+      if (previous is not None):
+        pen += atlas.kern(previous, char)
+      ink = atlas.ink(char)
+      if (ink is not None):
+        left, top = round(pen), int(y)
+        bounds = union_box(bounds, (left + ink[0], top + ink[1], left + ink[2], top + ink[3]), canvas)
+      pen += atlas.advance(char)
+      previous = char
+
+    y += lineheight + spacing
+
+  if (bounds is None):
+    return (0, 0)
+  return (bounds[2] - bounds[0], bounds[3] - bounds[1])
+
+
 class TextLabel:
   """ Parsed version of a single text-label object """
 
-  def __init__(self, json):
+  def __init__(self, json, scale=1.0):
     """ Parse out the various settings of a text label and clean them up """
     self.name =       util.get_default(json, "name", "text")            # Only used in complex layout
     self.source =     util.get_default(json, "source", "text.txt")            # Optional, used by simple layout
@@ -90,6 +302,7 @@ class TextLabel:
     self.color =      util.get_default(json, "color", "#000000")
     self.fontface =   util.get_default(json, "font-face", "Palatino Linotype")
     self.fontsize =   util.get_default(json, "font-size", 10, int)
+    self.minsize =    util.get_default(json, "min-font-size", self.fontsize, int)
     self.spacing =    util.get_default(json, "line-spacing", 4, int)
     self.justify =    util.get_default(json, "justify", "left")
     self.x_align =    util.get_default(json, "x-align", "left")
@@ -97,85 +310,287 @@ class TextLabel:
     self.wordwrap =   util.get_default(json, "wordwrap", True, bool)
     self.rotation =   util.get_default(json, "rotation", 0, int)
     weight =          util.get_default(json, "font-weight", "regular")
+    self.rasterizer = util.get_default(json, "rasterizer", "freetype")
+
+    # Preview renders shrink all the geometry of the label.
+    # The full-size label is kept around to tell when the preview lies.
+    self.scale = scale
+    self.reference = None
+    if (scale != 1.0):
+      self.reference = TextLabel(json)
+      self.x =        util.scaled(self.x, scale)
+      self.y =        util.scaled(self.y, scale)
+      self.width =    util.scaled(self.width, scale)
+      self.height =   util.scaled(self.height, scale)
+      self.fontsize = max(1, util.scaled(self.fontsize, scale))
+      self.minsize =  max(1, util.scaled(self.minsize, scale))
+      self.spacing =  util.scaled(self.spacing, scale)
 
     self.fontweight = sysfont.STYLE_NORMAL
     if (weight == "bold"):   self.fontweight = sysfont.STYLE_BOLD
     if (weight == "italic"): self.fontweight = sysfont.STYLE_ITALIC
 
-    fallback_fonts = [ "Arial", "liberation sans", "dejavu sans" ]
+    # The font is looked up on first use, or when the template is compiled (see locate_font).
+    # Looking up any font lists every font on the system, and opening it takes a while.
+    self._fontfile = None
+    self._font_located = False
+    self._font = None
+    self._font_id = None
+
+    # Smaller versions of the font, and the size each text was fitted to
+    self.sized_fonts = {}
+    self.fitted = {}
 
-    # Try to auto-select a font based on the user's string
-    candidate_font = sysfont.get_font(self.fontface, self.fontweight)
+  def locate_font(self):
+    """ Find the font file of this label, without opening it. None if there's only the built-in font. """
+    if (self._font_located):
+      return self._fontfile
+
+    with tracing.span("find font", "template", font=self.fontface):
+      fallback_fonts = [ "Arial", "liberation sans", "dejavu sans" ]
+
+      # Try to auto-select a font based on the user's string
+      candidate_font = sysfont.get_font(self.fontface, self.fontweight)
+
+      for font_name in fallback_fonts:
+        if (candidate_font is None):
+          # Fallback to arial
+          candidate_font = sysfont.get_font(font_name, self.fontweight)
+          if (candidate_font is not  None):
+            log.warning("font-fallback", "Unable to locate font %s. Falling back to %s", self.fontface, candidate_font)
 
-    for font_name in fallback_fonts:
       if (candidate_font is None):
-        # Fallback to arial
-        candidate_font = sysfont.get_font(font_name, self.fontweight)
-        if (candidate_font is not  None):
-          log.log.write("Unable to locate font %s. Falling back to %s\n" % (self.fontface, candidate_font))
+        log.warning("font-missing", "Unable to locate font %s or any fallback. Unicode support will not be available.", self.fontface)
+
+    self._fontfile = candidate_font
+    self._font_located = True
+    return self._fontfile
+
+  def use_font(self, fontfile):
+    """ Use a given font file (None for the built-in font) instead of looking one up """
+    self._fontfile = fontfile
+    self._font_located = True
+    self._font = None
+    self._font_id = None
+    self.sized_fonts = {}
+
+  def load_font(self):
+    """ Locate and open the font of this label """
+    fontfile = self.locate_font()
+    with tracing.span("load font", "template", font=self.fontface):
+      self._font = ImageFont.load_default()
+      if (fontfile is not None):
+        self._font = ImageFont.truetype(fontfile, self.fontsize)
+
+  @property
+  def font(self):
+    if (self._font is None):
+      self.load_font()
+    return self._font
+
+  @property
+  def fontfile(self):
+    return self.locate_font()
+
+  def font_at(self, size):
+    """ The font of this label, at a given size """
+    if (size == self.fontsize or self.fontfile is None):
+      return self.font
+    if (size not in self.sized_fonts):
+      self.sized_fonts[size] = self.font.font_variant(size=size)
+    return self.sized_fonts[size]
+
+  def font_id(self):
+    """ Identifies the font file, as it is right now """
+    if (self._font_id is None):
+      st = os.stat(self.fontfile)
+      self._font_id = (self.fontfile, st.st_size, st.st_mtime_ns)
+    return self._font_id
+
+  def layout(self, maxdims, text, fontsize):
+    """ Wrap and measure the text, going through the layout cache if there is one.
+        Returns (lines, size), or (None, None) if the text can't be wrapped. """
+    key = None
+    if (layoutcache.cache is not None and self.fontfile is not None):
+      settings = (fontsize, maxdims[0], self.spacing, self.justify, self.wordwrap, self.rasterizer)
+      key = layoutcache.cache.key(self.font_id(), settings, text)
+      entry = layoutcache.cache.get(key)
+      if (entry is not None):
+        return entry
+
+    font = self.font_at(fontsize)
+    lines = self.wrap(text, maxdims[0], font)
+    if (lines is None):
+      return (None, None)
+
+    measure = measure_lines
+    if (self.rasterizer == "atlas"):
+      measure = measure_lines_atlas
+    size = measure(lines, font, justify=self.justify, spacing=self.spacing)
+    if (key is not None):
+      layoutcache.cache.put(key, lines, size)
+    return (lines, size)
+
+  def fit(self, card_dims, text):
+    """ The largest font size (down to min-font-size) at which the text fits the label.
+        Only the text metrics are used, nothing is rendered. """
+    if (self.minsize >= self.fontsize or self.fontfile is None):
+      return self.fontsize
+
+    key = (card_dims, text)
+    if (key in self.fitted):
+      return self.fitted[key]
+
+    size = self.fontsize
+    _, _, problem = self.measure(card_dims, text, self.fontsize)
+    if (problem is not None):
+      _, _, problem = self.measure(card_dims, text, self.minsize)
+      if (problem is None):
+        # Binary search for the largest size that fits. Everything below it fits, too.
+        low, high = self.minsize, self.fontsize - 1
+        while (low < high):
+          middle = (low + high + 1) // 2
+          _, _, problem = self.measure(card_dims, text, middle)
+          if (problem is None):
+            low = middle
+          else:
+            high = middle - 1
+        size = low
+
+    self.fitted[key] = size
+    return size
+
+  def max_dims(self, card_dims):
+    """ The largest label which will fit on the card """
+    # If the user has set a max width, respect that.
+    # If not, we use the edge of the card.
+    if (self.rotation == 0):
+      return util.aligned_maxdims((self.x, self.y),
+                                  (self.width, self.height),
+                                  card_dims,
+                                  self.x_align,
+                                  self.y_align)
+
+    # Due to rotation of the text, we don't fully take the card's edges into account.
+    maxdim = max(card_dims)
+    return (min(self.width, maxdim), min(self.height, maxdim))
+
+  def wrap(self, text, maxwidth, font=None):
+    """ Split the text into lines, in a way that fits our width """
+    if (font is None): font = self.font
+    lines = [text]
+    if (self.wordwrap):
+      lines = wrap_pixel_width(text, maxwidth, font, linesep='\\n')
+    return lines
+
+  def overflow(self, size, maxdims, text):
+    """ Describe how a label of the given (unrotated) size overflows its max dimensions, or None if it fits """
+    maxwidth, maxheight = maxdims
+    width, height = size
 
-    if (candidate_font is None):
-      log.log.write("Unable to locate font %s or any fallback. Unicode support will not be available.\n" % self.fontface)
+    if (width > maxwidth):
+      return "Text label overflows max width (%d > %d): \"%s\"" % (width, maxwidth, text)
 
-    self.font = ImageFont.load_default()
-    if (candidate_font is not None):
-      self.font = ImageFont.truetype(candidate_font, self.fontsize)
-      #print(candidate_font)
+    if (height > maxheight):
+      return "Text label overflows max height (%d > %d): \"%s\"" % (height, maxheight, text)
 
+    return None
+
+  def outside(self, card_dims, size, text):
+    """ Describe how a label of the given (rotated) size falls off the card, or None if it fits """
+    # Figure out where to place the top-left corner of the label
+    x,y = util.alignment_to_absolute((self.x, self.y), size, self.x_align, self.y_align)
+
+    if (x < 0 or y < 0 or
+        x + size[0] > card_dims[0] or
+        y + size[1] > card_dims[1]):
+      return "Text label overflows card boundary: \"%s\"" % text
+
+    return None
+
+  def measure(self, card_dims, text, fontsize=None):
+    """ Lay out the text without rendering it. Returns (lines, size, overflow message) """
+    if (fontsize is None): fontsize = self.fit(card_dims, text)
+    maxdims = self.max_dims(card_dims)
+
+    lines, size = self.layout(maxdims, text, fontsize)
+    if (lines is None):
+      return (None, None, "Unable to wrap text label \"%s\"" % text)
+
+    problem = self.overflow(size, maxdims, text)
+    if (problem is None):
+      problem = self.outside(card_dims, util.rotated_size(size, self.rotation), text)
+
+    return (lines, size, problem)
+
+  def fits(self, card_dims, text):
+    """ Check whether a text will render in this label """
+    with tracing.span("measure", "select", label=self.name):
+      _, _, problem = self.measure(card_dims, text)
+    return problem is None
+
+  def compare_preview(self, card_dims, text, lines, problem):
+    """ Warn if the full-size render would lay out this text differently than the preview """
+    full_dims = (util.scaled(card_dims[0], 1 / self.scale),
+                 util.scaled(card_dims[1], 1 / self.scale))
+    full_lines, _, full_problem = self.reference.measure(full_dims, text)
+
+    if ((problem is None) != (full_problem is None)):
+      verdict = "fits"
+      if (full_problem is not None): verdict = "overflows"
+      log.warning("preview-differs", "Preview differs: text %s at full size: \"%s\"", verdict, text)
+    elif (problem is None and lines != full_lines):
+      # The first line that breaks differently; a missing line reads as empty
+      for number, (line, full_line) in enumerate(itertools.zip_longest(lines, full_lines, fillvalue="")):
+        if (line != full_line): break
+      log.warning("preview-differs", "Preview differs: line %d wraps differently at full size, \"%s\" instead of \"%s\": \"%s\"",
+                  number + 1, full_line, line, text)
 
   def render(self, card_dims, text):
     """ Generate a transparent PIL card layer with the text on it """
-    # If the user has set a max width, respect that.
-    # If not, we use the edge of the card.
+    maxdims = self.max_dims(card_dims)
 
-    if (self.rotation == 0):
-      maxwidth, maxheight = util.aligned_maxdims((self.x, self.y),
-                                                 (self.width, self.height),
-                                                 card_dims,
-                                                 self.x_align,
-                                                 self.y_align)
-    else:
-      # Due to rotation of the text, we don't fully take the card's edges into account.
-      maxdim = max(card_dims)
-      maxwidth = min(self.width, maxdim)
-      maxheight = min(self.height, maxdim)
+    # Shrink the text if that's allowed and needed
+    fontsize = self.fit(card_dims, text)
+    font = self.font_at(fontsize)
 
     # Split the text into lines, in a way that fits our width
-    lines = [text]
-    if (self.wordwrap):
-      lines = wrap_pixel_width(text, maxwidth, self.font, linesep='\\n')
+    lines, _ = self.layout(maxdims, text, fontsize)
 
     if (lines is None):
-      log.log.write("Warning: Unable to wrap text label \"%s\"\n" % text)
+      log.warning("text-wrap", "Warning: Unable to wrap text label \"%s\"", text)
+      if (self.reference is not None):
+        self.compare_preview(card_dims, text, lines, "Unable to wrap text label")
       return None
 
     # Render the text, one line at a time
-    label = render_lines(lines,
-                         font=self.font,
-                         color=self.color,
-                         justify=self.justify,
-                         spacing=self.spacing)
-
-    if (label.width > maxwidth):
-      log.log.write("Warning: Text label overflows max width (%d > %d): \"%s\"\n" % (label.width, maxwidth, text))
+    rasterize = render_lines
+    if (self.rasterizer == "atlas"):
+      rasterize = render_lines_atlas
+
+    with tracing.span("raster text", label=self.name):
+      label = rasterize(lines,
+                        font=font,
+                        color=self.color,
+                        justify=self.justify,
+                        spacing=self.spacing)
+
+    problem = self.overflow(label.size, maxdims, text)
+    if (problem is None):
+      if (self.rotation != 0):
+        label = util.rotate_image(label, self.rotation)
+      problem = self.outside(card_dims, label.size, text)
+
+    if (self.reference is not None):
+      self.compare_preview(card_dims, text, lines, problem)
+
+    if (problem is not None):
+      log.warning("text-overflow", "Warning: %s", problem)
       return None
 
-    if (label.height > maxheight):
-      log.log.write("Warning: Text label overflows max height (%d > %d): \"%s\"\n" % (label.height, maxheight, text))
-      return None
-
-    if (self.rotation != 0):
-      label = util.rotate_image(label, self.rotation)
-
     # Figure out where to place the top-left corner of the label
     x,y = util.alignment_to_absolute((self.x, self.y), label.size, self.x_align, self.y_align)
 
-    if (x < 0 or y < 0 or
-        x + label.width > card_dims[0] or
-        y + label.height > card_dims[1]):
-      log.log.write("Warning: Text label overflows card boundary: \"%s\"\n" % text)
-      return None
-
     image = Image.new("RGBA", card_dims, (0,0,0,0))
     image.paste(label, (x,y), mask=label)
 
@@ -185,7 +600,7 @@ class TextLabel:
 class ImageLabel:
   """ Parsed version of a single image-label object """
 
-  def __init__(self, json):
+  def __init__(self, json, scale=1.0):
     """ Parse out the various settings of a text label and clean them up """
     self.name =       util.get_default(json, "name", "image")           # Only used in complex layout
     self.source =     util.get_default(json, "source", "images.txt")    # Only used in simple layout
@@ -198,42 +613,82 @@ class ImageLabel:
     self.y_align =    util.get_default(json, "y-align", "top")
     self.rotation =   util.get_default(json, "rotation", 0, int)
 
-  def render(self, card_dims, image):
-    """ Generate a transparent PIL card layer with the image on it """
+    # Preview renders shrink the geometry and trade quality for speed
+    self.scale = scale
+    self.resample = Image.ANTIALIAS
+    if (scale != 1.0):
+      self.x =        util.scaled(self.x, scale)
+      self.y =        util.scaled(self.y, scale)
+      self.width =    util.scaled(self.width, scale)
+      self.height =   util.scaled(self.height, scale)
+      self.resample = Image.NEAREST
+
+  def target_size(self, image):
+    """ The size the image is scaled to, or None if it's used as-is """
 
     # Since images aren't wrapped, we simply accept the user's scaling 
     # settings or (if they are 0), use the image's own dimensions.
-    # If the image falls outside the card boundaries, we warn but allow it.
-
     w, h = image.size
     aspect = w/h
 
     if (self.width == 0 and self.height == 0):
       # No scaling, use image as-is
-      pass
-    else:
-      scalew,scaleh = self.width, self.height
+      if (self.scale != 1.0):
+        return (max(1, util.scaled(w, self.scale)),
+                max(1, util.scaled(h, self.scale)))
+      return None
+
+    scalew,scaleh = self.width, self.height
+
+    if (scalew == 0):
+      # Proportional scaling to given height
+      scalew = round(scaleh * aspect)
+
+    if (scaleh == 0):
+      scaleh = round(scalew / aspect)
 
-      if (scalew == 0):
-        # Proportional scaling to given height
-        scalew = round(scaleh * aspect)
+    return (scalew, scaleh)
 
-      if (scaleh == 0):
-        scaleh = round(scalew / aspect)
+  def transform(self, image):
+    """ Scale and rotate an image according to the label settings """
+    size = self.target_size(image)
+    if (size is None and self.rotation == 0):
+      return image
 
-      image = image.resize((scalew, scaleh), Image.ANTIALIAS)
+    # Deck images carry a hash of their file, so the result can be reused
+    digest = image.info.get("digest", None)
+    key = None
+    if (digest is not None and imagecache.cache is not None):
+      key = (digest, size, self.rotation, self.resample)
+      cached = imagecache.cache.get(key)
+      if (cached is not None):
+        return cached
 
+    if (size is not None):
+      image = image.resize(size, self.resample)
 
     if (self.rotation != 0):
       image = util.rotate_image(image, self.rotation)
 
+    if (key is not None):
+      imagecache.cache.put(key, image)
+
+    return image
+
+  def render(self, card_dims, image):
+    """ Generate a transparent PIL card layer with the image on it """
+
+    # If the image falls outside the card boundaries, we warn but allow it.
+    with tracing.span("raster image", label=self.name):
+      image = self.transform(image)
+
     # Figure out where to place the top-left corner of the label
     x,y = util.alignment_to_absolute((self.x, self.y), image.size, self.x_align, self.y_align)
 
     if (x < 0 or y < 0 or
         x + image.width > card_dims[0] or
         y + image.height > card_dims[1]):
-      log.log.write("Warning: Image label overflows card boundary")
+      log.warning("image-overflow", "Warning: Image label overflows card boundary")
 
     card = Image.new("RGBA", card_dims, (0,0,0,0))
     card.paste(image, (x,y), mask=image)
@@ -242,63 +697,223 @@ class ImageLabel:
 
 
 class ContentGenerator:
-  """ Loads and caches files (text, JSON and images) from the deck directory """
+  """ Loads and caches files (text, JSON and images) from the deck directory (or zip archive) """
 
   def __init__(self, directory):
     self.directory = directory
+    self.files = deckfiles.open_deck(directory)
     self.loaded_texts = {}
     self.loaded_json = {}
     self.loaded_images = {}
 
+    # Image filename -> whether its header reads, see has_image
+    self.checked_images = {}
+
+    # Deck files which couldn't be opened, so they're only reported once
+    self.unreadable = set()
+
+    # Lines that have been read ahead of time (see peek_text_simple)
+    self.lookahead = {}
+
+    # Number of lines (or JSON cards) consumed from each source so far
+    self.consumed = {}
+
+    # Optional background image decoder, see prefetch.py
+    self.prefetcher = None
+
+    # Images may be decoded on other threads by the prefetcher
+    self.image_lock = threading.Lock()
+
+    # Bytes of decoded images, for the memory governor
+    self.images_size = 0
+
+
+  def open_text(self, filename):
+    """ Open a text file (or database query, which reads like one) in the deck directory, once """
+    if (filename not in self.loaded_texts and sqlsource.is_query(filename)):
+      self.loaded_texts[filename] = sqlsource.QuerySource(self.directory, filename)
+      self.lookahead[filename] = deque()
 
-  def gen_text_simple(self, filename):
-    """ Fetch one line from a given text file in the deck directory """
     if (filename not in self.loaded_texts):
-      path = os.path.join(self.directory, filename)
-      handle = open(path, "r", encoding="utf-8-sig")
-      if (handle is None):
-        log.log.write("Unable to open text file %s\n" % path)
+      if (filename in self.unreadable):
+        return None
+      try:
+        handle = self.files.open_text(filename)
+      except OSError as e:
+        log.error("deck-file", "Unable to open text file %s: %s", self.files.path(filename), e)
+        self.unreadable.add(filename)
         return None
       self.loaded_texts[filename] = handle
+      self.lookahead[filename] = deque()
+    return self.loaded_texts[filename]
+
+  def gen_text_simple(self, filename):
+    """ Fetch one line from a given text file in the deck directory """
+    handle = self.open_text(filename)
+    if (handle is None):
+      return None
+
+    # Lines which were peeked at are consumed first
+    buffered = self.lookahead[filename]
+    if (len(buffered) > 0):
+      line = buffered.popleft()
+    else:
+      line = handle.readline().rstrip()
+    self.consumed[filename] = self.consumed.get(filename, 0) + 1
 
-    line = self.loaded_texts[filename].readline().rstrip()
     if (line == ""):
       # End of file
       return None
     return line
 
-  def gen_text_complex(self, filename):
-    """ Fetch an entire card (named fields) from a JSON file in the deck directory """
+  def peek_text_simple(self, filename, count):
+    """ Look at the next few lines of a text file without consuming them """
+    handle = self.open_text(filename)
+    if (handle is None):
+      return []
+
+    buffered = self.lookahead[filename]
+    while (len(buffered) < count):
+      raw = handle.readline()
+      buffered.append(raw.rstrip())
+      if (raw == ""):
+        # End of file, nothing more to read ahead
+        break
+
+    lines = []
+    for line in list(buffered)[:count]:
+      if (line == ""): break
+      lines.append(line)
+    return lines
+
+  def load_json(self, filename):
+    """ Load an entire JSON file from the deck directory, once """
     if (filename not in self.loaded_json):
-      path = os.path.join(self.directory, filename)
-      handle = open(path, "r", encoding="utf-8-sig")
-      if (handle is None):
-        log.log.write("Unable to open json file %s\n" % path)
+      if (filename in self.unreadable):
         return None
+      path = self.files.path(filename)
       try:
-        self.loaded_json[filename] = json.load(handle)
+        with self.files.open_text(filename) as handle:
+          self.loaded_json[filename] = json.load(handle)
+      except OSError as e:
+        log.error("deck-file", "Unable to open json file %s: %s", path, e)
+        self.unreadable.add(filename)
+        return None
       except ValueError as e:
-        sys.stderr.write("JSON error in %s: %s\n" % (path, e))
+        log.error("deck-json", "JSON error in %s: %s", path, e)
+        self.unreadable.add(filename)
         return None
+    return self.loaded_json[filename]
+
+  def open_query(self, source):
+    """ Start a query of a deck database for complex cards, once """
+    if (source not in self.loaded_json):
+      self.loaded_json[source] = sqlsource.QuerySource(self.directory, source)
+    return self.loaded_json[source]
+
+  def gen_text_complex(self, filename):
+    """ Fetch an entire card (named fields) from a JSON file in the deck directory """
+    if (sqlsource.is_query(filename)):
+      texts = self.open_query(filename).next_card()
+      if (texts is not None):
+        self.consumed[filename] = self.consumed.get(filename, 0) + 1
+      return texts
+
+    cards = self.load_json(filename)
+    if (cards is None):
+      return None
 
-    if (len(self.loaded_json[filename]) == 0):
+    if (len(cards) == 0):
       #End of file
       return None
-    texts = self.loaded_json[filename].pop(0)
+    texts = cards.pop(0)
+    self.consumed[filename] = self.consumed.get(filename, 0) + 1
     return texts
 
-  def load_image(self, filename):
-    if (filename not in self.loaded_images):
-      path = os.path.join(self.directory, filename)
-      try:
-        image = Image.open(path)
+  def position(self, filename):
+    """ The line number (or JSON card index) of the last item fetched from a source """
+    return self.consumed.get(filename, 0) - 1
+
+  def peek_text_complex(self, filename, count):
+    """ Look at the next few cards of a JSON file without consuming them """
+    if (sqlsource.is_query(filename)):
+      return self.open_query(filename).peek_cards(count)
+
+    cards = self.load_json(filename)
+    if (cards is None):
+      return []
+    return cards[:count]
+
+  def decode_image(self, filename):
+    """ Decode an image from the deck directory into the cache. Safe to call from any thread. """
+    try:
+      with tracing.span("decode image", "load", file=filename):
+        data = self.files.read(filename)
+        image = Image.open(io.BytesIO(data))
         image.load()
-      except:
-        log.log.write("Unable to load image %s\n" % path)
-        return None
+    except:
+      return None
+
+    # Identifies the contents of the file, for the transform cache
+    image.info["digest"] = hashlib.sha256(data).hexdigest()
+
+    with self.image_lock:
+      self.images_size += image_bytes(image) - image_bytes(self.loaded_images.get(filename, None))
       self.loaded_images[filename] = image
+    return image
 
-    return self.loaded_images[filename].copy()
+  def memory_used(self):
+    return self.images_size
+
+  def evict(self, size):
+    """ Forget decoded images, oldest first, until size bytes are freed. They're decoded again when needed.
+        Returns (images, bytes) freed. """
+    count = 0
+    freed = 0
+    with self.image_lock:
+      while (freed < size and len(self.loaded_images) > 0):
+        filename = next(iter(self.loaded_images))
+        freed += image_bytes(self.loaded_images.pop(filename))
+        count += 1
+      self.images_size -= freed
+    return (count, freed)
+
+  def has_image(self, filename):
+    """ Check that an image is there and reads as an image, so cards aren't picked for images
+        they can't render. Only its header is read, decoding is left to the prefetcher. """
+    with self.image_lock:
+      if (filename in self.loaded_images):
+        return True
+      if (filename in self.checked_images):
+        return self.checked_images[filename]
+
+    try:
+      with self.files.open_binary(filename) as handle:
+        Image.open(handle)
+      found = True
+    except Exception:
+      found = False
+
+    with self.image_lock:
+      self.checked_images[filename] = found
+    return found
+
+  def load_image(self, filename):
+    with self.image_lock:
+      image = self.loaded_images.get(filename, None)
+
+    if (image is None and self.prefetcher is not None):
+      # It may already be on its way
+      image = self.prefetcher.wait(filename)
+
+    if (image is None):
+      image = self.decode_image(filename)
+
+    if (image is None):
+      log.warning("image-load", "Unable to load image %s", self.files.path(filename))
+      return None
+
+    return image.copy()
 
   def gen_image_simple(self, source):
     filename = self.gen_text_simple(source)
@@ -403,6 +1018,124 @@ class TestTextStuff(unittest.TestCase):
     img_compare.show()
 
 
+  def test_measure(self):
+    lab = TextLabel({ "font-size": 24, "width": 200 })
+    text = "Measuring a text label without rendering it gives the size of the rendered label."
+    lines, size, problem = lab.measure((400, 600), text)
+    self.assertEqual(problem, None)
+
+    label = render_lines(lines, font=lab.font, spacing=lab.spacing)
+    self.assertEqual(size, label.size)
+
+    # Exactly, with either rasterizer and any justification
+    for justify in [ "left", "center", "right" ]:
+      for render, measure in [ (render_lines, measure_lines), (render_lines_atlas, measure_lines_atlas) ]:
+        label = render(lines, font=lab.font, justify=justify, spacing=lab.spacing)
+        self.assertEqual(measure(lines, lab.font, justify=justify, spacing=lab.spacing), label.size)
+
+    _, _, problem = lab.measure((400, 60), text)
+    self.assertNotEqual(problem, None)
+
+  def test_fit(self):
+    text = "This text is much too long to fit the label at the full size of the font."
+    card = (300, 300)
+
+    lab = TextLabel({ "font-size": 40, "width": 200, "height": 100 })
+    self.assertEqual(lab.render(card, text), None)
+
+    lab = TextLabel({ "font-size": 40, "min-font-size": 8, "width": 200, "height": 100 })
+    size = lab.fit(card, text)
+    self.assertTrue(8 <= size < 40)
+    self.assertEqual(lab.measure(card, text, size)[2], None)
+    self.assertNotEqual(lab.measure(card, text, size + 1)[2], None)
+    self.assertTrue(lab.fits(card, text))
+    self.assertNotEqual(lab.render(card, text), None)
+
+    # Fitted sizes are remembered
+    self.assertEqual(lab.fitted[(card, text)], size)
+
+    # Short texts keep the full size
+    self.assertEqual(lab.fit(card, "Short"), 40)
+
+  def test_layout_cache(self):
+    layouts = layoutcache.configure()
+    lab = TextLabel({ "font-size": 20, "width": 150 })
+    text = "A text which is wrapped and measured only once."
+
+    first = lab.measure((300, 300), text)
+    self.assertEqual(lab.measure((300, 300), text), first)
+    self.assertNotEqual(lab.render((300, 300), text), None)
+    if (lab.fontfile is not None):
+      self.assertEqual((layouts.hits, layouts.misses), (2, 1))
+    layoutcache.disable()
+
+  def test_atlas(self):
+    lab = TextLabel({ "font-size": 24, "width": 300, "justify": "center" })
+    lines = lab.wrap("Glyphs drawn from the atlas look like the ones FreeType renders, AVAST ye kerning!", 300)
+
+    reference = render_lines(lines, font=lab.font, color="#336699", justify="center")
+    label = render_lines_atlas(lines, font=lab.font, color="#336699", justify="center")
+    self.assertTrue(abs(label.width - reference.width) <= 2)
+    self.assertEqual(label.height, reference.height)
+    self.assertEqual(label.getextrema()[:3], ((0, 0x33), (0, 0x66), (0, 0x99)))
+
+    # Compare the coverage, pixel by pixel
+    size = (max(label.width, reference.width), label.height)
+    a = Image.new("L", size, 0)
+    a.paste(reference.getchannel("A"), (0, 0))
+    b = Image.new("L", size, 0)
+    b.paste(label.getchannel("A"), (0, 0))
+    histogram = ImageChops.difference(a, b).histogram()
+    mean = sum([ i * n for i,n in enumerate(histogram) ]) / (size[0] * size[1])
+    self.assertTrue(mean < 16)
+
+  def test_transform_cache(self):
+    transforms = imagecache.configure()
+    lab = ImageLabel({ "x": 0, "y": 0, "width": 20, "rotation": 90 })
+    image = Image.new("RGBA", (40, 10), (255, 0, 0, 255))
+    image.info["digest"] = "abc"
+
+    first = lab.render((50, 50), image)
+    second = lab.render((50, 50), image)
+    self.assertEqual(first.tobytes(), second.tobytes())
+    self.assertEqual((transforms.hits, transforms.misses), (1, 1))
+    imagecache.disable()
+
+  def test_preview_scale(self):
+    lab = TextLabel({ "x": 40, "y": 80, "width": 200, "font-size": 32, "line-spacing": 8 }, scale=0.25)
+    self.assertEqual((lab.x, lab.y, lab.width, lab.fontsize, lab.spacing), (10, 20, 50, 8, 2))
+    self.assertEqual(lab.reference.fontsize, 32)
+
+    img = ImageLabel({ "x": 10, "y": 10 }, scale=0.5)
+    layer = img.render((50, 50), Image.new("RGBA", (40, 20), (255, 0, 0, 255)))
+    self.assertEqual(layer.getbbox(), (5, 5, 25, 15))
+
+    # Wrapping differently names the first line that differs
+    lines, _, _ = lab.reference.measure((400, 400), "one two three four")
+    output = io.StringIO()
+    log.setlog(output)
+    lab.compare_preview((100, 100), "one two three four", lines[:-1] + [ lines[-1] + "x" ], None)
+    lab.compare_preview((100, 100), "one two three four", lines[:-1], None)
+    log.setlog(sys.stderr)
+    warnings = [ line for line in output.getvalue().splitlines() if line.startswith("Preview differs") ]
+    self.assertEqual(warnings[0], "Preview differs: line %d wraps differently at full size, \"%s\" instead of \"%s\": \"one two three four\""
+                                  % (len(lines), lines[-1], lines[-1] + "x"))
+    self.assertEqual(warnings[1], "Preview differs: line %d wraps differently at full size, \"%s\" instead of \"\": \"one two three four\""
+                                  % (len(lines), lines[-1]))
+
+  def test_missing_files(self):
+    deck = tempfile.mkdtemp()
+    archive = os.path.join(deck, "deck.zip")
+    with zipfile.ZipFile(archive, "w") as handle:
+      handle.writestr("other.txt", "Hello\n")
+
+    # A missing deck file is an error, not a crash
+    for directory in [ deck, archive ]:
+      content_gen = ContentGenerator(directory)
+      self.assertEqual(content_gen.gen_text_simple("texts.txt"), None)
+      self.assertEqual(content_gen.peek_text_simple("texts.txt", 2), [])
+      self.assertEqual(content_gen.gen_text_complex("cards.json"), None)
+
   # TODO: Test text wrapping
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+import unittest
+
+import io
+import os
+import atexit
+import shutil
+import zipfile
+import posixpath
+import tempfile
+import threading
+
+import log
+
+
+def is_archive(deck):
+  """ Is the deck a zip archive rather than a directory? """
+  return deck.lower().endswith(".zip") and os.path.isfile(deck)
+
+def is_deck(deck):
+  return os.path.isdir(deck) or is_archive(deck)
+
+def deck_name(deck):
+  """ The name of a deck, without the .zip of an archive """
+  name = os.path.basename(os.path.normpath(deck))
+  if (is_archive(deck)):
+    name = os.path.splitext(name)[0]
+  return name
+
+
+class DeckDirectory:
+  """ The files of a deck in a directory """
+
+  # Files can be seeked into, see DeckIndex
+  seekable = True
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def path(self, filename):
+    return os.path.join(self.directory, filename)
+
+  def open_binary(self, filename):
+    return open(self.path(filename), "rb")
+
+  def open_text(self, filename):
+    return open(self.path(filename), "r", encoding="utf-8-sig")
+
+  def read(self, filename):
+    with open(self.path(filename), "rb") as handle:
+      return handle.read()
+
+  def exists(self, filename):
+    return os.path.isfile(self.path(filename))
+
+  def stamp(self, filename):
+    """ Identify a version of a file, cheaply """
+    try:
+      st = os.stat(self.path(filename))
+    except OSError:
+      return (filename, None, None)
+    return (filename, st.st_size, st.st_mtime_ns)
+
+  def local_path(self, filename):
+    """ A file on disk with the contents of a deck file, for libraries that need one """
+    return self.path(filename)
+
+
+class DeckArchive:
+  """ The files of a deck in a zip archive, read in place: texts are streamed, and images
+      decoded from the bytes of their member. If every file is in one folder (as when a deck
+      directory is zipped), names are relative to that folder. """
+
+  # Compressed members can only be seeked by decompressing them again
+  seekable = False
+
+  def __init__(self, path):
+    self.archive_path = path
+    self.zip = zipfile.ZipFile(path)
+    self.lock = threading.Lock()
+
+    infos = [ info for info in self.zip.infolist() if not info.is_dir() ]
+    names = [ info.filename for info in infos ]
+    roots = set([ name.split("/", 1)[0] for name in names ])
+    root = ""
+    if (len(roots) == 1 and all([ "/" in name for name in names ])):
+      root = roots.pop() + "/"
+    self.members = { name[len(root):]: info for name, info in zip(names, infos) }
+
+    # Members extracted for local_path()
+    self.scratch = None
+    self.extracted = {}
+
+  def member(self, filename):
+    name = posixpath.normpath(filename.replace("\\", "/"))
+    info = self.members.get(name, None)
+    if (info is None):
+      raise FileNotFoundError("No %s in %s" % (name, self.archive_path))
+    return info
+
+  def path(self, filename):
+    return os.path.join(self.archive_path, filename)
+
+  def open_binary(self, filename):
+    info = self.member(filename)
+    with self.lock:
+      return self.zip.open(info)
+
+  def open_text(self, filename):
+    return io.TextIOWrapper(self.open_binary(filename), encoding="utf-8-sig")
+
+  def read(self, filename):
+    with self.open_binary(filename) as handle:
+      return handle.read()
+
+  def exists(self, filename):
+    try:
+      self.member(filename)
+    except FileNotFoundError:
+      return False
+    return True
+
+  def stamp(self, filename):
+    try:
+      info = self.member(filename)
+    except FileNotFoundError:
+      return (filename, None, None)
+    return (filename, info.file_size, info.CRC)
+
+  def local_path(self, filename):
+    """ Extract a single member (such as a database, which sqlite can only open as a file) """
+    with self.lock:
+      if (filename not in self.extracted):
+        if (self.scratch is None):
+          self.scratch = tempfile.mkdtemp(prefix="cardcinogen-deck-")
+          atexit.register(shutil.rmtree, self.scratch, True)
+        path = os.path.join(self.scratch, "%d%s" % (len(self.extracted), os.path.splitext(filename)[1]))
+        try:
+          with self.zip.open(self.member(filename)) as source, open(path, "wb") as target:
+            shutil.copyfileobj(source, target)
+          log.debug("deck-file", "Extracted %s from %s", filename, self.archive_path)
+        except FileNotFoundError:
+          # Let the caller fail to open it
+          pass
+        self.extracted[filename] = path
+      return self.extracted[filename]
+
+
+# Archives are opened once and shared, by path and version
+opened = {}
+opened_lock = threading.Lock()
+
+def open_deck(deck):
+  """ The files of a deck, whether it's a directory or a zip archive """
+  if (not is_archive(deck)):
+    return DeckDirectory(deck)
+
+  st = os.stat(deck)
+  key = (os.path.abspath(deck), st.st_size, st.st_mtime_ns)
+  with opened_lock:
+    if (key not in opened):
+      opened[key] = DeckArchive(deck)
+    return opened[key]
+
+
+#
+# Unit tests
+#
+class TestDeckFiles(unittest.TestCase):
+
+  def test_archive(self):
+    path = os.path.join(tempfile.mkdtemp(), "animals.zip")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+      archive.writestr("animals/", "")
+      archive.writestr("animals/texts.txt", "\ufeffCat\nDog\n")
+      archive.writestr("animals/art/cat.png", b"not really a png")
+
+    self.assertTrue(is_deck(path))
+    self.assertEqual(deck_name(path), "animals")
+
+    files = open_deck(path)
+    self.assertIs(open_deck(path), files)
+    self.assertEqual(files.open_text("texts.txt").readline(), "Cat\n")
+    self.assertEqual(files.read("art\\cat.png"), b"not really a png")
+    self.assertTrue(files.exists("./art/cat.png"))
+    self.assertFalse(files.exists("dog.png"))
+    self.assertRaises(FileNotFoundError, files.read, "dog.png")
+    self.assertEqual(files.stamp("texts.txt")[1], 11)
+
+    with open(files.local_path("texts.txt"), "rb") as handle:
+      self.assertEqual(handle.read(), "\ufeffCat\nDog\n".encode("utf-8"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,342 @@
+import unittest
+
+import os
+import sqlite3
+import zipfile
+import tempfile
+from collections import deque
+
+from PIL import Image
+
+import log
+import deckfiles
+import sqlsource
+import tracing
+from content import ContentGenerator
+from card import CardTemplate
+
+
+def line_offsets(path):
+  """ Byte offset of the start of each line in a text file """
+  offsets = []
+  position = 0
+  with open(path, "rb") as handle:
+    for line in handle:
+      offsets.append(position)
+      position += len(line)
+  return offsets
+
+def parse_card_ranges(spec):
+  """ Parse a list of card numbers like "3,10-12" into a sorted list of (1-based) card numbers """
+  numbers = set()
+  for part in spec.split(","):
+    part = part.strip()
+    if (part == ""): continue
+
+    if ("-" in part):
+      first, last = part.split("-", 1)
+      first, last = int(first), int(last)
+    else:
+      first = last = int(part)
+
+    if (first < 1 or last < first):
+      raise ValueError("Invalid card range: %s" % part)
+
+    numbers.update(range(first, last + 1))
+
+  return sorted(numbers)
+
+
+def pack_served(served):
+  """ Content as served to a card, in a form JSON can hold: [ [ source, line or card number, value ] ] """
+  return [ [ k[0], k[1], v ] for k,v in served.items() ]
+
+def unpack_served(packed):
+  return { (source, number): value for source, number, value in packed }
+
+
+class DeckIndex:
+  """ Maps every card of a deck to the content that goes on it, so single cards can be rendered on their own """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.files = deckfiles.open_deck(directory)
+
+    # Text file -> byte offset of each line
+    self.offsets = {}
+
+    # Database query (or text file in a zip archive) -> all its rows, as text lines
+    self.lines = {}
+
+    # One entry per card, as picked by CardTemplate.select_card
+    self.cards = []
+
+    # Every deck file (text or JSON) the cards draw their content from
+    self.sources = []
+
+    # JSON deck file (or database query) -> list of cards, loaded when needed
+    self.json = {}
+
+  def build(self, template):
+    """ Walk through the whole deck once, picking content for each card without rendering any """
+    content_gen = ContentGenerator(self.directory)
+
+    while (True):
+      card = template.select_card(content_gen)
+      if (card is None): break
+      self.cards.append(card)
+
+    for filename in content_gen.loaded_texts:
+      if (sqlsource.is_query(filename)):
+        # Query results can't be seeked into, so keep them around
+        with sqlsource.QuerySource(self.directory, filename) as source:
+          self.lines[filename] = source.lines()
+      elif (not self.files.seekable):
+        # Neither can compressed archive members, cheaply
+        with self.files.open_text(filename) as handle:
+          self.lines[filename] = [ line.rstrip() for line in handle ]
+      else:
+        self.offsets[filename] = line_offsets(os.path.join(self.directory, filename))
+
+    for filename in content_gen.loaded_json:
+      if (sqlsource.is_query(filename)):
+        with sqlsource.QuerySource(self.directory, filename) as source:
+          self.json[filename] = source.cards()
+
+    self.sources = sorted(list(content_gen.loaded_texts) + list(content_gen.loaded_json))
+
+    return len(self.cards)
+
+  def read_line(self, filename, number):
+    """ Seek straight to a single line of a text file """
+    if (filename in self.lines):
+      return self.lines[filename][number]
+
+    offsets = self.offsets[filename]
+    path = os.path.join(self.directory, filename)
+
+    with open(path, "rb") as handle:
+      handle.seek(offsets[number])
+      raw = handle.readline()
+
+    # Only the first line can carry a byte order mark
+    encoding = "utf-8"
+    if (number == 0): encoding = "utf-8-sig"
+    return raw.decode(encoding).rstrip()
+
+  def read_json(self, filename, number):
+    """ A single card from a JSON deck file """
+    if (filename not in self.json):
+      # Cards are consumed as the deck is indexed, so read the file again
+      self.json[filename] = ContentGenerator(self.directory).load_json(filename)
+    return self.json[filename][number]
+
+  def content(self, card):
+    """ The content of an indexed card, by (source, line or card number), like RecordingGenerator.take() """
+    if ("card" in card):
+      return { (card["source"], card["card"]): self.read_json(card["source"], card["card"]) }
+
+    served = {}
+    for entry in card["images"] + card["texts"]:
+      if ("source" in entry):
+        served[(entry["source"], entry["line"])] = self.read_line(entry["source"], entry["line"])
+    return served
+
+  def render(self, template, number, content_gen):
+    """ Render a single card (0-based), using a ReplayGenerator for content """
+    card = self.cards[number]
+    with tracing.span("card", card=number + 1):
+      content_gen.queue(card)
+      face = template.render_card(card["layout"], content_gen)
+      content_gen.clear()
+
+    if (face is None):
+      log.warning("index-mismatch", "Warning: Card %d did not render like it was indexed.", number + 1)
+    return face
+
+
+class ReplayGenerator(ContentGenerator):
+  """ Serves exactly the content an index assigned to a card, in place of reading through the deck """
+
+  def __init__(self, index):
+    super().__init__(index.directory)
+    self.index = index
+    self.queued_texts = {}
+    self.queued_json = {}
+
+  def queue(self, card, served=None):
+    """ Line up the contents of a single indexed card. If the content served for it
+        was recorded by a RecordingGenerator, that is used instead of the index. """
+    if (served is None):
+      read_line = self.index.read_line
+      read_json = self.index.read_json
+    else:
+      read_line = read_json = lambda source, number: served[(source, number)]
+
+    if ("card" in card):
+      # Complex layout, a whole card from a JSON file
+      content = read_json(card["source"], card["card"])
+      self.queued_json.setdefault(card["source"], deque()).append(content)
+      return
+
+    # Layouts pull image filenames before texts, in label order.
+    # Only the order within each file matters, though.
+    for entry in card["images"] + card["texts"]:
+      if ("source" not in entry): continue
+      line = read_line(entry["source"], entry["line"])
+      self.queued_texts.setdefault(entry["source"], deque()).append(line)
+
+  def clear(self):
+    self.queued_texts = {}
+    self.queued_json = {}
+
+  def gen_text_simple(self, filename):
+    queued = self.queued_texts.get(filename, None)
+    if (not queued):
+      return None
+    return queued.popleft()
+
+  def peek_text_simple(self, filename, count):
+    return list(self.queued_texts.get(filename, []))[:count]
+
+  def gen_text_complex(self, filename):
+    queued = self.queued_json.get(filename, None)
+    if (not queued):
+      return None
+    return queued.popleft()
+
+  def peek_text_complex(self, filename, count):
+    return list(self.queued_json.get(filename, []))[:count]
+
+
+class RecordingGenerator(ContentGenerator):
+  """ Reads through the deck like a ContentGenerator, and remembers what it served,
+      so the cards it selects can be rendered later (or elsewhere) by a ReplayGenerator """
+
+  def __init__(self, directory):
+    super().__init__(directory)
+
+    # (source, line or card number) -> content
+    self.served = {}
+
+    # Image filename -> whether it read as an image when a card was selected
+    self.images = {}
+
+  def has_image(self, filename):
+    found = super().has_image(filename)
+    self.images[filename] = found
+    return found
+
+  def gen_text_simple(self, filename):
+    line = super().gen_text_simple(filename)
+    if (line is not None):
+      self.served[(filename, self.position(filename))] = line
+    return line
+
+  def gen_text_complex(self, filename):
+    texts = super().gen_text_complex(filename)
+    if (texts is not None):
+      self.served[(filename, self.position(filename))] = texts
+    return texts
+
+  def take(self):
+    """ Everything served since the last call """
+    served = self.served
+    self.served = {}
+    return served
+
+
+#
+# Unit tests
+#
+class TestDeckIndex(unittest.TestCase):
+
+  def make_deck(self, count):
+    deck = tempfile.mkdtemp()
+    with open(os.path.join(deck, "images.txt"), "w", encoding="utf-8") as handle:
+      handle.write("\ufeff")
+      for i in range(count):
+        name = "img%d.png" % i
+        Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, name))
+        handle.write(name + "\n")
+    return deck
+
+  def test_ranges(self):
+    self.assertEqual(parse_card_ranges("3"), [3])
+    self.assertEqual(parse_card_ranges("1400-1403"), [1400, 1401, 1402, 1403])
+    self.assertEqual(parse_card_ranges("5,1-2,2"), [1, 2, 5])
+    self.assertRaises(ValueError, parse_card_ranges, "0-3")
+    self.assertRaises(ValueError, parse_card_ranges, "4-2")
+
+  def test_index(self):
+    deck = self.make_deck(12)
+    tmpl = CardTemplate({ "layouts": [ { "images": [ { "source": "images.txt", "x": 0, "y": 0 } ] } ] }, deck)
+
+    index = DeckIndex(deck)
+    self.assertEqual(index.build(tmpl), 12)
+    self.assertEqual(len(index.offsets["images.txt"]), 12)
+    self.assertEqual(index.read_line("images.txt", 0), "img0.png")
+    self.assertEqual(index.read_line("images.txt", 11), "img11.png")
+
+    # Single cards render just like they do in the full deck
+    replay = ReplayGenerator(index)
+    full = ContentGenerator(deck)
+    faces = [ tmpl.make_card(full) for i in range(12) ]
+    for number in [ 11, 3, 7 ]:
+      face = index.render(tmpl, number, replay)
+      self.assertEqual(face.tobytes(), faces[number].tobytes())
+
+  def test_query(self):
+    deck = self.make_deck(6)
+    db = sqlite3.connect(os.path.join(deck, "deck.sqlite"))
+    db.execute("CREATE TABLE cards (id INTEGER PRIMARY KEY, title TEXT, picture TEXT)")
+    for i in range(6):
+      db.execute("INSERT INTO cards (title, picture) VALUES (?, ?)", ("Card %d" % i, "img%d.png" % i))
+    db.commit()
+    db.close()
+
+    # The same cards, from a text file and from the database
+    simple = CardTemplate({ "layouts": [ { "images": [ { "source": "deck.sqlite#SELECT picture FROM cards WHERE id > 2" } ] } ] }, deck)
+    complex = CardTemplate({ "layouts": [ { "type": "complex", "source": "deck.sqlite#cards",
+                                            "texts": [ { "name": "title", "y": 20 } ],
+                                            "images": [ { "name": "picture" } ] } ] }, deck)
+
+    for tmpl, count in [ (simple, 4), (complex, 6) ]:
+      index = DeckIndex(deck)
+      self.assertEqual(index.build(tmpl), count)
+
+      replay = ReplayGenerator(index)
+      full = ContentGenerator(deck)
+      faces = [ tmpl.make_card(full) for i in range(count) ]
+      self.assertEqual(tmpl.make_card(full), None)
+      face = index.render(tmpl, count - 1, replay)
+      self.assertEqual(face.tobytes(), faces[-1].tobytes())
+
+  def test_archive(self):
+    deck = self.make_deck(6)
+    db = sqlite3.connect(os.path.join(deck, "deck.sqlite"))
+    db.execute("CREATE TABLE cards (picture TEXT)")
+    db.executemany("INSERT INTO cards VALUES (?)", [ ("img%d.png" % i,) for i in range(6) ])
+    db.commit()
+    db.close()
+
+    archive = os.path.join(tempfile.mkdtemp(), "deck.zip")
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as handle:
+      for name in os.listdir(deck):
+        handle.write(os.path.join(deck, name), "deck/" + name)
+
+    # Cards from a zipped deck are the same as from the directory
+    for source in [ "images.txt", "deck.sqlite#cards" ]:
+      tmpl = CardTemplate({ "layouts": [ { "images": [ { "source": source } ] } ] }, deck)
+      full = ContentGenerator(deck)
+      faces = [ tmpl.make_card(full) for i in range(6) ]
+      zipped = ContentGenerator(archive)
+      self.assertEqual([ tmpl.make_card(zipped).tobytes() for i in range(6) ], [ f.tobytes() for f in faces ])
+
+      index = DeckIndex(archive)
+      self.assertEqual(index.build(tmpl), 6)
+      self.assertEqual(index.render(tmpl, 4, ReplayGenerator(index)).tobytes(), faces[4].tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,567 @@
+import unittest
+
+import io
+import os
+import json
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+from collections import deque
+
+from PIL import Image
+
+import log
+import tracing
+from card import CardTemplate
+from compiler import compile_template
+from deckindex import DeckIndex, RecordingGenerator, ReplayGenerator, pack_served, unpack_served
+from pipeline import card_images, select_cards
+
+
+# Bump this whenever the messages change
+PROTOCOL_VERSION = 2
+
+# Largest message header we'll accept, to fail fast on garbage
+MAX_HEADER = 64 << 20
+
+def parse_address(text, default_host="localhost"):
+  """ HOST:PORT, or just PORT on this machine only """
+  host, _, port = text.rpartition(":")
+  if (not port.isdigit()):
+    raise ValueError("Expected HOST:PORT, got \"%s\"" % text)
+  return (host or default_host, int(port))
+
+def send_message(sock, header, blobs=()):
+  """ A JSON header, followed by binary blobs whose sizes are listed in it """
+  header = dict(header, sizes=[ len(blob) for blob in blobs ])
+  data = json.dumps(header).encode("utf-8")
+  sock.sendall(struct.pack(">I", len(data)) + data)
+  for blob in blobs:
+    sock.sendall(blob)
+
+def recv_exactly(sock, count):
+  data = bytearray(count)
+  view = memoryview(data)
+  received = 0
+  while (received < count):
+    n = sock.recv_into(view[received:], count - received)
+    if (n == 0):
+      raise ConnectionError("Connection closed")
+    received += n
+  return bytes(data)
+
+def recv_message(sock):
+  """ Returns (header, blobs) """
+  size, = struct.unpack(">I", recv_exactly(sock, 4))
+  if (size > MAX_HEADER):
+    raise ConnectionError("Message header too large (%d bytes)" % size)
+  header = json.loads(recv_exactly(sock, size).decode("utf-8"))
+  blobs = [ recv_exactly(sock, n) for n in header.get("sizes", []) ]
+  return (header, blobs)
+
+def safe_name(filename):
+  """ A deck filename, which must stay inside the directory it's written to """
+  name = os.path.normpath(filename)
+  if (os.path.isabs(name) or name == ".." or name.startswith(".." + os.sep)):
+    raise ValueError("Refusing deck file outside the deck: %s" % filename)
+  return name
+
+
+#
+# Templates are sent to the workers as JSON, with the images and font files they use,
+# since the workers may not have the same fonts (or any fonts) installed.
+# The workers compile it themselves: nothing they receive is run as code.
+#
+
+def pack_template(spec, template):
+  """ The header and blobs of a template message: the JSON template with its images
+      renamed, the images it uses, and the font file of each text label """
+  spec = json.loads(json.dumps(spec))
+  images = []
+  def attach(owner, key, path):
+    name = "%d%s" % (len(images), os.path.splitext(path)[1])
+    owner[key] = name
+    images.append((name, path))
+
+  attach(spec, "front-image", template.front_path)
+  attach(spec, "hidden-image", template.hidden_path)
+  for layout_spec, layout in zip(spec.get("layouts", []), template.layouts):
+    if (layout.front_path is not None):
+      attach(layout_spec, "front-image", layout.front_path)
+
+  names = []
+  blobs = []
+  for name, path in images:
+    try:
+      with open(path, "rb") as handle:
+        blobs.append(handle.read())
+      names.append(name)
+    except OSError:
+      # The worker falls back to a plain image, just like we did
+      pass
+
+  # Labels using the built-in font (None) use it on the workers, too
+  labels = [ label.fontfile for layout in template.layouts for label in layout.text_labels() ]
+  fonts = sorted(set([ f for f in labels if f is not None ]))
+  for path in fonts:
+    with open(path, "rb") as handle:
+      blobs.append(handle.read())
+
+  header = { "type": "template", "spec": spec, "scale": template.scale,
+             "images": names, "fonts": fonts, "labels": labels }
+  return (header, blobs)
+
+def unpack_template(header, blobs, directory):
+  """ Save the images and fonts that came with a template, then compile it """
+  images = os.path.join(directory, "template")
+  fonts = os.path.join(directory, "fonts")
+  os.makedirs(images, exist_ok=True)
+  os.makedirs(fonts, exist_ok=True)
+
+  names = header["images"]
+  for name, contents in zip(names, blobs):
+    with open(os.path.join(images, safe_name(name)), "wb") as handle:
+      handle.write(contents)
+
+  local = {}
+  for i,(path, contents) in enumerate(zip(header["fonts"], blobs[len(names):])):
+    local[path] = os.path.join(fonts, "%d%s" % (i, os.path.splitext(path)[1]))
+    with open(local[path], "wb") as handle:
+      handle.write(contents)
+
+  labels = [ None if path is None else local[path] for path in header["labels"] ]
+  template = compile_template(header["spec"], images, scale=header["scale"], fonts=labels)
+  if (template is None):
+    raise ConnectionError("The template from the coordinator doesn't compile")
+  return template
+
+
+class Batch:
+  """ A few selected cards, as handed to a worker """
+
+  def __init__(self, number, items):
+    self.number = number
+    self.items = items          # (position in the deck, card number or None, card, served content)
+    self.workers = set()        # Workers currently rendering it
+    self.done = False
+
+
+class Coordinator:
+  """ Hands out batches of selected cards, with their content, to render workers over TCP,
+      and collects the rendered faces in deck order.
+      Workers ask for work when they're done with their last batch, so faster ones simply get more.
+      Batches of workers that disconnect (or time out) go to the next worker that asks, and once
+      every batch is out, idle workers get a copy of the oldest unfinished one as well. """
+
+  def __init__(self, address, batch_size=16, timeout=300, max_ahead=None):
+    self.server = socket.create_server(address)
+    self.address = self.server.getsockname()
+    self.batch_size = batch_size
+    self.timeout = timeout
+
+    # How far past the next card in deck order the workers may get
+    self.max_ahead = max_ahead or 8 * batch_size
+
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock)
+    self.select_lock = threading.Lock()
+
+    self.cards = None           # Cards to select from, once results() is called
+    self.batches = {}           # Batches not yet done
+    self.batch_count = 0
+    self.retry = deque()        # Batches to hand out again
+    self.results_ready = {}     # Position in the deck -> (card number, face)
+    self.delivered = 0          # Faces passed on so far, in order
+    self.selected = 0           # Cards selected so far
+    self.exhausted = False      # All cards selected
+    self.closed = False         # Done, cancelled or failed: workers get no more batches
+    self.error = None
+
+    self.workers = 0
+    self.retried = 0
+    self.duplicated = 0
+
+  def next_batch(self, worker):
+    """ The next batch for a worker, or None if there's nothing left to do """
+    while (True):
+      with self.lock:
+        if (self.closed):
+          return None
+
+        while (len(self.retry) > 0):
+          batch = self.batches.get(self.retry.popleft(), None)
+          if (batch is not None and not batch.done):
+            batch.workers.add(worker)
+            return batch
+
+        if (self.exhausted and len(self.batches) == 0):
+          return None
+        select = (self.cards is not None and not self.exhausted and self.selected - self.delivered < self.max_ahead)
+
+      if (select):
+        batch = self.select_batch(worker)
+        if (batch is not None):
+          return batch
+        continue
+
+      with self.lock:
+        # Nothing new to do, so help with the oldest batch that's still out
+        for number in sorted(self.batches):
+          batch = self.batches[number]
+          if (worker not in batch.workers and len(batch.workers) < 2):
+            batch.workers.add(worker)
+            self.duplicated += 1
+            return batch
+        self.changed.wait(0.5)
+
+  def select_batch(self, worker):
+    """ Pick the contents of the next few cards. Selection reads through the deck, so it runs one batch at a time. """
+    with self.select_lock:
+      items = []
+      try:
+        while (len(items) < self.batch_size):
+          item = next(self.cards, None)
+          if (item is None):
+            break
+          number, card, served = item
+          if (served is None):
+            served = self.index.content(card)
+          items.append((number, card, served))
+      except Exception as e:
+        with self.lock:
+          self.error = e
+          self.exhausted = True
+          self.changed.notify_all()
+        return None
+
+      with self.lock:
+        batch = None
+        if (len(items) > 0):
+          batch = Batch(self.batch_count, [ (self.selected + i,) + item for i,item in enumerate(items) ])
+          batch.workers.add(worker)
+          self.batch_count += 1
+          self.batches[batch.number] = batch
+          self.selected += len(items)
+        else:
+          self.exhausted = True
+        self.changed.notify_all()
+        return batch
+
+  def complete(self, batch, faces):
+    with self.lock:
+      if (batch.done):
+        # Another worker got there first
+        return
+      batch.done = True
+      del self.batches[batch.number]
+      for item, face in zip(batch.items, faces):
+        self.results_ready[item[0]] = (item[1], face)
+      self.changed.notify_all()
+
+  def lost(self, worker, batch, reason):
+    with self.lock:
+      batch.workers.discard(worker)
+      if (not batch.done and len(batch.workers) == 0):
+        log.warning("worker-lost", "Lost worker %s (%s), handing its cards out again.", worker, reason)
+        self.retry.appendleft(batch.number)
+        self.retried += 1
+        self.changed.notify_all()
+
+  def serve(self, conn, worker):
+    """ Talk to one worker until the work is done or the worker goes away """
+    batch = None
+    sent_images = set()
+    try:
+      conn.settimeout(self.timeout)
+      header, _ = recv_message(conn)
+      if (header.get("type") != "hello" or header.get("version") != PROTOCOL_VERSION):
+        raise ConnectionError("not a render worker of this version")
+
+      send_message(conn, *self.template_message)
+
+      while (True):
+        batch = self.next_batch(worker)
+        if (batch is None):
+          send_message(conn, { "type": "done" })
+          return
+
+        # Deck images go along the first time a worker needs them
+        names = []
+        blobs = []
+        for _, _, card, served in batch.items:
+          for filename in card_images(self.template, card, served):
+            if (filename in sent_images): continue
+            sent_images.add(filename)
+            try:
+              blobs.append(self.index.files.read(filename))
+              names.append(filename)
+            except OSError:
+              # The worker will fail to render this card, just like we would
+              pass
+
+        cards = [ [ number, card, pack_served(served) ] for _, number, card, served in batch.items ]
+        send_message(conn, { "type": "batch", "batch": batch.number, "cards": cards, "images": names }, blobs)
+
+        header, blobs = recv_message(conn)
+        if (header.get("type") != "faces" or header.get("batch") != batch.number or len(blobs) != len(batch.items)):
+          raise ConnectionError("unexpected reply")
+
+        faces = []
+        for blob in blobs:
+          face = None
+          if (len(blob) > 0):
+            face = Image.open(io.BytesIO(blob))
+            face.load()
+          faces.append(face)
+        self.complete(batch, faces)
+        batch = None
+
+    except (OSError, ValueError) as e:
+      if (batch is not None):
+        self.lost(worker, batch, e)
+      else:
+        log.debug("worker", "Worker %s disconnected: %s", worker, e)
+    finally:
+      conn.close()
+
+  def accept(self):
+    while (True):
+      try:
+        conn, peer = self.server.accept()
+      except OSError:
+        # Closed
+        return
+      with self.lock:
+        self.workers += 1
+        worker = "%s:%d#%d" % (peer[0], peer[1], self.workers)
+      log.info("worker", "Worker %s connected.", worker)
+      threading.Thread(target=self.serve, args=(conn, worker), name="worker " + worker, daemon=True).start()
+
+  def start(self, spec, template, index):
+    """ Start taking workers. The template (spec is its JSON) is sent to each of them,
+        deck files are read from the index's directory. """
+    self.template = template
+    self.index = index
+    self.template_message = pack_template(spec, template)
+
+    threading.Thread(target=self.accept, name="coordinator", daemon=True).start()
+    log.info("worker", "Waiting for workers on %s:%d", self.address[0], self.address[1])
+
+  def results(self, cards, cancel=None):
+    """ Render the cards (as yielded by select_cards, or numbered with served=None from a DeckIndex) on the workers.
+        Yields (card number, face) in deck order. The number is None where it was None in cards,
+        the face is None if the card didn't render. """
+    with self.lock:
+      # Workers which connected early are waiting for these
+      self.cards = iter(cards)
+      self.changed.notify_all()
+    try:
+      while (True):
+        with self.lock:
+          while (self.delivered not in self.results_ready):
+            if (self.error is not None):
+              raise self.error
+            if (self.exhausted and self.delivered >= self.selected):
+              return
+            if (cancel is not None and cancel.is_set()):
+              return
+            if (self.closed):
+              return
+            self.changed.wait(0.5)
+          number, face = self.results_ready.pop(self.delivered)
+          self.delivered += 1
+          self.changed.notify_all()
+        yield (number, face)
+    finally:
+      self.close()
+
+  def close(self):
+    """ Stop taking workers, and send the connected ones home once they're done with their batch """
+    with self.lock:
+      if (self.closed):
+        return
+      self.closed = True
+      self.changed.notify_all()
+
+    self.server.close()
+    if (self.retried + self.duplicated > 0):
+      log.info("worker", "%d batches handed out again after losing a worker, %d copied to idle workers.",
+               self.retried, self.duplicated)
+
+
+def run_worker(address, connect_timeout=30):
+  """ Render batches for a coordinator until it's done. Returns the number of cards rendered. """
+  deadline = time.time() + connect_timeout
+  while (True):
+    try:
+      conn = socket.create_connection(address)
+      break
+    except OSError:
+      if (time.time() > deadline):
+        raise
+      time.sleep(0.5)
+
+  scratch = tempfile.mkdtemp(prefix="cardcinogen-worker-")
+  rendered = 0
+  try:
+    send_message(conn, { "type": "hello", "version": PROTOCOL_VERSION })
+
+    template = None
+    content_gen = ReplayGenerator(DeckIndex(scratch))
+    while (True):
+      header, blobs = recv_message(conn)
+      kind = header.get("type")
+
+      if (kind == "done"):
+        break
+
+      if (kind == "template"):
+        template = unpack_template(header, blobs, scratch)
+        continue
+
+      if (kind != "batch" or template is None):
+        raise ConnectionError("Unexpected message from the coordinator: %s" % kind)
+
+      for filename, data in zip(header["images"], blobs):
+        path = os.path.join(scratch, safe_name(filename))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as handle:
+          handle.write(data)
+
+      faces = []
+      for number, card, served in header["cards"]:
+        with tracing.span("card", card=number, batch=header["batch"]):
+          content_gen.queue(card, unpack_served(served))
+          face = template.render_card(card["layout"], content_gen)
+          content_gen.clear()
+
+        blob = b""
+        if (face is not None):
+          # Fast to encode, and lossless
+          buffer = io.BytesIO()
+          face.save(buffer, "png", compress_level=1)
+          blob = buffer.getvalue()
+          rendered += 1
+        faces.append(blob)
+
+      send_message(conn, { "type": "faces", "batch": header["batch"] }, faces)
+
+  finally:
+    conn.close()
+    shutil.rmtree(scratch, ignore_errors=True)
+
+  return rendered
+
+
+#
+# Unit tests
+#
+class TestDistributed(unittest.TestCase):
+
+  def make_deck(self, count):
+    deck = tempfile.mkdtemp()
+    with open(os.path.join(deck, "images.txt"), "w", encoding="utf-8") as images, \
+         open(os.path.join(deck, "texts.txt"), "w", encoding="utf-8") as texts:
+      for i in range(count):
+        name = "img%d.png" % i
+        Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, name))
+        images.write(name + "\n")
+        texts.write("Card number %d\n" % i)
+    return deck
+
+  def test_address(self):
+    self.assertEqual(parse_address("localhost:7000"), ("localhost", 7000))
+    self.assertEqual(parse_address("7000"), ("localhost", 7000))
+    self.assertEqual(parse_address("0.0.0.0:7000"), ("0.0.0.0", 7000))
+    self.assertRaises(ValueError, parse_address, "localhost")
+    self.assertRaises(ValueError, safe_name, "../secret.png")
+    self.assertEqual(safe_name("art/cat.png"), os.path.join("art", "cat.png"))
+
+  def test_template(self):
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, "template"))
+    Image.new("RGBA", (60, 80), (0, 0, 255, 255)).save(os.path.join(root, "front.png"))
+    spec = { "front-image": "../front.png",
+             "layouts": [ { "texts": [ { "source": "texts.txt", "y": 20 } ] } ] }
+    tmpl = CardTemplate(spec, os.path.join(root, "template"), scale=0.5)
+
+    # Sent as plain JSON and files, and compiled again on the worker with the same font
+    header, blobs = pack_template(spec, tmpl)
+    self.assertEqual(json.loads(json.dumps(header)), header)
+    worker = unpack_template(header, blobs, tempfile.mkdtemp())
+    self.assertEqual(worker.front.tobytes(), tmpl.front.tobytes())
+    label = worker.layouts[0].textlabels[0]
+    if (tmpl.layouts[0].textlabels[0].fontfile is not None):
+      self.assertNotEqual(label.fontfile, tmpl.layouts[0].textlabels[0].fontfile)
+      with open(label.fontfile, "rb") as copy, open(tmpl.layouts[0].textlabels[0].fontfile, "rb") as original:
+        self.assertEqual(copy.read(), original.read())
+    self.assertEqual(label.render(worker.front.size, "Hello").tobytes(),
+                     tmpl.layouts[0].textlabels[0].render(tmpl.front.size, "Hello").tobytes())
+
+  def test_workers(self):
+    deck = self.make_deck(40)
+    spec = { "layouts": [ { "images": [ { "source": "images.txt", "x": 0, "y": 0 } ],
+                            "texts": [ { "source": "texts.txt", "y": 50 } ] } ] }
+    tmpl = CardTemplate(spec, deck)
+
+    content_gen = RecordingGenerator(deck)
+    expected = []
+    while (True):
+      face = tmpl.make_card(content_gen)
+      if (face is None): break
+      expected.append(face)
+
+    coordinator = Coordinator(("127.0.0.1", 0), batch_size=3)
+
+    # A worker which takes a batch and then dies
+    def flaky():
+      conn = socket.create_connection(coordinator.address)
+      send_message(conn, { "type": "hello", "version": PROTOCOL_VERSION })
+      recv_message(conn)
+      recv_message(conn)
+      conn.close()
+      while (coordinator.retried == 0):
+        time.sleep(0.01)
+
+    def workers():
+      flaky()
+      threads = [ threading.Thread(target=run_worker, args=(coordinator.address,)) for i in range(3) ]
+      for thread in threads: thread.start()
+      for thread in threads: thread.join()
+
+    helper = threading.Thread(target=workers)
+    helper.start()
+    content_gen = RecordingGenerator(deck)
+    coordinator.start(spec, tmpl, content_gen)
+    faces = list(coordinator.results(select_cards(tmpl, content_gen)))
+    helper.join()
+
+    self.assertEqual(len(faces), len(expected))
+    self.assertTrue(coordinator.retried >= 1)
+    for (number, face), local in zip(faces, expected):
+      self.assertEqual(number, None)
+      self.assertEqual(face.tobytes(), local.tobytes())
+
+  def test_close(self):
+    deck = self.make_deck(1)
+    spec = { "layouts": [ { "images": [ { "source": "images.txt" } ] } ] }
+    coordinator = Coordinator(("127.0.0.1", 0))
+    coordinator.start(spec, CardTemplate(spec, deck), RecordingGenerator(deck))
+
+    # A worker waiting for cards is sent home when the run is called off
+    rendered = []
+    worker = threading.Thread(target=lambda: rendered.append(run_worker(coordinator.address)))
+    worker.start()
+    while (coordinator.workers == 0):
+      time.sleep(0.01)
+    coordinator.close()
+    worker.join(10)
+    self.assertFalse(worker.is_alive())
+    self.assertEqual(rendered, [ 0 ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,61 @@
+
 from tkinter import *
 from tkinter.filedialog import *
+from tkinter.ttk import Progressbar
 
 import os
+import time
+import queue
+import threading
 
 import log
+import util
 
 class CardGui:
   """ A simple GUI for users who don't use the command line options """
 
+  # How often (ms) the log and progress are brought up to date
+  refresh_interval = 100
+
   def invoke(self):
+    # Generation runs on a worker thread, so the window stays responsive
+    if (self.worker is not None and self.worker.is_alive()):
+      return
+
+    self.cancel = threading.Event()
+    self.cards_done = 0
+    self.started = time.time()
+
+    self.btnGenerate.config(state=DISABLED)
+    self.btnCancel.config(state=NORMAL)
+    self.progress.start()
+
+    self.worker = threading.Thread(target=self.work,
+                                   args=(self.template.get(), self.deck.get(), self.prefix.get()),
+                                   daemon=True)
+    self.worker.start()
+
+  def work(self, template_path, deck, prefix):
     try:
-      template = open(self.template.get(), 'r')
-      self.generator(template=template,
-                     deck=self.deck.get(),
-                     output_prefix=self.prefix.get())
+      with open(template_path, 'r', encoding="utf-8-sig") as template:
+        self.generator(template=template,
+                       deck=deck,
+                       output_prefix=prefix,
+                       cache_dir=util.default_cache_dir(),
+                       progress=self.setProgress,
+                       cancel=self.cancel)
     except Exception as e:
-      log.log.write("Error: %s\n" % e)
+      log.error("gui", "Error: %s", e)
+
+  def setProgress(self, cards):
+    # Called from the worker thread. Picked up by refresh() on the next tick.
+    self.cards_done = cards
+
+  def stop(self):
+    # Button was pressed. The generator stops after the card it's working on.
+    if (self.cancel is not None):
+      self.cancel.set()
+      self.btnCancel.config(state=DISABLED)
 
   def setTemplate(self):
     # Button was pressed. Select a JSON file.
@@ -48,14 +88,45 @@ class CardGui:
     pass
 
   def write(self, string):
-    # Write something to the log window
-    self.log.config(state=NORMAL)
-    self.log.insert(END, string)
-    self.log.config(state=DISABLED)
+    # Queue something for the log window. This may be called from any thread,
+    # the text is inserted on the Tk thread by refresh().
+    self.messages.put(string)
+
+  def refresh(self):
+    # Insert all queued log messages in one go
+    lines = []
+    try:
+      while (True):
+        lines.append(self.messages.get_nowait())
+    except queue.Empty:
+      pass
+
+    if (len(lines) > 0):
+      self.log.config(state=NORMAL)
+      self.log.insert(END, "".join(lines))
+      self.log.see(END)
+      self.log.config(state=DISABLED)
+
+    if (self.worker is not None):
+      elapsed = max(time.time() - self.started, 0.001)
+      self.status.set("%d cards, %.1f cards/sec" % (self.cards_done, self.cards_done / elapsed))
+
+      if (not self.worker.is_alive()):
+        # Generation finished (or was cancelled)
+        self.worker = None
+        self.progress.stop()
+        self.btnGenerate.config(state=NORMAL)
+        self.btnCancel.config(state=DISABLED)
+
+    self.win.after(self.refresh_interval, self.refresh)
 
   def run(self, generator_function):
 
     self.generator = generator_function
+    self.worker = None
+    self.cancel = None
+    self.cards_done = 0
+    self.messages = queue.Queue()
 
     self.win = Tk()
     self.win.grid_columnconfigure(1, weight=1)
@@ -65,6 +136,7 @@ class CardGui:
     self.template = StringVar()
     self.deck = StringVar()
     self.prefix = StringVar()
+    self.status = StringVar()
 
 
     Label(self.win, text="Card template:").grid(row=0, column=0, sticky=E)
@@ -78,13 +150,20 @@ class CardGui:
     Label(self.win, text="Output file prefix:").grid(row=2, column=0, sticky=E)
     self.txtDeck = Entry(self.win, textvariable=self.prefix).grid(row=2, column=1, sticky=E+W)
 
-    self.btnGenerate = Button(self.win, text="Generate!", command=self.invoke).grid(row=3, column=0, columnspan=3, sticky=E+W)
+    self.btnGenerate = Button(self.win, text="Generate!", command=self.invoke)
+    self.btnGenerate.grid(row=3, column=0, columnspan=2, sticky=E+W)
+    self.btnCancel = Button(self.win, text="Cancel", command=self.stop, state=DISABLED)
+    self.btnCancel.grid(row=3, column=2, sticky=E+W)
+
+    self.progress = Progressbar(self.win, mode="indeterminate")
+    self.progress.grid(row=4, column=0, columnspan=2, sticky=E+W)
+    Label(self.win, textvariable=self.status).grid(row=4, column=2, sticky=E)
 
     self.log = Text(self.win)
-    self.log.grid(row=4, column=0, columnspan=3, sticky=N+S+E+W)
+    self.log.grid(row=5, column=0, columnspan=3, sticky=N+S+E+W)
     self.log.config(state=DISABLED)
 
     log.setlog(self)
 
+    self.win.after(self.refresh_interval, self.refresh)
     return self.win.mainloop()
-
@@ -0,0 +1,220 @@
+import unittest
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+import log
+import util
+from memory import image_bytes
+
+
+# Bytes of transformed images kept on disk, before the least recently used are removed
+DISK_LIMIT = 1 << 30
+
+
+class TransformCache:
+  """ Resized and rotated versions of deck images, kept in memory (least recently used first out)
+      and optionally on disk, so each transform is only computed once. On disk, files are
+      pruned least recently used first (by modification time, bumped when read) once they
+      take up more than disk_limit bytes. """
+
+  def __init__(self, directory=None, capacity=64, disk_limit=DISK_LIMIT):
+    self.directory = directory
+    self.capacity = capacity
+    self.images = OrderedDict()
+    self.lock = threading.Lock()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+
+    # Bytes on disk, counted once the first image is stored. Other runs sharing the directory
+    # add to it too, so it's counted again from the files themselves before pruning.
+    self.disk_limit = disk_limit
+    self.disk_size = None
+    self.disk_lock = threading.Lock()
+
+  def path(self, key):
+    name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    return os.path.join(self.directory, name + ".png")
+
+  def remember(self, key, image):
+    with self.lock:
+      self.size += image_bytes(image) - image_bytes(self.images.get(key, None))
+      self.images[key] = image
+      self.images.move_to_end(key)
+      while (len(self.images) > self.capacity):
+        self.size -= image_bytes(self.images.popitem(last=False)[1])
+
+  def memory_used(self):
+    return self.size
+
+  def evict(self, size):
+    """ Drop images from memory, least recently used first, until size bytes are freed.
+        Returns (images, bytes) freed. """
+    count = 0
+    freed = 0
+    with self.lock:
+      while (freed < size and len(self.images) > 0):
+        freed += image_bytes(self.images.popitem(last=False)[1])
+        count += 1
+      self.size -= freed
+    return (count, freed)
+
+  def get(self, key):
+    """ A copy of the cached image, or None """
+    with self.lock:
+      image = self.images.get(key, None)
+      if (image is not None):
+        self.images.move_to_end(key)
+
+    if (image is None and self.directory is not None):
+      try:
+        path = self.path(key)
+        image = Image.open(path)
+        image.load()
+        self.remember(key, image)
+      except (OSError, ValueError):
+        image = None
+
+      if (image is not None):
+        try:
+          # Recently used, as far as pruning goes
+          os.utime(path)
+        except OSError:
+          pass
+
+    if (image is None):
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    return image.copy()
+
+  def put(self, key, image):
+    self.remember(key, image.copy())
+
+    if (self.directory is not None):
+      path = self.path(key)
+      try:
+        # Fast and lossless. These are read far more often than they are written.
+        util.write_replacing(path, lambda handle: image.save(handle, "png", compress_level=1))
+        self.stored(os.path.getsize(path))
+      except OSError as e:
+        log.debug("transform-cache", "Unable to save transformed image: %s", e)
+
+  def disk_files(self):
+    """ (modification time, bytes, path) of every image on disk """
+    files = []
+    for entry in os.scandir(self.directory):
+      if (entry.name.endswith(".png")):
+        try:
+          stat = entry.stat()
+        except OSError:
+          # Pruned by another run
+          continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    return files
+
+  def stored(self, length):
+    """ Count an image just written to disk, pruning the directory once it's over the limit """
+    with self.disk_lock:
+      if (self.disk_size is None):
+        self.disk_size = sum(size for _, size, _ in self.disk_files())
+      else:
+        self.disk_size += length
+      if (self.disk_size > self.disk_limit):
+        self.prune()
+
+  def prune(self):
+    """ Remove the least recently used images until the directory is back to 90% of the
+        limit, so it isn't pruned again for every image stored. Called with disk_lock held. """
+    files = sorted(self.disk_files())
+    self.disk_size = sum(size for _, size, _ in files)
+    target = self.disk_limit * 9 // 10
+    removed = 0
+    for _, size, path in files:
+      if (self.disk_size <= target):
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      self.disk_size -= size
+      removed += 1
+    log.debug("transform-cache", "Pruned %d transformed images from %s", removed, self.directory)
+
+
+# The cache used by image labels, if any. See configure().
+cache = None
+
+def configure(directory=None, capacity=64, disk_limit=DISK_LIMIT):
+  """ Set up the transform cache. Without a directory, it's only kept in memory. """
+  global cache
+  cache = TransformCache(directory, capacity, disk_limit)
+  return cache
+
+def disable():
+  global cache
+  cache = None
+
+
+#
+# Unit tests
+#
+class TestTransformCache(unittest.TestCase):
+
+  def test_lru(self):
+    transforms = TransformCache(capacity=2)
+    for i in range(3):
+      transforms.put(("img%d" % i, 10), Image.new("RGBA", (i + 1, 1)))
+
+    self.assertEqual(transforms.get(("img0", 10)), None)
+    self.assertEqual(transforms.get(("img2", 10)).size, (3, 1))
+    self.assertEqual((transforms.hits, transforms.misses), (1, 1))
+
+    # Evicted under memory pressure, least recently used first
+    self.assertEqual(transforms.memory_used(), 20)
+    self.assertEqual(transforms.evict(1), (1, 8))
+    self.assertEqual(transforms.get(("img1", 10)), None)
+
+  def test_disk(self):
+    directory = tempfile.mkdtemp()
+    image = Image.new("RGBA", (5, 4), (1, 2, 3, 128))
+    TransformCache(directory).put(("abc", (5, 4)), image)
+
+    # A fresh cache, e.g. in the next run
+    transforms = TransformCache(directory)
+    self.assertEqual(transforms.get(("abc", (5, 4))).tobytes(), image.tobytes())
+    self.assertEqual(transforms.get(("abc", (5, 5))), None)
+
+  def test_prune(self):
+    directory = tempfile.mkdtemp()
+    images = [ Image.effect_noise((32, 32), 64 + i) for i in range(6) ]
+    earlier = TransformCache(directory)
+    length = 0
+    for i, image in enumerate(images):
+      earlier.put(("img", i), image)
+      path = earlier.path(("img", i))
+      length = max(length, os.path.getsize(path))
+      os.utime(path, (1000 + i, 1000 + i))
+
+    # Reading an image makes it recent
+    transforms = TransformCache(directory, capacity=0, disk_limit=5 * length)
+    self.assertNotEqual(transforms.get(("img", 0)), None)
+
+    # Over the limit: the least recently used go, down to 90% of it
+    transforms.put(("img", 6), images[0])
+    self.assertLessEqual(transforms.disk_size, 5 * length * 9 // 10)
+    self.assertEqual(transforms.disk_size, sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)))
+    self.assertFalse(os.path.exists(transforms.path(("img", 1))))
+    self.assertTrue(os.path.exists(transforms.path(("img", 0))))
+    self.assertTrue(os.path.exists(transforms.path(("img", 6))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,18 +10,26 @@ import util
 
 class CardLayout:
 
-  def __init__(self, json, rootdir):
+  def __init__(self, json, rootdir, scale=1.0):
     self.type =          util.get_default(json, "type", "simple")
     self.directory = rootdir
+    self.scale = scale
 
     # Load a front image which is specific to this card layout
     front_name =  util.get_default(json, "front-image", None)
     self.front = None
+    self.front_path = None
     if (front_name is not None):
-      front_path = os.path.join(rootdir, front_name)
-      self.front = util.default_image(front_path)
+      self.front_path = os.path.join(rootdir, front_name)
+      self.front = util.default_image(self.front_path)
+      if (scale != 1.0):
+        self.front = util.scaled_image(self.front, scale)
 
 
+  def select(self, dimensions, content_gen):
+    """ Pick the content for the next card, like render() would, but without rendering it """
+    return None
+
   def render(self, dimensions, content_gen):
     """ Render a PIL image of the specified dimensions, requesting text and images from content_gen """
 
@@ -31,24 +39,90 @@ class CardLayout:
 
     return image
 
+  def upcoming_images(self, content_gen, count):
+    """ Filenames of the images the next few cards of this layout will need """
+    return []
+
+  def text_labels(self):
+    """ Every text label, including the full-size ones kept by preview labels """
+    return []
+
+  def dependencies(self):
+    """ The files (images, fonts) this layout was built from """
+    files = []
+    if (self.front_path is not None):
+      files.append(self.front_path)
+    for label in self.text_labels():
+      if (label.fontfile is not None):
+        files.append(label.fontfile)
+    return files
+
 class SimpleLayout(CardLayout):
   """ Parsed version of a simple layout (uses text lines as deck input) """
 
-  def __init__(self, json, rootdir):
-    super().__init__(json, rootdir)
+  def __init__(self, json, rootdir, scale=1.0):
+    super().__init__(json, rootdir, scale)
     textspecs = util.get_default(json, "texts", [])
     imagespecs = util.get_default(json, "images", [])
 
     # Initialize plain text labels, to be rendered when we have text
     self.textlabels = []
     for spec in textspecs:
-      self.textlabels.append(TextLabel(spec))
+      self.textlabels.append(TextLabel(spec, scale))
 
     # Initialize image labels, to be rendered when we have text
     self.imagelabels = []
     for spec in imagespecs:
-      self.imagelabels.append(ImageLabel(spec))
+      self.imagelabels.append(ImageLabel(spec, scale))
+
+
+  def text_labels(self):
+    return self.textlabels + [ l.reference for l in self.textlabels if l.reference is not None ]
+
+  def upcoming_images(self, content_gen, count):
+    """ Filenames of the images the next few cards of this layout will need """
+    names = []
+    for label in self.imagelabels:
+      if (label.static is not None):
+        names.append(label.static)
+      else:
+        names += content_gen.peek_text_simple(label.source, count)
+    return names
+
+  def select(self, dimensions, content_gen):
+    """ Pick the content for the next card, like render() would, but without rendering it """
+    if (len(self.textlabels) + len(self.imagelabels) == 0):
+      log.warning("no-labels", "Warning: No text or image labels in layout.")
+      return None
+
+    images = []
+    for label in self.imagelabels:
+      if (label.static is not None):
+        filename = label.static
+        images.append({ "static": filename })
+      else:
+        filename = content_gen.gen_text_simple(label.source)
+        if (filename is None):
+          return None
+        images.append({ "source": label.source, "line": content_gen.position(label.source) })
+
+      if (not content_gen.has_image(filename)):
+        log.warning("image-load", "Unable to load image %s", os.path.join(content_gen.directory, filename))
+        return None
+
+    texts = []
+    for label in self.textlabels:
+      fits = False
+      while (not fits):
+        text = content_gen.gen_text_simple(label.source)
+        if (text is None):
+          # End of file
+          return None
+        fits = label.fits(dimensions, text)
 
+      texts.append({ "source": label.source, "line": content_gen.position(label.source) })
+
+    return { "images": images, "texts": texts }
 
   def render(self, dimensions, content_gen):
     """ Generate a transparent PIL card layer with the text on it """
@@ -57,7 +131,7 @@ class SimpleLayout(CardLayout):
     image = super().render(dimensions, content_gen)
 
     if (len(self.textlabels) + len(self.imagelabels) == 0):
-      log.log.write("Warning: No text or image labels in layout.")
+      log.warning("no-labels", "Warning: No text or image labels in layout.")
       return None
 
     for label in self.imagelabels:
@@ -99,8 +173,8 @@ class SimpleLayout(CardLayout):
 class ComplexLayout(CardLayout):
   """ Parsed version of a complex layout (uses JSON objects as deck input) """
 
-  def __init__(self, json, rootdir):
-    super().__init__(json, rootdir)
+  def __init__(self, json, rootdir, scale=1.0):
+    super().__init__(json, rootdir, scale)
     self.source =        util.get_default(json, "source", "text.json")
     self.textspecs =     util.get_default(json, "texts", [])
     self.imagespecs =    util.get_default(json, "images", [])
@@ -109,12 +183,70 @@ class ComplexLayout(CardLayout):
     self.textlabels = {}
     for spec in self.textspecs:
       name = util.get_default(spec, "name", "")
-      self.textlabels[name] = TextLabel(spec)
+      self.textlabels[name] = TextLabel(spec, scale)
 
     self.imagelabels = {}
     for spec in self.imagespecs:
       name = util.get_default(spec, "name", "")
-      self.imagelabels[name] = ImageLabel(spec)
+      self.imagelabels[name] = ImageLabel(spec, scale)
+
+  def text_labels(self):
+    labels = list(self.textlabels.values())
+    return labels + [ l.reference for l in labels if l.reference is not None ]
+
+  def upcoming_images(self, content_gen, count):
+    """ Filenames of the images the next few cards of this layout will need """
+    names = []
+    for texts in content_gen.peek_text_complex(self.source, count):
+      for name,label in self.imagelabels.items():
+        filename = label.static
+        if (filename is None):
+          filename = util.get_default(texts, name, None)
+        if (filename is not None):
+          names.append(filename)
+    return names
+
+  def try_select_labels(self, dimensions, texts, content_gen):
+    """ Check that a card's contents will render, without rendering it """
+    for name,label in self.imagelabels.items():
+      filename = label.static
+      if (filename is None):
+        filename  = util.get_default(texts, name, None)
+
+      if (filename is None):
+        continue
+
+      if (not content_gen.has_image(filename)):
+        log.warning("image-load", "Unable to load image %s", os.path.join(content_gen.directory, filename))
+        return False
+
+    for name,label in self.textlabels.items():
+      static = ""
+      if (label.static is not None):
+        static = label.static
+
+      text  = util.get_default(texts, name, static)
+      if (not label.fits(dimensions, text)):
+        log.warning("sub-label", "Failed to render sub-label %s.", name)
+        return False
+
+    return True
+
+  def select(self, dimensions, content_gen):
+    """ Pick the content for the next card, like render() would, but without rendering it """
+    if (len(self.textlabels) == 0):
+      log.warning("no-labels", "Warning: No labels in layout.")
+      return None
+
+    fits = False
+    while (not fits):
+      texts = content_gen.gen_text_complex(self.source)
+      if (texts is None):
+        # End of file
+        return None
+      fits = self.try_select_labels(dimensions, texts, content_gen)
+
+    return { "source": self.source, "card": content_gen.position(self.source) }
 
   def try_render_labels(self, dimensions, texts, content_gen):
     image = Image.new("RGBA", dimensions, (0,0,0,0))
@@ -158,7 +290,7 @@ class ComplexLayout(CardLayout):
 
       rendered_text = label.render(dimensions, text)
       if (rendered_text is None):
-        log.log.write("Failed to render sub-label %s.\n" % name)
+        log.warning("sub-label", "Failed to render sub-label %s.", name)
         rendered_labels = None
         return None
 
@@ -170,7 +302,7 @@ class ComplexLayout(CardLayout):
     """ Generate a transparent PIL card layer with the text on it """
 
     if (len(self.textlabels) == 0):
-      log.log.write("Warning: No labels in layout.")
+      log.warning("no-labels", "Warning: No labels in layout.")
       return None
 
     # The static card face
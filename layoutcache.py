@@ -0,0 +1,183 @@
+import unittest
+
+import os
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+import PIL
+
+import log
+
+
+# Bump this whenever wrapping or measuring changes
+LAYOUT_VERSION = 2
+
+# New layouts are committed this many at a time, so other runs sharing the
+# cache are never locked out for long
+BATCH_SIZE = 32
+
+class LayoutCache:
+  """ Line breaks and measured sizes of texts, by font, size and label geometry.
+      Kept in memory and optionally in an SQLite file, so warm runs don't lay out text at all.
+      The file may be shared by runs at the same time. If it can't be read or written,
+      the cache carries on in memory only. """
+
+  def __init__(self, path=None, timeout=2.0):
+    self.path = path
+    self.entries = {}
+    self.pending = 0
+    self.hits = 0
+    self.misses = 0
+
+    # Texts may be measured and rendered on different threads
+    self.lock = threading.Lock()
+
+    self.db = None
+    if (path is not None):
+      try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        # Readers don't wait for writers (or the other way around) in other runs
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS layouts (key TEXT PRIMARY KEY, lines TEXT, width INTEGER, height INTEGER)")
+        self.db.commit()
+      except sqlite3.Error as e:
+        self.fail(e)
+
+  def fail(self, e):
+    """ Give up on the file, keeping what's in memory. Called with the lock held (or from __init__). """
+    log.warning("layout-cache-file", "Unable to use the layout cache %s, keeping layouts in memory only: %s", self.path, e)
+    if (self.db is not None):
+      try:
+        self.db.close()
+      except sqlite3.Error:
+        pass
+    self.db = None
+    self.pending = 0
+
+  def key(self, font_id, settings, text):
+    digest = hashlib.sha256()
+    digest.update(repr((LAYOUT_VERSION, PIL.__version__, font_id, settings)).encode("utf-8"))
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+  def get(self, key):
+    """ (lines, size), or None if this layout hasn't been seen """
+    with self.lock:
+      entry = self.entries.get(key, None)
+
+      if (entry is None and self.db is not None):
+        try:
+          row = self.db.execute("SELECT lines, width, height FROM layouts WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+          self.fail(e)
+          row = None
+        if (row is not None):
+          entry = (json.loads(row[0]), (row[1], row[2]))
+          self.entries[key] = entry
+
+      if (entry is None):
+        self.misses += 1
+      else:
+        self.hits += 1
+    return entry
+
+  def put(self, key, lines, size):
+    with self.lock:
+      self.entries[key] = (lines, size)
+      if (self.db is not None):
+        try:
+          self.db.execute("INSERT OR REPLACE INTO layouts VALUES (?, ?, ?, ?)", (key, json.dumps(lines), size[0], size[1]))
+          self.pending += 1
+          if (self.pending >= BATCH_SIZE):
+            self.commit()
+        except sqlite3.Error as e:
+          self.fail(e)
+
+  def commit(self):
+    """ Called with the lock held """
+    self.db.commit()
+    self.pending = 0
+
+  def flush(self):
+    """ Write new layouts to disk """
+    with self.lock:
+      if (self.db is not None and self.pending > 0):
+        try:
+          self.commit()
+        except sqlite3.Error as e:
+          self.fail(e)
+
+  def close(self):
+    self.flush()
+    if (self.db is not None):
+      try:
+        self.db.close()
+      except sqlite3.Error:
+        pass
+      self.db = None
+
+
+# The cache used by text labels, if any. See configure().
+cache = None
+
+def configure(path=None):
+  """ Set up the layout cache. Without a path, it's only kept in memory. """
+  global cache
+  disable()
+  cache = LayoutCache(path)
+  return cache
+
+def disable():
+  global cache
+  if (cache is not None):
+    cache.close()
+  cache = None
+
+
+#
+# Unit tests
+#
+class TestLayoutCache(unittest.TestCase):
+
+  def test_persist(self):
+    path = os.path.join(tempfile.mkdtemp(), "layout.sqlite")
+    layouts = LayoutCache(path)
+    key = layouts.key(("font.ttf", 1, 2), (12, 100), "Some text")
+    self.assertEqual(layouts.get(key), None)
+    layouts.put(key, [ "Some", "text" ], (40, 30))
+    layouts.close()
+
+    layouts = LayoutCache(path)
+    self.assertEqual(layouts.get(key), ([ "Some", "text" ], (40, 30)))
+    self.assertEqual(layouts.get(layouts.key(("font.ttf", 1, 2), (13, 100), "Some text")), None)
+    self.assertEqual((layouts.hits, layouts.misses), (1, 1))
+    layouts.close()
+
+  def test_shared(self):
+    path = os.path.join(tempfile.mkdtemp(), "layout.sqlite")
+    first = LayoutCache(path)
+    second = LayoutCache(path, timeout=0.1)
+    key = first.key(("font.ttf", 1, 2), (12, 100), "Some text")
+
+    # Another run in the middle of writing doesn't fail this one
+    first.put(key, [ "Some", "text" ], (40, 30))
+    second.put(key, [ "Some", "text" ], (40, 30))
+    self.assertEqual(second.get(key), ([ "Some", "text" ], (40, 30)))
+    first.close()
+    second.close()
+
+    # Nor does a broken cache file
+    with open(path, "wb") as handle:
+      handle.write(b"not a database" * 100)
+    layouts = LayoutCache(path)
+    layouts.put(key, [ "Some", "text" ], (40, 30))
+    self.assertEqual(layouts.get(key), ([ "Some", "text" ], (40, 30)))
+    layouts.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,10 @@
+import unittest
+
+import io
+import os
 import sys
+import tempfile
+import threading
 
 # Global log function.
 # This object exposes a write(string) function.
@@ -7,3 +13,164 @@ log = sys.stderr
 def setlog(obj):
   global log
   log = obj
+
+
+# Message severities
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = { "debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR }
+
+# Messages below this severity are not shown
+level = INFO
+
+# How many warnings of the same kind are shown before the rest are only counted.
+# None shows them all.
+limit = 10
+
+# Every message, including suppressed ones, also goes here if set
+detail = None
+
+# kind -> [severity, count]
+counters = {}
+lock = threading.Lock()
+
+
+def configure(new_level, new_limit, detail_path=None):
+  """ Set the log level, repeat limit and an optional detail file """
+  global level, limit, detail
+  level = new_level
+  limit = new_limit
+  if (detail_path is not None):
+    detail = open(detail_path, "w", encoding="utf-8", buffering=1 << 16)
+
+def close():
+  """ Flush and close the detail file, if any """
+  global detail
+  with lock:
+    if (detail is not None):
+      detail.close()
+      detail = None
+
+def reset():
+  """ Forget the message counts, e.g. at the start of a run """
+  with lock:
+    counters.clear()
+
+def message(severity, kind, text, *args):
+  """ Log a message of a given kind. The text is only %-formatted if it is actually written. """
+  with lock:
+    counter = counters.setdefault(kind, [severity, 0])
+    counter[1] += 1
+    count = counter[1]
+
+  # Only warnings are rate limited. They are the ones which repeat for every card.
+  limited = (severity == WARNING and limit is not None and count > limit)
+  shown = (severity >= level and not limited)
+  if (not shown and detail is None):
+    return
+
+  if (len(args) > 0):
+    text = text % args
+  text += "\n"
+
+  # Writes from several threads would interleave, or meet close()
+  with lock:
+    if (detail is not None):
+      detail.write(text)
+
+  if (shown):
+    log.write(text)
+    if (severity == WARNING and count == limit):
+      log.write("(Further \"%s\" messages will only be counted.)\n" % kind)
+
+def debug(kind, text, *args):
+  message(DEBUG, kind, text, *args)
+
+def info(kind, text, *args):
+  message(INFO, kind, text, *args)
+
+def warning(kind, text, *args):
+  message(WARNING, kind, text, *args)
+
+def error(kind, text, *args):
+  message(ERROR, kind, text, *args)
+
+def summary():
+  """ Write the number of warnings and errors of each kind """
+  with lock:
+    problems = [ (kind, c[1]) for kind,c in counters.items() if c[0] >= WARNING ]
+
+  if (len(problems) == 0):
+    return
+
+  log.write("Summary of problems:\n")
+  for kind, count in sorted(problems):
+    log.write("  %6d %s\n" % (count, kind))
+
+  with lock:
+    if (detail is not None):
+      detail.flush()
+
+
+#
+# Unit tests
+#
+class TestLog(unittest.TestCase):
+
+  def setUp(self):
+    self.output = io.StringIO()
+    setlog(self.output)
+    reset()
+
+  def tearDown(self):
+    setlog(sys.stderr)
+    configure(INFO, 10)
+
+  def test_limit(self):
+    configure(INFO, 3)
+    for i in range(10):
+      warning("overflow", "Text %d overflows", i)
+    info("status", "Done")
+    info("status", "Done")
+    debug("chatter", "Not shown")
+
+    lines = self.output.getvalue().splitlines()
+    self.assertEqual(lines[:3], [ "Text 0 overflows", "Text 1 overflows", "Text 2 overflows" ])
+    self.assertEqual(lines[-2:], [ "Done", "Done" ])
+    self.assertEqual(len(lines), 6)
+
+    summary()
+    self.assertTrue("      10 overflow" in self.output.getvalue())
+    self.assertFalse("status" in self.output.getvalue())
+
+  def test_level(self):
+    configure(ERROR, None)
+    warning("overflow", "Quiet")
+    error("broken", "Loud")
+    self.assertEqual(self.output.getvalue(), "Loud\n")
+
+  def test_detail(self):
+    path = os.path.join(tempfile.mkdtemp(), "detail.log")
+    configure(ERROR, 1, path)
+
+    def chatter(thread):
+      for i in range(500):
+        warning("overflow", "Thread %d text %d overflows " + "x" * 200, thread, i)
+
+    threads = [ threading.Thread(target=chatter, args=(t,)) for t in range(4) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    close()
+
+    # Every message, suppressed or not, each on a line of its own
+    with open(path, "r", encoding="utf-8") as handle:
+      lines = handle.read().splitlines()
+    self.assertEqual(len(lines), 2000)
+    self.assertTrue(all(line.endswith(" overflows " + "x" * 200) for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+import unittest
+
+import os
+import re
+import time
+import threading
+
+from PIL import Image
+
+import log
+import tracing
+from tiler import COLUMNS, ROWS, CARDS_PER_SHEET
+
+
+def parse_size(text):
+  """ A memory size like 512M, 2G or 1.5GB in bytes. Plain numbers are megabytes. """
+  match = re.match(r"^\s*([0-9]+(?:\.[0-9]*)?)\s*([KMG]?)B?\s*$", text, re.IGNORECASE)
+  if (match is None):
+    raise ValueError("Expected a size like 512M or 2G, got \"%s\"" % text)
+  unit = { "K": 1 << 10, "": 1 << 20, "M": 1 << 20, "G": 1 << 30 }[match.group(2).upper()]
+  size = int(float(match.group(1)) * unit)
+  if (size <= 0):
+    raise ValueError("A memory size must be positive")
+  return size
+
+def image_bytes(image):
+  """ Roughly how much memory the pixels of an image take """
+  if (image is None):
+    return 0
+  return image.width * image.height * len(image.getbands())
+
+def process_memory():
+  """ Memory in use by this process, or 0 where we can't tell """
+  try:
+    with open("/proc/self/statm", "r") as handle:
+      return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, IndexError, AttributeError):
+    return 0
+
+def megabytes(size):
+  return size / float(1 << 20)
+
+
+class MemoryGovernor:
+  """ Keeps a run within a memory budget. Caches which hold images register here, and
+      so do the cards and sheets on their way through the pipeline. When the budget runs
+      short, caches are emptied first, and if that isn't enough, rendering waits for
+      cards to be written before it starts on new ones. """
+
+  def __init__(self, budget):
+    self.budget = budget
+
+    # Whatever the process already holds (interpreter, libraries, the template)
+    # before any cards are rendered
+    self.baseline = process_memory()
+
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock)
+
+    # name -> object with memory_used() and evict(size) -> (items, bytes)
+    self.caches = {}
+
+    self.in_flight = 0          # Bytes of cards, sheets and bands between rendering and writing
+    self.peak = 0
+    self.evicted = {}           # Cache name -> [items, bytes]
+    self.waits = 0
+    self.waited = 0.0
+
+  def available(self):
+    return max(0, self.budget - self.baseline)
+
+  def register(self, name, cache):
+    with self.lock:
+      self.caches[name] = cache
+
+  def unregister(self, name):
+    with self.lock:
+      self.caches.pop(name, None)
+
+  def used(self):
+    """ Bytes of everything tracked. Called with the lock held. """
+    return self.in_flight + sum([ c.memory_used() for c in self.caches.values() ])
+
+  def relieve(self, needed):
+    """ Empty caches, biggest first, until needed more bytes fit. Called with the lock held. """
+    over = self.used() + needed - self.available()
+    for name, cache in sorted(self.caches.items(), key=lambda c: -c[1].memory_used()):
+      if (over <= 0): break
+      items, freed = cache.evict(over)
+      if (items > 0):
+        counts = self.evicted.setdefault(name, [0, 0])
+        counts[0] += items
+        counts[1] += freed
+        over -= freed
+    return over <= 0
+
+  def reserve(self, size, floor=None, abort=None):
+    """ Account for a card (or sheet) entering the pipeline. If there's no room even after
+        emptying the caches, waits for others to be released, unless fewer than floor bytes
+        are in flight (the tiler may be waiting for more cards to finish a sheet or row).
+        Without a floor it never waits. """
+    with self.lock:
+      started = None
+      while (not self.relieve(size) and floor is not None and self.in_flight >= floor):
+        if (abort is not None and abort.is_set()):
+          break
+        if (started is None):
+          started = time.perf_counter()
+          self.waits += 1
+        self.changed.wait(0.1)
+      if (started is not None):
+        ended = time.perf_counter()
+        self.waited += ended - started
+        if (tracing.tracer is not None):
+          tracing.tracer.complete("wait for memory", "wait", started, ended, None)
+
+      self.in_flight += size
+      self.peak = max(self.peak, self.used())
+
+  def release(self, size):
+    with self.lock:
+      self.in_flight -= size
+      self.changed.notify_all()
+
+  def plan(self, template, stream, can_stream, queue_size, prefetch):
+    """ Pick sheet streaming and how many cards may be in flight, so a run fits the budget.
+        Returns (stream, queue_size, prefetch). """
+    face = image_bytes(template.front)
+    sheet = COLUMNS * template.hidden.width * ROWS * template.hidden.height * 3
+    band = sheet // ROWS
+    available = self.available()
+
+    # What has to fit in any case: the cards of a sheet (or row) waiting to be tiled,
+    # and one sheet being tiled while another is written
+    whole = CARDS_PER_SHEET * face + 2 * sheet
+    streamed = COLUMNS * face + 2 * band
+
+    if (not stream and whole > available / 2):
+      if (can_stream):
+        stream = True
+        log.info("memory", "Streaming sheets a row at a time, as whole sheets would take %.0f MB of the %.0f MB budget.",
+                 megabytes(whole), megabytes(available))
+      elif (whole > available):
+        log.warning("memory-budget", "Whole sheets need about %.0f MB, more than the %.0f MB left in the budget. Without --optimize and --quantize they could be streamed instead.",
+                    megabytes(whole), megabytes(available))
+
+    # Each stage's queue may hold this many cards. Rendering waits for the budget anyway,
+    # but shorter queues mean fewer cards stuck behind the one which is waiting.
+    spare = available - (streamed if stream else whole)
+    fits = max(1, int(spare // (3 * face)))
+    if (fits < queue_size):
+      log.info("memory", "Keeping at most %d cards in each queue (instead of %d) to stay within %.0f MB.",
+               fits, queue_size, megabytes(self.budget))
+      queue_size = fits
+    if (prefetch > queue_size):
+      log.info("memory", "Decoding images at most %d cards ahead (instead of %d).", queue_size, prefetch)
+      prefetch = queue_size
+
+    return (stream, queue_size, prefetch)
+
+  def report(self):
+    """ Log what the governor had to do """
+    log.info("memory", "Peak of %.0f MB in caches and cards, on top of %.0f MB at the start, for a budget of %.0f MB.",
+             megabytes(self.peak), megabytes(self.baseline), megabytes(self.budget))
+    for name, (items, size) in sorted(self.evicted.items()):
+      log.info("memory", "Dropped %d %s (%.0f MB) to make room.", items, name, megabytes(size))
+    if (self.waits > 0):
+      log.info("memory", "Rendering waited %d times (%.2f s) for cards to be written.", self.waits, self.waited)
+
+
+# The governor that caches and the pipeline report to, if there's a budget. See configure().
+governor = None
+
+def configure(budget):
+  """ Enforce a memory budget (in bytes) from here on """
+  global governor
+  governor = MemoryGovernor(budget)
+  return governor
+
+def disable():
+  global governor
+  governor = None
+
+
+#
+# Unit tests
+#
+class FakeCache:
+
+  def __init__(self, sizes):
+    self.sizes = sizes
+
+  def memory_used(self):
+    return sum(self.sizes)
+
+  def evict(self, size):
+    items = 0
+    freed = 0
+    while (freed < size and len(self.sizes) > 0):
+      freed += self.sizes.pop(0)
+      items += 1
+    return (items, freed)
+
+
+class TestMemory(unittest.TestCase):
+
+  def test_size(self):
+    self.assertEqual(parse_size("512M"), 512 << 20)
+    self.assertEqual(parse_size("2g"), 2 << 30)
+    self.assertEqual(parse_size("1.5GB"), 3 << 29)
+    self.assertEqual(parse_size("100"), 100 << 20)
+    self.assertRaises(ValueError, parse_size, "lots")
+    self.assertEqual(image_bytes(Image.new("RGBA", (10, 20))), 800)
+
+  def test_evict(self):
+    governor = MemoryGovernor(1000)
+    governor.baseline = 0
+    cache = FakeCache([ 300, 300, 300 ])
+    governor.register("images", cache)
+
+    # Caches make room first
+    governor.reserve(500, floor=0)
+    self.assertEqual(cache.sizes, [ 300 ])
+    self.assertEqual(governor.evicted, { "images": [ 2, 600 ] })
+
+    # Below the floor, cards go ahead even when over budget
+    governor.reserve(700, floor=2000)
+    self.assertEqual(governor.in_flight, 1200)
+    self.assertEqual(cache.sizes, [])
+
+    # Otherwise they wait for room
+    done = threading.Event()
+    def reserve():
+      governor.reserve(600, floor=0)
+      done.set()
+    threading.Thread(target=reserve).start()
+    self.assertFalse(done.wait(0.3))
+    governor.release(1200)
+    self.assertTrue(done.wait(5))
+    self.assertEqual(governor.in_flight, 600)
+    self.assertEqual(governor.waits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
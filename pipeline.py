@@ -0,0 +1,602 @@
+import unittest
+
+import os
+import json
+import queue
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+import log
+import memory
+import tracing
+from card import CardTemplate
+from deckindex import RecordingGenerator, ReplayGenerator
+from prefetch import Prefetcher
+from sheets import SheetWriter, SheetStream
+from tiler import COLUMNS, ROWS, CARDS_PER_SHEET
+
+
+# Passed down the pipeline after the last item
+END = object()
+
+# Returned to a stage which is waiting when the pipeline is stopped
+ABORT = object()
+
+class Stage:
+  """ One step of a pipeline, with the bounded queue of items waiting for it """
+
+  def __init__(self, name, work, finish, depth, workers=1):
+    self.name = name
+    self.work = work        # item -> list of items for the next stage
+    self.finish = finish    # () -> list of items for the next stage, after the last item
+    self.queue = queue.Queue(depth)
+    self.depth = depth
+
+    # Threads taking items from the queue. The last one to see the end runs finish.
+    self.workers = workers
+    self.running = workers
+    self.lock = threading.Lock()
+
+    self.items = 0
+    self.busy = 0.0
+    self.starved = 0.0      # Waiting for items
+    self.blocked = 0.0      # Waiting for room in the next stage's queue
+
+    # Queue depth, as seen by each arriving item
+    self.arrivals = 0
+    self.depth_sum = 0
+    self.depth_max = 0
+
+  def report(self):
+    mean = 0.0
+    if (self.arrivals > 0): mean = self.depth_sum / self.arrivals
+    log.debug("pipeline", "%-8s %5d items, queue %.1f average, %d max (of %d), busy %.2f s, waited %.2f s for input, %.2f s for output",
+              self.name, self.items, mean, self.depth_max, self.depth, self.busy, self.starved, self.blocked)
+
+
+class Pipeline:
+  """ Runs each stage on its own thread, joined by bounded queues. A stage which gets
+      ahead of the next one waits for room in its queue, so no stage runs away with memory. """
+
+  def __init__(self, cancel=None):
+    self.cancel = cancel
+    self.stages = []
+    self.source = None
+    self.abort = threading.Event()
+    self.error = None
+    self.cancelled = False
+
+  def stage(self, name, work, finish=None, depth=8, workers=1):
+    """ Add a stage. With several workers, work has to be safe to call from several threads
+        and the items may come out in a different order. """
+    self.stages.append(Stage(name, work, finish, depth, workers))
+
+  def put(self, stage, item):
+    """ Queue an item for a stage, waiting while its queue is full. False if the pipeline was stopped. """
+    with stage.lock:
+      depth = stage.queue.qsize()
+      stage.arrivals += 1
+      stage.depth_sum += depth
+      stage.depth_max = max(stage.depth_max, depth)
+
+    try:
+      stage.queue.put_nowait(item)
+      return True
+    except queue.Full:
+      pass
+
+    with tracing.span("wait for " + stage.name, "wait"):
+      while (not self.abort.is_set()):
+        try:
+          stage.queue.put(item, timeout=0.1)
+          return True
+        except queue.Full:
+          pass
+    return False
+
+  def get(self, stage):
+    try:
+      return stage.queue.get_nowait()
+    except queue.Empty:
+      pass
+
+    with tracing.span("wait for input", "wait"):
+      while (not self.abort.is_set()):
+        try:
+          return stage.queue.get(timeout=0.1)
+        except queue.Empty:
+          pass
+    return ABORT
+
+  def forward(self, stage, outputs, downstream):
+    """ Pass the outputs of a stage on, timing how long that takes """
+    started = time.perf_counter()
+    for item in outputs:
+      if (downstream is not None and not self.put(downstream, item)):
+        return False
+    with stage.lock:
+      stage.blocked += time.perf_counter() - started
+    return True
+
+  def fail(self, error):
+    if (self.error is None):
+      self.error = error
+    self.abort.set()
+
+  def feed(self, items):
+    """ Run the first stage, which produces the items """
+    stage = self.source
+    downstream = self.stages[0] if len(self.stages) > 0 else None
+    try:
+      iterator = iter(items)
+      while (True):
+        if (self.cancel is not None and self.cancel.is_set()):
+          self.cancelled = True
+          self.abort.set()
+          return
+
+        started = time.perf_counter()
+        item = next(iterator, END)
+        stage.busy += time.perf_counter() - started
+
+        if (item is END):
+          if (self.cancel is not None and self.cancel.is_set()):
+            # The items may have stopped early because of it
+            self.cancelled = True
+            self.abort.set()
+            return
+          self.forward(stage, [ END ], downstream)
+          return
+        stage.items += 1
+        if (not self.forward(stage, [ item ], downstream)):
+          return
+    except BaseException as e:
+      self.fail(e)
+
+  def process(self, number):
+    """ Run one of the later stages """
+    stage = self.stages[number]
+    downstream = self.stages[number + 1] if number + 1 < len(self.stages) else None
+    try:
+      while (True):
+        started = time.perf_counter()
+        item = self.get(stage)
+        with stage.lock:
+          stage.starved += time.perf_counter() - started
+        if (item is ABORT):
+          return
+
+        if (item is END):
+          with stage.lock:
+            stage.running -= 1
+            last = (stage.running == 0)
+          if (not last):
+            # Let the other workers of this stage see the end too
+            stage.queue.put(END)
+            return
+
+          started = time.perf_counter()
+          outputs = stage.finish() if stage.finish is not None else []
+          stage.busy += time.perf_counter() - started
+          self.forward(stage, outputs + [ END ], downstream)
+          return
+
+        started = time.perf_counter()
+        outputs = stage.work(item)
+        with stage.lock:
+          stage.items += 1
+          stage.busy += time.perf_counter() - started
+        if (not self.forward(stage, outputs, downstream)):
+          return
+    except BaseException as e:
+      self.fail(e)
+
+  def run(self, name, items):
+    """ Feed the items through every stage. Returns False if cancelled, raises whatever a stage raised. """
+    self.source = Stage(name, None, None, 0)
+    threads = [ threading.Thread(target=self.feed, args=(items,), name=name) ]
+    for i,stage in enumerate(self.stages):
+      for worker in range(stage.workers):
+        threads.append(threading.Thread(target=self.process, args=(i,), name=stage.name))
+
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    for stage in [ self.source ] + self.stages:
+      stage.report()
+
+    if (self.error is not None):
+      raise self.error
+    return not self.cancelled
+
+
+def card_images(template, card, served):
+  """ Filenames of the deck images a selected card will load """
+  if ("card" in card):
+    # Complex layout, images are named by the card's fields
+    content = served[(card["source"], card["card"])]
+    layout = template.layouts[card["layout"]]
+    names = []
+    for name,label in layout.imagelabels.items():
+      filename = label.static
+      if (filename is None):
+        filename = content.get(name, None)
+      if (filename is not None):
+        names.append(filename)
+    return names
+
+  names = []
+  for entry in card["images"]:
+    if ("static" in entry):
+      names.append(entry["static"])
+    else:
+      names.append(served[(entry["source"], entry["line"])])
+  return names
+
+def select_cards(template, content_gen):
+  """ Walk through the deck, fetching content and measuring texts to pick each card, without rendering any """
+  while (True):
+    with tracing.span("select card", "select"):
+      card = template.select_card(content_gen)
+    if (card is None):
+      return
+    yield (None, card, content_gen.take())
+
+
+def render_deck(template, index, cards, writer, first_sheet=0, fill_missing=False,
+                prefetch=8, depth=8, cancel=None, progress=None, coordinator=None):
+  """ Render cards onto sheets as a pipeline: select (content and layout), then
+      render, tile and write, each on its own thread.
+      cards yields (number, card, served) like select_cards, or with a number and
+      served=None for cards of a DeckIndex. Numbers are counted from 1 if they're None.
+      With a started Coordinator (see distributed.py), the cards are rendered by its workers instead.
+      If there's a memory governor, cards and sheets are accounted with it on their way through.
+      Returns (cards rendered, sheet filenames), or None if cancelled. """
+  replay = ReplayGenerator(index)
+
+  governor = memory.governor
+  face_size = memory.image_bytes(template.front)
+  if (writer.stream):
+    # The tiler needs a row of cards before it lets go of any
+    floor = COLUMNS * face_size
+  else:
+    floor = CARDS_PER_SHEET * face_size
+
+  def hold(size, floor=None):
+    if (governor is not None):
+      governor.reserve(size, floor, pipeline.abort)
+
+  def drop(size):
+    if (governor is not None and size > 0):
+      governor.release(size)
+
+  # Decodes the images of selected cards while they wait to be rendered
+  prefetcher = None
+  if (prefetch > 0 and coordinator is None):
+    prefetcher = Prefetcher(replay, lookahead=prefetch)
+
+  def selected(items):
+    for number, card, served in items:
+      if (prefetcher is not None and served is not None):
+        for filename in card_images(template, card, served):
+          if (not prefetcher.schedule(filename)): break
+      yield (number, card, served)
+
+  rendered = 0
+  attempted = 0
+  def render(item):
+    nonlocal attempted
+    number, card, served = item
+    attempted += 1
+    with tracing.span("card", card=number or attempted):
+      replay.queue(card, served)
+      face = template.render_card(card["layout"], replay)
+      replay.clear()
+    return collect((number, face))
+
+  def collect(item):
+    nonlocal rendered
+    number, face = item
+    if (number is None):
+      number = rendered + 1
+    if (face is None):
+      log.warning("index-mismatch", "Warning: Card %d did not render like it was indexed.", number)
+      if (not fill_missing):
+        return []
+      # Keep the rest of the cards in the slots a full render would use
+      face = template.front.copy()
+
+    rendered += 1
+    if (progress is not None): progress(rendered)
+
+    # Over budget, this waits for cards further down the pipeline to be written
+    hold(face_size, floor)
+    return [ (number, face) ]
+
+  serial = first_sheet
+  faces = []
+  numbers = []
+  def tile_sheet():
+    nonlocal serial, faces, numbers
+    serial += 1
+    filename, entry, changed = writer.describe(serial, faces, numbers)
+    img = None
+    if (changed):
+      img = writer.tile(faces)
+      hold(memory.image_bytes(img))
+    drop(len(faces) * face_size)
+    faces, numbers = [], []
+    return (filename, entry, img)
+
+  def tile(item):
+    number, face = item
+    faces.append(face)
+    numbers.append(number)
+    if (len(faces) < CARDS_PER_SHEET):
+      return []
+    return [ tile_sheet() ]
+
+  def tile_last():
+    if (len(faces) == 0):
+      return []
+    return [ tile_sheet() ]
+
+  # Streamed sheets: the tiler hands each completed row of cards to the encoder.
+  # The rows left once a sheet is complete are tiled by the encoder, one at a time.
+  sheet = None
+  streams = set()
+  next_row = object()
+  held = 0
+  def streamed(bands):
+    """ Account for the bands leaving the tiler, and the cards it no longer needs """
+    nonlocal held
+    for _, band in bands:
+      if (band is not None and band is not next_row):
+        hold(memory.image_bytes(band))
+    remaining = len(sheet.row) if sheet is not None else 0
+    drop((held - remaining) * face_size)
+    held = remaining
+    return bands
+
+  def close_stream():
+    nonlocal sheet
+    bands = [ (sheet, next_row) ] * (ROWS - sheet.rows) + [ (sheet, None) ]
+    sheet = None
+    return bands
+
+  def tile_streamed(item):
+    nonlocal serial, sheet, held
+    number, face = item
+    held += 1
+    if (sheet is None):
+      serial += 1
+      sheet = SheetStream(writer, serial)
+      streams.add(sheet)
+
+    bands = [ (sheet, band) for band in sheet.add(face, number) ]
+    if (len(sheet.digests) == CARDS_PER_SHEET):
+      bands += close_stream()
+    return streamed(bands)
+
+  def tile_streamed_last():
+    if (sheet is None):
+      return []
+    return streamed(close_stream())
+
+  def encode(item):
+    stream, band = item
+    if (band is next_row):
+      stream.encode(stream.band())
+    elif (band is not None):
+      stream.encode(band)
+      drop(memory.image_bytes(band))
+    else:
+      filenames.append(stream.finish())
+      streams.discard(stream)
+    return []
+
+  filenames = []
+  def write(item):
+    filename, entry, img = item
+    if (img is not None):
+      writer.save(filename, entry, img)
+      drop(memory.image_bytes(img))
+    filenames.append(filename)
+    return []
+
+  def write_manifest():
+    writer.finish()
+    return []
+
+  # Decoded deck images can be dropped to make room
+  if (governor is not None):
+    governor.register("decoded images", replay)
+
+  # The renderer may run up to --prefetch cards behind, so there's time to decode their images
+  pipeline = Pipeline(cancel)
+  if (coordinator is None):
+    source = ("select", selected(cards))
+    pipeline.stage("render", render, depth=max(depth, prefetch))
+  else:
+    # Rendered faces come back from the workers in deck order
+    source = ("workers", coordinator.results(cards, cancel))
+    pipeline.stage("collect", collect, depth=depth)
+  if (writer.stream):
+    # Bands have to be encoded in order, and only one is waiting at a time
+    pipeline.stage("tile", tile_streamed, tile_streamed_last, depth=depth)
+    pipeline.stage("write", encode, write_manifest, depth=1)
+  else:
+    pipeline.stage("tile", tile, tile_last, depth=depth)
+    # Encoding mostly runs outside the interpreter lock, so two sheets can be compressed at once
+    pipeline.stage("write", write, write_manifest, depth=2, workers=2)
+
+  try:
+    completed = pipeline.run(*source)
+  finally:
+    if (prefetcher is not None):
+      prefetcher.shutdown()
+    if (coordinator is not None):
+      # The workers may still be waiting for cards, after a cancel or an error
+      coordinator.close()
+    for stream in list(streams):
+      stream.discard()
+    if (governor is not None):
+      governor.unregister("decoded images")
+
+  if (not completed):
+    return None
+  return (rendered, sorted(filenames))
+
+
+#
+# Unit tests
+#
+class TestPipeline(unittest.TestCase):
+
+  def test_stages(self):
+    pipeline = Pipeline()
+    seen = []
+    pipeline.stage("double", lambda n: [ n, n ], depth=2)
+    pipeline.stage("sum", lambda n: [ n ] if n % 3 == 0 else [], lambda: [ -1 ], depth=1)
+    pipeline.stage("collect", lambda n: seen.append(n) or [])
+    self.assertTrue(pipeline.run("count", range(10)))
+    self.assertEqual(seen, [ 0, 0, 3, 3, 6, 6, 9, 9, -1 ])
+    self.assertEqual(pipeline.stages[0].items, 10)
+    self.assertTrue(pipeline.stages[1].depth_max <= 1)
+
+  def test_error(self):
+    def broken(n):
+      if (n == 5): raise ValueError("broken")
+      return [ n ]
+    pipeline = Pipeline()
+    pipeline.stage("broken", broken)
+    pipeline.stage("rest", lambda n: [])
+    self.assertRaises(ValueError, pipeline.run, "count", range(1000))
+
+  def test_cancel(self):
+    cancel = threading.Event()
+    def slow(n):
+      if (n == 3): cancel.set()
+      return []
+    pipeline = Pipeline(cancel)
+    pipeline.stage("slow", slow, depth=1)
+    self.assertFalse(pipeline.run("count", range(1000)))
+
+  def test_deck(self):
+    deck = tempfile.mkdtemp()
+    with open(os.path.join(deck, "images.txt"), "w", encoding="utf-8") as handle:
+      for i in range(CARDS_PER_SHEET + 3):
+        name = "img%d.png" % i
+        Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, name))
+        handle.write(name + "\n")
+    tmpl = CardTemplate({ "layouts": [ { "images": [ { "source": "images.txt", "x": 0, "y": 0 } ] } ] }, deck)
+
+    # The same sheets as rendering the cards one by one
+    faces = []
+    content_gen = RecordingGenerator(deck)
+    while (True):
+      face = tmpl.make_card(content_gen)
+      if (face is None): break
+      faces.append(face)
+
+    prefix = os.path.join(tempfile.mkdtemp(), "deck_")
+    writer = SheetWriter(prefix, tmpl.hidden)
+    content_gen = RecordingGenerator(deck)
+    count, filenames = render_deck(tmpl, content_gen, select_cards(tmpl, content_gen), writer, depth=2)
+    self.assertEqual(count, len(faces))
+    self.assertEqual(len(filenames), 2)
+
+    expected = writer.tile(faces[CARDS_PER_SHEET:])
+    self.assertEqual(Image.open(filenames[1]).tobytes(), expected.tobytes())
+
+    # Streamed a row at a time, the sheets hold the same pixels
+    writer = SheetWriter(prefix, tmpl.hidden, stream=True)
+    content_gen = RecordingGenerator(deck)
+    count, filenames = render_deck(tmpl, content_gen, select_cards(tmpl, content_gen), writer, depth=2)
+    self.assertEqual(writer.written, 2)
+    self.assertEqual(Image.open(filenames[1]).tobytes(), expected.tobytes())
+
+    # On a tight memory budget, everything accounted for is given back by the end
+    for stream in (False, True):
+      governor = memory.configure(1)
+      writer = SheetWriter(os.path.join(tempfile.mkdtemp(), "deck_"), tmpl.hidden, stream=stream)
+      content_gen = RecordingGenerator(deck)
+      count, filenames = render_deck(tmpl, content_gen, select_cards(tmpl, content_gen), writer, depth=2)
+      memory.disable()
+      self.assertEqual(Image.open(filenames[1]).tobytes(), expected.tobytes())
+      self.assertEqual(governor.in_flight, 0)
+      self.assertTrue(governor.waits > 0)
+
+  def test_broken_image(self):
+    deck = tempfile.mkdtemp()
+    cards = []
+    with open(os.path.join(deck, "images.txt"), "w", encoding="utf-8") as handle:
+      for i in range(4):
+        name = "img%d.png" % i
+        if (i == 1):
+          with open(os.path.join(deck, name), "wb") as image:
+            image.write(b"\x89PNG\r\n\x1a\n not really")
+        else:
+          Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, name))
+        handle.write(name + "\n")
+        cards.append({ "title": "Card %d" % i, "picture": name })
+    with open(os.path.join(deck, "cards.json"), "w", encoding="utf-8") as handle:
+      json.dump(cards, handle)
+
+    simple = CardTemplate({ "layouts": [ { "images": [ { "source": "images.txt", "x": 0, "y": 0 } ] } ] }, deck)
+    complex = CardTemplate({ "layouts": [ { "type": "complex", "source": "cards.json",
+                                            "texts": [ { "name": "title", "y": 20 } ],
+                                            "images": [ { "name": "picture" } ] } ] }, deck)
+
+    # A broken image ends a simple layout, and a complex one moves on to the next card,
+    # just like rendering the cards one by one does
+    for tmpl, count in [ (simple, 1), (complex, 3) ]:
+      faces = []
+      content_gen = RecordingGenerator(deck)
+      while (True):
+        face = tmpl.make_card(content_gen)
+        if (face is None): break
+        faces.append(face)
+      self.assertEqual(len(faces), count)
+
+      log.reset()
+      writer = SheetWriter(os.path.join(tempfile.mkdtemp(), "deck_"), tmpl.hidden)
+      content_gen = RecordingGenerator(deck)
+      rendered, filenames = render_deck(tmpl, content_gen, select_cards(tmpl, content_gen), writer)
+      self.assertEqual(rendered, count)
+      self.assertFalse("index-mismatch" in log.counters)
+      self.assertEqual([ c["card"] for c in writer.manifest()["sheets"][0]["cards"] ], list(range(1, count + 1)))
+      self.assertEqual(Image.open(filenames[0]).tobytes(), writer.tile(faces).tobytes())
+
+  def test_prefetch(self):
+    deck = tempfile.mkdtemp()
+    with open(os.path.join(deck, "images.txt"), "w", encoding="utf-8") as handle:
+      for i in range(20):
+        name = "img%d.png" % i
+        Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, name))
+        handle.write(name + "\n")
+    tmpl = CardTemplate({ "layouts": [ { "images": [ { "source": "images.txt", "x": 0, "y": 0 } ] } ] }, deck)
+
+    trace = os.path.join(tempfile.mkdtemp(), "trace.json")
+    tracing.configure(trace)
+    writer = SheetWriter(os.path.join(tempfile.mkdtemp(), "deck_"), tmpl.hidden)
+    content_gen = RecordingGenerator(deck)
+    render_deck(tmpl, content_gen, select_cards(tmpl, content_gen), writer)
+    tracing.close()
+
+    # Selecting only checks the images, they're decoded in the prefetcher's pool
+    with open(trace, "r", encoding="utf-8") as handle:
+      events = json.load(handle)["traceEvents"]
+    threads = { e["tid"]: e["args"]["name"] for e in events if e["ph"] == "M" }
+    decoders = [ threads[e["tid"]] for e in events if e["ph"] == "X" and e["name"] == "decode image" ]
+    self.assertTrue(len(decoders) >= 20)
+    self.assertFalse("select" in decoders)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+import unittest
+
+import os
+import json
+import hashlib
+import tempfile
+
+from PIL import Image
+
+import log
+import deckfiles
+import sqlsource
+import util
+from card import CardTemplate
+from content import ContentGenerator, TextLabel
+from deckindex import RecordingGenerator, pack_served, unpack_served
+from pipeline import select_cards
+
+
+# Bump this whenever selecting content (or the plan format) changes
+PLAN_VERSION = 4
+
+def label_signature(label):
+  """ The settings of a label which decide what fits on it. Colors and image placement don't. """
+  if (isinstance(label, TextLabel)):
+    # The font file the label actually uses (looked up when the template was compiled),
+    # since a fallback or an updated font has different metrics
+    font = [ label.fontface, None ]
+    if (label.fontfile is not None):
+      font = [ label.fontface ] + list(label.font_id())
+    return [ "text", label.name, label.source, label.static, font, label.fontweight,
+             label.fontsize, label.minsize, label.spacing, label.wordwrap, label.justify, label.rasterizer,
+             label.x, label.y, label.width, label.height, label.x_align, label.y_align, label.rotation ]
+
+  # Images only have to exist
+  return [ "image", label.name, label.source, label.static ]
+
+def template_signature(template):
+  """ Everything about a template that content selection depends on """
+  layouts = []
+  for layout in template.layouts:
+    texts = layout.textlabels
+    images = layout.imagelabels
+    source = None
+    if (isinstance(texts, dict)):
+      # Complex layout
+      source = layout.source
+      texts = list(texts.values())
+      images = list(images.values())
+    layouts.append([ layout.type, source,
+                     [ label_signature(l) for l in texts ],
+                     [ label_signature(l) for l in images ] ])
+  return [ PLAN_VERSION, template.scale, template.front.size, layouts ]
+
+def source_file(source):
+  """ The deck file a text, JSON or query source reads """
+  if (sqlsource.is_query(source)):
+    source = sqlsource.split_source(source)[0]
+  return source
+
+
+class CardPlan:
+  """ The layout and content of every card of a deck, as picked by the template's fit checks,
+      with nothing rendered. It can be saved, and rendered (see pipeline.render_deck)
+      as often as the template's styling changes. """
+
+  def __init__(self):
+    # (card, served) in deck order, like CardTemplate.select_card and RecordingGenerator.take
+    self.cards = []
+
+    # Stamps of the deck files the content came from
+    self.sources = []
+
+    # Image filename -> [ whether it loaded, its stamp... ]
+    self.images = {}
+
+  def record(self, cards):
+    """ Pass cards (as yielded by select_cards) through, adding each to the plan """
+    for number, card, served in cards:
+      self.cards.append((card, served))
+      yield (number, card, served)
+
+  def finish(self, content_gen):
+    """ Note which deck files the plan depends on, once the RecordingGenerator has gone through the deck """
+    files = set()
+    for source in list(content_gen.loaded_texts) + list(content_gen.loaded_json):
+      files.add(source_file(source))
+    self.sources = [ content_gen.files.stamp(filename) for filename in sorted(files) ]
+    self.images = { filename: [ found ] + list(content_gen.files.stamp(filename)[1:])
+                    for filename, found in content_gen.images.items() }
+
+  def items(self):
+    """ The planned cards, like select_cards yields them """
+    for card, served in self.cards:
+      yield (None, card, served)
+
+  def current(self, directory):
+    """ Is the deck still the one this plan was made for? """
+    files = deckfiles.open_deck(directory)
+    for entry in self.sources:
+      if (files.stamp(entry[0]) != tuple(entry)):
+        log.debug("plan", "%s has changed, planning the deck again", entry[0])
+        return False
+
+    checker = None
+    for filename, entry in self.images.items():
+      if (list(files.stamp(filename)[1:]) == entry[1:]):
+        continue
+      # Only an image which now loads when it didn't (or the other way around) changes the cards
+      if (checker is None):
+        checker = ContentGenerator(directory)
+      if (checker.has_image(filename) != entry[0]):
+        log.debug("plan", "%s has been added, removed or broken, planning the deck again", filename)
+        return False
+
+    return True
+
+  def to_json(self):
+    return {
+      "version": PLAN_VERSION,
+      "sources": self.sources,
+      "images": self.images,
+      "cards": [ [ card, pack_served(served) ] for card, served in self.cards ]
+    }
+
+  @staticmethod
+  def from_json(entry):
+    plan = CardPlan()
+    plan.sources = entry["sources"]
+    plan.images = entry["images"]
+    plan.cards = [ (card, unpack_served(served)) for card, served in entry["cards"] ]
+    return plan
+
+
+class PlanCache:
+  """ Stores card plans between runs, by what the content of each card depends on """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def key(self, template, deck):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(template_signature(template)).encode("utf-8"))
+    digest.update(os.path.abspath(deck).encode("utf-8"))
+    digest.update(json.dumps(sorted(sqlsource.parameters.items())).encode("utf-8"))
+    return digest.hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.directory, "plans", key + ".json")
+
+  def load(self, key, deck):
+    """ A plan for the deck, if there is one and the deck hasn't changed since """
+    try:
+      with open(self.path(key), "r", encoding="utf-8") as handle:
+        entry = json.load(handle)
+      if (entry.get("version") != PLAN_VERSION):
+        return None
+      plan = CardPlan.from_json(entry)
+    except (OSError, ValueError, KeyError, TypeError):
+      return None
+
+    if (not plan.current(deck)):
+      return None
+    return plan
+
+  def store(self, key, plan):
+    try:
+      data = json.dumps(plan.to_json()).encode("utf-8")
+      util.write_replacing(self.path(key), lambda handle: handle.write(data))
+    except (OSError, TypeError, ValueError) as e:
+      log.debug("plan", "Unable to save the card plan: %s", e)
+
+
+#
+# Unit tests
+#
+class TestPlan(unittest.TestCase):
+
+  def make_deck(self):
+    deck = tempfile.mkdtemp()
+    Image.new("RGBA", (8, 8), (255, 0, 0, 255)).save(os.path.join(deck, "icon.png"))
+    with open(os.path.join(deck, "text.txt"), "w", encoding="utf-8") as handle:
+      handle.write("One\nTwo\nThree\n")
+    return deck
+
+  def spec(self, color="#000000", size=10):
+    return { "layouts": [ { "texts": [ { "source": "text.txt", "font-size": size, "color": color } ],
+                            "images": [ { "static": "icon.png", "x": 3 } ] } ] }
+
+  def test_plan(self):
+    deck = self.make_deck()
+    cache = PlanCache(tempfile.mkdtemp())
+    tmpl = CardTemplate(self.spec(), deck)
+    key = cache.key(tmpl, deck)
+
+    content_gen = RecordingGenerator(deck)
+    plan = CardPlan()
+    self.assertEqual(len(list(plan.record(select_cards(tmpl, content_gen)))), 3)
+    plan.finish(content_gen)
+    cache.store(key, plan)
+
+    loaded = cache.load(key, deck)
+    self.assertEqual([ served for _, _, served in loaded.items() ], [ served for _, served in plan.cards ])
+    self.assertEqual(loaded.images["icon.png"][0], True)
+
+    # Only the styling changed, so the plan still holds. Fonts aren't opened to tell.
+    restyled = CardTemplate(self.spec(color="#ff0000"), deck)
+    self.assertEqual(cache.key(restyled, deck), key)
+    self.assertEqual(restyled.layouts[0].textlabels[0]._font, None)
+
+    # But the same font face from another file needs a new plan
+    font = os.path.join(deck, "font.ttf")
+    with open(font, "wb") as handle:
+      handle.write(b"a font")
+    refonted = CardTemplate(self.spec(), deck)
+    refonted.layouts[0].textlabels[0]._fontfile = font
+    refonted.layouts[0].textlabels[0]._font_located = True
+    self.assertNotEqual(cache.key(refonted, deck), key)
+    self.assertNotEqual(cache.key(CardTemplate(self.spec(size=12), deck), deck), key)
+
+    # New artwork doesn't change the cards, but artwork which doesn't load does
+    Image.new("RGBA", (8, 8), (0, 0, 255, 255)).save(os.path.join(deck, "icon.png"))
+    self.assertNotEqual(cache.load(key, deck), None)
+    with open(os.path.join(deck, "icon.png"), "wb") as handle:
+      handle.write(b"not an image")
+    self.assertEqual(cache.load(key, deck), None)
+
+    # A different deck needs a new plan
+    with open(os.path.join(deck, "text.txt"), "a", encoding="utf-8") as handle:
+      handle.write("Four\n")
+    self.assertEqual(cache.load(key, deck), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
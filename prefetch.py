@@ -0,0 +1,139 @@
+import unittest
+
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from content import ContentGenerator
+from layout import SimpleLayout
+
+
+class Prefetcher:
+  """ Decodes the images of upcoming cards on a thread pool, so the renderer doesn't have to wait for them """
+
+  def __init__(self, content_gen, lookahead=8, workers=4, max_pending=32):
+    self.content_gen = content_gen
+    self.lookahead = lookahead
+    self.max_pending = max_pending
+
+    self.pool = ThreadPoolExecutor(max_workers=workers)
+    self.lock = threading.Lock()
+
+    # filename -> Future, for images that are queued or being decoded
+    self.pending = {}
+
+    content_gen.prefetcher = self
+
+  def schedule(self, filename):
+    """ Queue an image for decoding. Returns False if the queue is full. """
+    with self.lock:
+      if (filename in self.pending):
+        return True
+
+      with self.content_gen.image_lock:
+        if (filename in self.content_gen.loaded_images):
+          return True
+
+      # Bounded queue. Anything we drop now will be scheduled again
+      # on a later look-ahead, once the decoders have caught up.
+      if (len(self.pending) >= self.max_pending):
+        return False
+
+      future = self.pool.submit(self.content_gen.decode_image, filename)
+      self.pending[filename] = future
+
+    future.add_done_callback(lambda f: self.forget(filename))
+    return True
+
+  def forget(self, filename):
+    with self.lock:
+      self.pending.pop(filename, None)
+
+  def wait(self, filename):
+    """ If an image is being prefetched, wait for it to finish. Returns None otherwise. """
+    with self.lock:
+      future = self.pending.get(filename, None)
+
+    if (future is None):
+      return None
+    return future.result()
+
+  def look_ahead(self, layouts):
+    """ Schedule the images which the next few cards of each layout will need """
+    for layout in layouts:
+      try:
+        names = layout.upcoming_images(self.content_gen, self.lookahead)
+      except (OSError, ValueError):
+        # Missing or broken deck files are reported by the renderer, not here.
+        continue
+
+      for filename in names:
+        if (not self.schedule(filename)): return
+
+  def shutdown(self):
+    self.pool.shutdown(wait=True)
+    self.content_gen.prefetcher = None
+
+
+#
+# Unit tests
+#
+class TestPrefetch(unittest.TestCase):
+
+  def make_deck(self, count):
+    deck = tempfile.mkdtemp()
+    with open(os.path.join(deck, "images.txt"), "w") as handle:
+      for i in range(count):
+        name = "img%d.png" % i
+        Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, name))
+        handle.write(name + "\n")
+    return deck
+
+  def test_peek(self):
+    deck = self.make_deck(5)
+    gen = ContentGenerator(deck)
+
+    self.assertEqual(gen.peek_text_simple("images.txt", 2), ["img0.png", "img1.png"])
+    self.assertEqual(gen.gen_text_simple("images.txt"), "img0.png")
+    self.assertEqual(gen.peek_text_simple("images.txt", 10), ["img1.png", "img2.png", "img3.png", "img4.png"])
+    for i in range(1, 5):
+      self.assertEqual(gen.gen_text_simple("images.txt"), "img%d.png" % i)
+    self.assertEqual(gen.gen_text_simple("images.txt"), None)
+    self.assertEqual(gen.peek_text_simple("images.txt", 3), [])
+
+  def test_prefetch(self):
+    deck = self.make_deck(6)
+    gen = ContentGenerator(deck)
+    layouts = [ SimpleLayout({ "images": [ { "source": "images.txt" } ] }, deck) ]
+
+    # Hold the decoders back until we've looked at the queue
+    gate = threading.Event()
+    decode = gen.decode_image
+    gen.decode_image = lambda filename: gate.wait() and decode(filename)
+
+    prefetcher = Prefetcher(gen, lookahead=4, workers=2, max_pending=3)
+    prefetcher.look_ahead(layouts)
+
+    # Only as many as the queue allows
+    self.assertEqual(len(prefetcher.pending), 3)
+
+    gate.set()
+    prefetcher.pool.shutdown(wait=True)
+    self.assertEqual(len(gen.loaded_images), 3)
+
+    prefetcher.pool = ThreadPoolExecutor(max_workers=2)
+    for i in range(6):
+      prefetcher.look_ahead(layouts)
+      image = gen.gen_image_simple("images.txt")
+      self.assertEqual(image.getpixel((0, 0)), (i, 0, 0, 255))
+
+    prefetcher.shutdown()
+    self.assertEqual(gen.prefetcher, None)
+    self.assertEqual(gen.gen_image_simple("images.txt"), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
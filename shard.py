@@ -0,0 +1,234 @@
+import unittest
+
+import os
+import glob
+import json
+import hashlib
+import tempfile
+
+import log
+import sqlsource
+from tiler import CARDS_PER_SHEET
+
+
+def parse_shard(spec):
+  """ Parse a shard specification like "2/5" into (shard, shards), numbered from 1 """
+  try:
+    shard, shards = spec.split("/")
+    shard, shards = int(shard), int(shards)
+  except ValueError:
+    raise ValueError("Shards are specified as i/N, e.g. 2/5")
+
+  if (shards < 1 or shard < 1 or shard > shards):
+    raise ValueError("Invalid shard %s" % spec)
+
+  return (shard, shards)
+
+def sheet_count(total_cards):
+  """ How many sheets a deck of the given size is tiled into """
+  return (total_cards + CARDS_PER_SHEET - 1) // CARDS_PER_SHEET
+
+def shard_sheets(shard, total_cards):
+  """ The contiguous range of sheets (0-based, end exclusive) rendered by a shard """
+  number, shards = shard
+  sheets = sheet_count(total_cards)
+  first = (number - 1) * sheets // shards
+  end = number * sheets // shards
+  return (first, end)
+
+def shard_cards(shard, total_cards):
+  """ The card numbers (1-based) which end up on a shard's sheets """
+  first, end = shard_sheets(shard, total_cards)
+  return list(range(first * CARDS_PER_SHEET + 1,
+                    min(end * CARDS_PER_SHEET, total_cards) + 1))
+
+def deck_fingerprint(spec, index, scale=1.0):
+  """ A hash identifying the template and deck contents, which all shards must agree on """
+  digest = hashlib.sha256()
+  digest.update(json.dumps(spec, sort_keys=True).encode("utf-8"))
+  digest.update(json.dumps(index.cards, sort_keys=True).encode("utf-8"))
+  digest.update(repr(scale).encode("utf-8"))
+
+  for filename in index.sources:
+    digest.update(filename.encode("utf-8"))
+    if (sqlsource.is_query(filename)):
+      # The rows a database query returned
+      rows = index.lines.get(filename, index.json.get(filename, None))
+      digest.update(json.dumps(rows, sort_keys=True).encode("utf-8"))
+    else:
+      digest.update(index.files.read(filename))
+
+  return digest.hexdigest()
+
+def manifest_name(output_prefix, shard):
+  return "%sshard%dof%d.json" % (output_prefix, shard[0], shard[1])
+
+def write_manifest(output_prefix, shard, total_cards, fingerprint, filenames):
+  """ Record what a shard rendered, so the merged output can be checked """
+  first, end = shard_sheets(shard, total_cards)
+
+  sheets = []
+  for serial, filename in zip(range(first + 1, end + 1), filenames):
+    sheets.append({
+      "serial": serial,
+      "filename": os.path.basename(filename),
+      "first-card": (serial - 1) * CARDS_PER_SHEET + 1,
+      "last-card": min(serial * CARDS_PER_SHEET, total_cards)
+    })
+
+  manifest = {
+    "shard": shard[0],
+    "shards": shard[1],
+    "fingerprint": fingerprint,
+    "total-cards": total_cards,
+    "total-sheets": sheet_count(total_cards),
+    "sheets": sheets
+  }
+
+  path = manifest_name(output_prefix, shard)
+  with open(path, "w", encoding="utf-8") as handle:
+    json.dump(manifest, handle, indent=2)
+  return path
+
+def read_manifest(path):
+  """ Load a shard manifest, checking it has everything check_manifests looks at """
+  with open(path, "r", encoding="utf-8") as handle:
+    manifest = json.load(handle)
+
+  if (not isinstance(manifest, dict)):
+    raise ValueError("not a shard manifest")
+  for key in [ "shard", "shards", "fingerprint", "total-cards", "total-sheets", "sheets" ]:
+    if (key not in manifest):
+      raise KeyError(key)
+  if (not isinstance(manifest["sheets"], list)):
+    raise ValueError("sheets is not a list")
+  for sheet in manifest["sheets"]:
+    for key in [ "serial", "filename" ]:
+      if (not isinstance(sheet, dict) or key not in sheet):
+        raise KeyError("sheets/" + key)
+  return manifest
+
+def check_manifests(output_prefix):
+  """ Verify that the shards of a render add up to the complete deck. Returns 0 on success. """
+  paths = sorted(glob.glob(glob.escape(output_prefix) + "shard*of*.json"))
+  if (len(paths) == 0):
+    log.error("shards", "No shard manifests found for %s", output_prefix)
+    return 1
+
+  errors = 0
+  manifests = []
+  for path in paths:
+    try:
+      manifests.append(read_manifest(path))
+    except OSError as e:
+      log.error("shards", "Unable to read shard manifest %s: %s", path, e)
+      errors += 1
+    except ValueError as e:
+      log.error("shards", "JSON error in shard manifest %s: %s", path, e)
+      errors += 1
+    except KeyError as e:
+      log.error("shards", "Shard manifest %s is incomplete, no %s", path, e)
+      errors += 1
+
+  if (len(manifests) == 0):
+    return 1
+  reference = manifests[0]
+
+  shards = set()
+  for m in manifests:
+    for key in [ "shards", "fingerprint", "total-cards" ]:
+      if (m[key] != reference[key]):
+        log.error("shards", "Shard %d disagrees with shard %d on %s", m["shard"], reference["shard"], key)
+        errors += 1
+    shards.add(m["shard"])
+
+  missing = set(range(1, reference["shards"] + 1)) - shards
+  for number in sorted(missing):
+    log.error("shards", "Missing manifest for shard %d of %d", number, reference["shards"])
+    errors += 1
+
+  # Every sheet must be rendered exactly once, and actually be there
+  serials = []
+  directory = os.path.dirname(output_prefix)
+  for m in manifests:
+    for sheet in m["sheets"]:
+      serials.append(sheet["serial"])
+      if (not os.path.isfile(os.path.join(directory, sheet["filename"]))):
+        log.error("shards", "Missing sheet %s", sheet["filename"])
+        errors += 1
+
+  if (sorted(serials) != list(range(1, reference["total-sheets"] + 1))):
+    log.error("shards", "Shards cover sheets %s, expected 1-%d", sorted(serials), reference["total-sheets"])
+    errors += 1
+
+  if (errors > 0):
+    return 1
+
+  log.info("shards", "All %d shards present, %d sheets with %d cards.",
+           reference["shards"], reference["total-sheets"], reference["total-cards"])
+  return 0
+
+
+#
+# Unit tests
+#
+class TestShard(unittest.TestCase):
+
+  def test_parse(self):
+    self.assertEqual(parse_shard("1/1"), (1, 1))
+    self.assertEqual(parse_shard("3/4"), (3, 4))
+    self.assertRaises(ValueError, parse_shard, "0/4")
+    self.assertRaises(ValueError, parse_shard, "5/4")
+    self.assertRaises(ValueError, parse_shard, "2")
+
+  def test_partition(self):
+    for total in [ 1, 68, 69, 70, 500, 1403 ]:
+      for shards in [ 1, 2, 3, 7, 10 ]:
+        cards = []
+        for number in range(1, shards + 1):
+          first, end = shard_sheets((number, shards), total)
+          these = shard_cards((number, shards), total)
+          if (len(these) > 0):
+            # Shards always start on a fresh sheet
+            self.assertEqual(these[0], first * CARDS_PER_SHEET + 1)
+          cards += these
+        self.assertEqual(cards, list(range(1, total + 1)))
+
+  def test_manifest(self):
+    directory = tempfile.mkdtemp()
+    prefix = os.path.join(directory, "deck_")
+    total = 3 * CARDS_PER_SHEET + 1
+
+    self.assertEqual(check_manifests(prefix), 1)
+
+    for number in [ 1, 2 ]:
+      shard = (number, 2)
+      first, end = shard_sheets(shard, total)
+      filenames = []
+      for serial in range(first + 1, end + 1):
+        filenames.append(prefix + str(serial).zfill(2) + ".png")
+        open(filenames[-1], "wb").close()
+      write_manifest(prefix, shard, total, "abc", filenames)
+
+      # Half done is not done
+      if (number == 1):
+        self.assertEqual(check_manifests(prefix), 1)
+
+    self.assertEqual(check_manifests(prefix), 0)
+
+    os.remove(prefix + "03.png")
+    self.assertEqual(check_manifests(prefix), 1)
+    open(prefix + "03.png", "wb").close()
+
+    # Broken manifests are errors, not crashes
+    path = manifest_name(prefix, (2, 2))
+    with open(path, "r", encoding="utf-8") as handle:
+      manifest = json.load(handle)
+    for broken in [ "{", json.dumps(dict(manifest, sheets=[ {} ])), json.dumps({ "shard": 2 }), "[]", "3" ]:
+      with open(path, "w", encoding="utf-8") as handle:
+        handle.write(broken)
+      self.assertEqual(check_manifests(prefix), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,528 @@
+import unittest
+
+import os
+import json
+import zlib
+import struct
+import hashlib
+import tempfile
+import threading
+
+from PIL import Image, ImageChops
+
+import log
+import tracing
+from tiler import COLUMNS, ROWS, CARDS_PER_SHEET, CardTiler
+
+
+# Bump this whenever the way sheets are tiled or encoded changes
+SHEET_VERSION = 1
+
+# mkstemp makes files only their owner can read. Streamed sheets get the mode
+# any other file would, read from the umask once, while there's only one thread.
+_umask = os.umask(0o022)
+os.umask(_umask)
+SHEET_MODE = 0o666 & ~_umask
+
+def image_digest(image):
+  """ A hash of the pixels of an image """
+  digest = hashlib.sha256()
+  digest.update(repr((image.mode, image.size)).encode("utf-8"))
+  digest.update(image.tobytes())
+  return digest.hexdigest()
+
+def sheet_digest(card_digests, hidden_digest, encoding=""):
+  """ A hash of everything that goes into a sheet, known before it is tiled or encoded """
+  digest = hashlib.sha256()
+  digest.update(repr((SHEET_VERSION, COLUMNS, ROWS, encoding)).encode("utf-8"))
+  digest.update(hidden_digest.encode("utf-8"))
+  for card in card_digests:
+    digest.update(card.encode("utf-8"))
+  return digest.hexdigest()
+
+def optimize_sheet(img, colors=None):
+  """ Convert a sheet to the smallest image mode that holds it without loss,
+      or quantize it to a palette of the given number of colors. Returns (image, description). """
+  if (colors is not None):
+    return (img.quantize(colors, method=Image.FASTOCTREE), "P, quantized to %d colors" % colors)
+
+  used = img.getcolors(256)
+  if (used is None):
+    return (img, "RGB")
+
+  if (all([ c[0] == c[1] == c[2] for _,c in used ])):
+    return (img.convert("L"), "L, %d shades" % len(used))
+
+  # Not every quantizer reproduces every color exactly, so check before trusting it
+  paletted = img.quantize(len(used), method=Image.MAXCOVERAGE, dither=Image.NONE)
+  if (ImageChops.difference(paletted.convert("RGB"), img).getbbox() is None):
+    return (paletted, "P, %d colors" % len(used))
+
+  return (img, "RGB")
+
+PNG_COLOR_TYPES = { "L": 0, "RGB": 2, "RGBA": 6 }
+
+def filter_cost(img):
+  """ How well filtered rows will compress, by the sum of their bytes taken as signed (as libpng does) """
+  histogram = img.histogram()
+  return sum([ count * min(i % 256, 256 - i % 256) for i,count in enumerate(histogram) ])
+
+class PngStream:
+  """ Encodes a PNG image a band of rows at a time, so the whole image is never in memory """
+
+  # Rows filtered and compressed together
+  CHUNK_ROWS = 64
+
+  # Size of the IDAT chunks written
+  IDAT_BYTES = 1 << 18
+
+  def __init__(self, handle, size, mode="RGB", compress_level=6):
+    self.handle = handle
+    self.size = size
+    self.mode = mode
+    self.rows = 0
+
+    # The last row written, for the Up filter
+    self.previous = Image.new(mode, (size[0], 1))
+
+    self.compressor = zlib.compressobj(compress_level)
+    self.pending = []
+    self.pending_bytes = 0
+
+    handle.write(b"\x89PNG\r\n\x1a\n")
+    self.chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, PNG_COLOR_TYPES[mode], 0, 0, 0))
+
+  def chunk(self, kind, data):
+    self.handle.write(struct.pack(">I", len(data)))
+    self.handle.write(kind)
+    self.handle.write(data)
+    self.handle.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+  def compressed(self, data):
+    self.pending.append(data)
+    self.pending_bytes += len(data)
+    if (self.pending_bytes >= self.IDAT_BYTES):
+      self.chunk(b"IDAT", b"".join(self.pending))
+      self.pending = []
+      self.pending_bytes = 0
+
+  def write(self, band):
+    """ Encode the next rows of the image """
+    for top in range(0, band.height, self.CHUNK_ROWS):
+      self.write_rows(band.crop((0, top, band.width, min(top + self.CHUNK_ROWS, band.height))))
+
+  def write_rows(self, rows):
+    # Either no filter or Up (each byte minus the one above), whichever looks like it compresses better.
+    # Both are computed on whole images, so no per-byte work is done in Python.
+    above = Image.new(self.mode, rows.size)
+    above.paste(self.previous, (0, 0))
+    above.paste(rows.crop((0, 0, rows.width, rows.height - 1)), (0, 1))
+    up = ImageChops.subtract_modulo(rows, above)
+
+    filtered, kind = (rows, b"\x00")
+    if (filter_cost(up) < filter_cost(rows)):
+      filtered, kind = (up, b"\x02")
+
+    raw = filtered.tobytes()
+    stride = len(raw) // rows.height
+    data = b"".join([ kind + raw[i * stride:(i + 1) * stride] for i in range(rows.height) ])
+    self.compressed(self.compressor.compress(data))
+
+    self.previous = rows.crop((0, rows.height - 1, rows.width, rows.height))
+    self.rows += rows.height
+
+  def finish(self):
+    if (self.rows != self.size[1]):
+      raise ValueError("PNG stream got %d rows, expected %d" % (self.rows, self.size[1]))
+    self.compressed(self.compressor.flush())
+    if (self.pending_bytes > 0):
+      self.chunk(b"IDAT", b"".join(self.pending))
+    self.chunk(b"IEND", b"")
+
+def manifest_name(output_prefix):
+  return output_prefix + "manifest.json"
+
+def load_manifest(output_prefix):
+  """ The sheets written by an earlier run with the same prefix, by filename """
+  try:
+    with open(manifest_name(output_prefix), "r", encoding="utf-8") as handle:
+      manifest = json.load(handle)
+  except (OSError, ValueError):
+    return {}
+
+  return { sheet["filename"]: sheet for sheet in manifest.get("sheets", []) }
+
+def unchanged(previous, entry, directory):
+  """ Is the sheet described by entry already on disk, exactly as an earlier run wrote it? """
+  old = previous.get(entry["filename"], None)
+  if (old is None or old["hash"] != entry["hash"]):
+    return False
+
+  try:
+    return os.path.getsize(os.path.join(directory, entry["filename"])) == old["bytes"]
+  except OSError:
+    return False
+
+
+class SheetWriter:
+  """ Tiles and saves sheets, skipping the ones that are identical to the previous run's """
+
+  def __init__(self, output_prefix, hidden, encoding="png", merge=False, optimize=False, quantize=None, stream=False):
+    self.output_prefix = output_prefix
+    self.directory = os.path.dirname(output_prefix)
+    self.hidden = hidden
+    self.hidden_digest = image_digest(hidden)
+    self.encoding = encoding
+    self.tiler = CardTiler()
+
+    # Output mode optimization. The settings are part of each sheet's hash.
+    self.optimize = optimize or quantize is not None
+    self.quantize = quantize
+    self.settings = encoding
+    if (self.optimize):
+      self.settings += ":optimize:%s" % quantize
+
+    # Sheets are tiled and encoded a row of cards at a time, see SheetStream
+    self.stream = stream
+    if (stream):
+      self.settings += ":stream"
+
+    # Uncompressed size of the sheets, as tiled and as written
+    self.raw_bytes = 0
+    self.optimized_bytes = 0
+
+    self.previous = self.load_previous()
+
+    # A partial render (shard) only replaces its own sheets in the manifest
+    self.sheets = {}
+    if (merge):
+      self.sheets = dict(self.previous)
+
+    self.written = 0
+    self.skipped = 0
+
+    # Sheets may be saved on several threads at once
+    self.lock = threading.Lock()
+
+  def load_previous(self):
+    """ The sheets of the last run, as recorded in its manifest """
+    return load_manifest(self.output_prefix)
+
+  def filename(self, serial):
+    return self.output_prefix + str(serial).zfill(2) + "." + self.encoding
+
+  def describe(self, serial, faces, numbers):
+    """ The manifest entry of a sheet, from its cards alone. Returns (filename, entry, changed).
+        A sheet that hasn't changed since the last run is recorded as it is. """
+    return self.describe_digests(serial, [ image_digest(face) for face in faces ], numbers)
+
+  def describe_digests(self, serial, digests, numbers):
+    filename = self.filename(serial)
+    entry = {
+      "serial": serial,
+      "filename": os.path.basename(filename),
+      "hash": sheet_digest(digests, self.hidden_digest, self.settings),
+      "cards": [ { "slot": i, "card": n, "hash": d } for i,(n,d) in enumerate(zip(numbers, digests)) ]
+    }
+
+    if (not unchanged(self.previous, entry, self.directory)):
+      return (filename, entry, True)
+
+    old = self.previous[entry["filename"]]
+    for key in [ "width", "height", "bytes", "mode" ]:
+      entry[key] = old.get(key, None)
+    with self.lock:
+      self.skipped += 1
+      self.sheets[entry["filename"]] = entry
+    return (filename, entry, False)
+
+  def tile(self, faces):
+    with tracing.span("tile sheet", "tile"):
+      return self.tiler.tile(list(faces), self.hidden)[0]
+
+  def save(self, filename, entry, img):
+    """ Encode and write a tiled sheet """
+    raw = len(img.getbands()) * img.width * img.height
+    with tracing.span("encode sheet", "write", sheet=entry["filename"]):
+      if (self.optimize):
+        img, description = optimize_sheet(img, self.quantize)
+        log.debug("sheets", "%s: %s", entry["filename"], description)
+      length = self.store(filename, entry, img)
+
+    if (self.optimize):
+      with self.lock:
+        self.raw_bytes += raw
+        self.optimized_bytes += len(img.getbands()) * img.width * img.height
+    self.record(entry, img.mode, img.size, length)
+
+  def store(self, filename, entry, img):
+    """ Encode a tiled sheet where it belongs. Returns its size in bytes. """
+    img.save(filename)
+    return os.path.getsize(filename)
+
+  def place(self, temporary, filename, entry, mode, size):
+    """ Put a streamed sheet, encoded into a temporary file, where it belongs """
+    os.replace(temporary, filename)
+    self.record(entry, mode, size, os.path.getsize(filename))
+
+  def record(self, entry, mode, size, length):
+    """ Add a sheet which was just written to the manifest """
+    entry["mode"] = mode
+    entry["width"], entry["height"] = size
+    entry["bytes"] = length
+
+    with self.lock:
+      self.written += 1
+      self.sheets[entry["filename"]] = entry
+
+  def write(self, serial, faces, numbers):
+    """ Write one sheet, unless it hasn't changed. Returns the filename. """
+    filename, entry, changed = self.describe(serial, faces, numbers)
+    if (changed):
+      self.save(filename, entry, self.tile(faces))
+    return filename
+
+  def manifest(self):
+    """ The manifest of all the sheets """
+    return {
+      "version": SHEET_VERSION,
+      "card-width": self.hidden.width,
+      "card-height": self.hidden.height,
+      "sheets": sorted(self.sheets.values(), key=lambda s: s["serial"])
+    }
+
+  def finish(self):
+    """ Write the manifest of all the sheets """
+    path = manifest_name(self.output_prefix)
+    with open(path, "w", encoding="utf-8") as handle:
+      json.dump(self.manifest(), handle, indent=2)
+    self.report()
+    return path
+
+  def report(self):
+    if (self.raw_bytes > 0):
+      log.info("progress", "Optimized sheets hold %.1f MB of pixels instead of %.1f MB (%d%% smaller).",
+               self.optimized_bytes / 1e6, self.raw_bytes / 1e6,
+               round(100 * (1 - self.optimized_bytes / self.raw_bytes)))
+
+    if (self.skipped > 0):
+      log.info("progress", "%d sheets unchanged since the last run, %d written.", self.skipped, self.written)
+
+
+class SheetStream:
+  """ Tiles and encodes one sheet a row of cards at a time, so only a single row of it
+      is ever in memory. It's written to a temporary file, which replaces the sheet only if
+      the sheet changed. Cards go in with add(), and each band that returns goes to encode(). """
+
+  def __init__(self, writer, serial):
+    self.writer = writer
+    self.serial = serial
+    self.filename = writer.filename(serial)
+    self.size = (COLUMNS * writer.hidden.width, ROWS * writer.hidden.height)
+
+    self.digests = []
+    self.numbers = []
+    self.row = []
+    self.rows = 0
+
+    # A temporary file of its own, so runs sharing a prefix don't write into each other's
+    directory = os.path.dirname(self.filename) or "."
+    fd, self.temporary = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.filename) + ".", suffix=".tmp")
+    os.chmod(self.temporary, SHEET_MODE)
+    self.handle = os.fdopen(fd, "wb")
+    self.png = PngStream(self.handle, self.size)
+
+  def band(self):
+    with tracing.span("tile row", "tile", sheet=self.serial, row=self.rows):
+      band = self.writer.tiler.tile_band(self.row, self.rows, self.writer.hidden)
+    self.row = []
+    self.rows += 1
+    return band
+
+  def add(self, face, number):
+    """ Add the next card. Returns the band of the row it completed, if any. """
+    self.digests.append(image_digest(face))
+    self.numbers.append(number)
+    self.row.append(face)
+    if (len(self.row) < COLUMNS):
+      return []
+    return [ self.band() ]
+
+  def last_bands(self):
+    """ The rest of the rows, once all the cards are added. Each one is tiled as it's asked for. """
+    while (self.rows < ROWS):
+      yield self.band()
+
+  def encode(self, band):
+    with tracing.span("encode row", "write", sheet=self.serial):
+      self.png.write(band)
+
+  def finish(self):
+    """ Complete the sheet, once every band is encoded. Returns the filename. """
+    try:
+      self.png.finish()
+      self.handle.close()
+
+      filename, entry, changed = self.writer.describe_digests(self.serial, self.digests, self.numbers)
+      if (changed):
+        self.writer.place(self.temporary, filename, entry, self.png.mode, self.size)
+      else:
+        os.remove(self.temporary)
+    except BaseException:
+      self.discard()
+      raise
+    return filename
+
+  def discard(self):
+    """ Give up on an unfinished sheet """
+    self.handle.close()
+    try:
+      os.remove(self.temporary)
+    except OSError:
+      pass
+
+
+def write_sheets(writer, faces, numbers, first_sheet=0):
+  """ Split the cards into sheets and write them all. Returns the filenames. """
+  filenames = []
+  if (writer.stream):
+    for start in range(0, len(faces), CARDS_PER_SHEET):
+      sheet = SheetStream(writer, first_sheet + 1 + start // CARDS_PER_SHEET)
+      for face, number in zip(faces[start:start + CARDS_PER_SHEET], numbers[start:start + CARDS_PER_SHEET]):
+        for band in sheet.add(face, number):
+          sheet.encode(band)
+      for band in sheet.last_bands():
+        sheet.encode(band)
+      filenames.append(sheet.finish())
+    writer.finish()
+    return filenames
+
+  for start in range(0, len(faces), CARDS_PER_SHEET):
+    serial = first_sheet + 1 + start // CARDS_PER_SHEET
+    filenames.append(writer.write(serial,
+                                  faces[start:start + CARDS_PER_SHEET],
+                                  numbers[start:start + CARDS_PER_SHEET]))
+  writer.finish()
+  return filenames
+
+
+#
+# Unit tests
+#
+class TestSheets(unittest.TestCase):
+
+  def make_faces(self, count, shade=0):
+    return [ Image.new("RGB", (6, 8), (i, shade, 0)) for i in range(count) ]
+
+  def test_skip(self):
+    prefix = os.path.join(tempfile.mkdtemp(), "deck_")
+    hidden = Image.new("RGB", (6, 8), (255, 0, 255))
+    faces = self.make_faces(CARDS_PER_SHEET + 5)
+    numbers = list(range(1, len(faces) + 1))
+
+    writer = SheetWriter(prefix, hidden)
+    filenames = write_sheets(writer, faces, numbers)
+    self.assertEqual((writer.written, writer.skipped), (2, 0))
+    self.assertEqual(Image.open(filenames[1]).getpixel((0, 0)), (CARDS_PER_SHEET, 0, 0))
+
+    with open(manifest_name(prefix), "r", encoding="utf-8") as handle:
+      manifest = json.load(handle)
+    self.assertEqual(len(manifest["sheets"]), 2)
+    self.assertEqual(len(manifest["sheets"][1]["cards"]), 5)
+    self.assertEqual(manifest["sheets"][1]["cards"][0]["card"], CARDS_PER_SHEET + 1)
+
+    # Nothing changed
+    writer = SheetWriter(prefix, hidden)
+    write_sheets(writer, faces, numbers)
+    self.assertEqual((writer.written, writer.skipped), (0, 2))
+
+    # One card changed
+    faces[-1] = Image.new("RGB", (6, 8), (1, 2, 3))
+    writer = SheetWriter(prefix, hidden)
+    write_sheets(writer, faces, numbers)
+    self.assertEqual((writer.written, writer.skipped), (1, 1))
+
+    # A sheet went missing
+    os.remove(filenames[0])
+    writer = SheetWriter(prefix, hidden)
+    write_sheets(writer, faces, numbers)
+    self.assertEqual((writer.written, writer.skipped), (1, 1))
+    self.assertTrue(os.path.isfile(filenames[0]))
+
+    # Optimizing changes how the sheets are written, so they are all redone
+    writer = SheetWriter(prefix, hidden, optimize=True)
+    write_sheets(writer, faces, numbers)
+    self.assertEqual((writer.written, writer.skipped), (2, 0))
+    self.assertEqual(Image.open(filenames[1]).mode, "P")
+
+  def test_stream(self):
+    prefix = os.path.join(tempfile.mkdtemp(), "deck_")
+    hidden = Image.new("RGB", (6, 8), (255, 0, 255))
+    faces = [ Image.new("RGBA", (6, 8), (i * 3, 255 - i, i % 7, 255)) for i in range(CARDS_PER_SHEET + 12) ]
+    faces[3].paste((0, 0, 0, 255), (2, 2, 4, 4))
+    numbers = list(range(1, len(faces) + 1))
+    expected = CardTiler().tile(list(faces), hidden)
+
+    # Small chunks, so sheets span several of them and rows are filtered across chunks
+    PngStream.CHUNK_ROWS = 5
+    writer = SheetWriter(prefix, hidden, stream=True)
+    filenames = write_sheets(writer, faces, numbers)
+    PngStream.CHUNK_ROWS = 64
+
+    self.assertEqual(writer.written, 2)
+    for filename, sheet in zip(filenames, expected):
+      img = Image.open(filename)
+      self.assertEqual(img.mode, "RGB")
+      self.assertEqual(img.tobytes(), sheet.tobytes())
+    self.assertEqual([ name for name in os.listdir(os.path.dirname(prefix)) if name.endswith(".tmp") ], [])
+    self.assertEqual(os.stat(filenames[0]).st_mode & 0o777, SHEET_MODE)
+
+    # Unchanged sheets are left alone
+    writer = SheetWriter(prefix, hidden, stream=True)
+    write_sheets(writer, faces, numbers)
+    self.assertEqual((writer.written, writer.skipped), (0, 2))
+
+  def test_stream_temporary(self):
+    prefix = os.path.join(tempfile.mkdtemp(), "deck_")
+    hidden = Image.new("RGB", (6, 8), (255, 0, 255))
+    writer = SheetWriter(prefix, hidden, stream=True)
+
+    # Two streams of the same sheet, as two runs sharing a prefix would have
+    first, second = SheetStream(writer, 1), SheetStream(writer, 1)
+    self.assertNotEqual(first.temporary, second.temporary)
+    second.discard()
+    self.assertTrue(os.path.exists(first.temporary))
+    first.discard()
+    self.assertEqual(os.listdir(os.path.dirname(prefix)), [])
+
+    # A sheet that fails to encode leaves nothing behind
+    sheet = SheetStream(writer, 1)
+    with self.assertRaises(Exception):
+      sheet.finish()
+    self.assertEqual(os.listdir(os.path.dirname(prefix)), [])
+
+  def test_optimize(self):
+    gray = Image.new("RGB", (40, 20), (255, 255, 255))
+    gray.paste((0, 0, 0), (0, 0, 10, 10))
+    img, _ = optimize_sheet(gray)
+    self.assertEqual(img.mode, "L")
+    self.assertEqual(img.convert("RGB").tobytes(), gray.tobytes())
+
+    few = gray.copy()
+    few.paste((0, 255, 0), (10, 10, 20, 20))
+    img, _ = optimize_sheet(few)
+    self.assertEqual(img.mode, "P")
+    self.assertEqual(img.convert("RGB").tobytes(), few.tobytes())
+
+    many = Image.new("RGB", (300, 1))
+    many.putdata([ (i % 256, i // 256, 7) for i in range(300) ])
+    img, _ = optimize_sheet(many)
+    self.assertEqual(img.mode, "RGB")
+
+    img, _ = optimize_sheet(many, colors=16)
+    self.assertEqual(img.mode, "P")
+    self.assertTrue(len(img.getcolors()) <= 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import unittest
+
+import os
+import re
+import sqlite3
+import pathlib
+import tempfile
+from collections import deque
+
+import log
+import deckfiles
+
+
+# Values for the :named parameters of deck queries, e.g. { "pack": "base" }
+parameters = {}
+
+DATABASE_EXTENSIONS = ( ".sqlite", ".sqlite3", ".db" )
+
+def is_query(source):
+  """ Does a label source name a database table or query (deck.sqlite#table) rather than a file? """
+  if ("#" not in source):
+    return False
+  database, _ = source.split("#", 1)
+  return database.lower().endswith(DATABASE_EXTENSIONS)
+
+def split_source(source):
+  """ The database filename and the SQL to run for a source """
+  database, query = source.split("#", 1)
+  query = query.strip()
+
+  if (re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", query)):
+    # Just a table name
+    query = "SELECT * FROM \"%s\"" % query
+
+  return (database, query)
+
+
+class QuerySource:
+  """ Streams the rows of a query in a deck database, one card at a time.
+      Simple layouts read it like a text file (first column of each row),
+      complex layouts get each row as a card with named fields.
+      The database is closed once the last row is read. """
+
+  def __init__(self, directory, source):
+    self.source = source
+    database, query = split_source(source)
+    path = deckfiles.open_deck(directory).local_path(database)
+
+    self.db = None
+    self.cursor = None
+    try:
+      # Read-only, so a typo can't create an empty database. The path is quoted,
+      # as a ? or # in it would otherwise end the filename part of the URI.
+      uri = pathlib.Path(os.path.abspath(path)).as_uri() + "?mode=ro"
+      self.db = sqlite3.connect(uri, uri=True)
+      self.db.row_factory = sqlite3.Row
+      self.cursor = self.db.execute(query, parameters)
+    except sqlite3.Error as e:
+      log.error("deck-query", "Unable to query %s: %s", source, e)
+      if (self.db is not None):
+        self.db.close()
+        self.db = None
+
+    # Rows which were peeked at
+    self.buffered = deque()
+
+  def fetch(self):
+    if (len(self.buffered) > 0):
+      return self.buffered.popleft()
+    if (self.cursor is None):
+      return None
+    row = self.cursor.fetchone()
+    if (row is None):
+      self.close()
+    return row
+
+  def readline(self):
+    """ Like a text file: the first column and a newline, or "" at the end """
+    row = self.fetch()
+    if (row is None):
+      return ""
+    value = row[0]
+    if (value is None):
+      value = ""
+    return str(value).replace("\n", " ") + "\n"
+
+  def next_card(self):
+    """ The next row, as a card of named fields, or None at the end """
+    row = self.fetch()
+    if (row is None):
+      return None
+    return self.card(row)
+
+  def card(self, row):
+    # Labels expect text, whatever the column type. Empty columns are left out, like missing JSON fields.
+    return { k: str(row[k]) for k in row.keys() if row[k] is not None }
+
+  def peek_cards(self, count):
+    while (len(self.buffered) < count and self.cursor is not None):
+      row = self.cursor.fetchone()
+      if (row is None):
+        self.close()
+        break
+      self.buffered.append(row)
+    return [ self.card(row) for row in list(self.buffered)[:count] ]
+
+  def lines(self):
+    """ All remaining rows, as text lines """
+    ret = []
+    while (True):
+      line = self.readline()
+      if (line == ""): break
+      ret.append(line.rstrip())
+    return ret
+
+  def cards(self):
+    """ All remaining rows, as cards """
+    ret = []
+    while (True):
+      card = self.next_card()
+      if (card is None): break
+      ret.append(card)
+    return ret
+
+  def close(self):
+    if (self.db is not None):
+      self.db.close()
+      self.db = None
+      self.cursor = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+#
+# Unit tests
+#
+class TestQuerySource(unittest.TestCase):
+
+  def make_db(self):
+    # Characters which mean something in a URI
+    directory = os.path.join(tempfile.mkdtemp(), "deck #1? 100%")
+    os.mkdir(directory)
+    db = sqlite3.connect(os.path.join(directory, "deck.sqlite"))
+    db.execute("CREATE TABLE white (id INTEGER PRIMARY KEY, text TEXT, pack TEXT)")
+    db.execute("CREATE INDEX white_pack ON white (pack)")
+    for i in range(10):
+      db.execute("INSERT INTO white (text, pack) VALUES (?, ?)", ("Card %d" % i, "base" if i < 6 else "extra"))
+    db.commit()
+    db.close()
+    return directory
+
+  def test_source(self):
+    self.assertTrue(is_query("deck.sqlite#white"))
+    self.assertTrue(is_query("deck.db#SELECT text FROM white"))
+    self.assertFalse(is_query("white.txt"))
+    self.assertFalse(is_query("notes#1.txt"))
+    self.assertEqual(split_source("deck.db#white"), ("deck.db", "SELECT * FROM \"white\""))
+
+  def test_rows(self):
+    global parameters
+    directory = self.make_db()
+
+    source = QuerySource(directory, "deck.sqlite#SELECT text FROM white ORDER BY id")
+    self.assertEqual(source.readline(), "Card 0\n")
+    self.assertEqual(len(source.lines()), 9)
+    self.assertEqual(source.db, None)
+    self.assertEqual(source.readline(), "")
+
+    parameters = { "pack": "extra" }
+    source = QuerySource(directory, "deck.sqlite#SELECT text, pack FROM white WHERE pack = :pack")
+    self.assertEqual(source.peek_cards(2), [ { "text": "Card 6", "pack": "extra" }, { "text": "Card 7", "pack": "extra" } ])
+    self.assertEqual(source.peek_cards(5), source.peek_cards(4))
+    self.assertEqual(source.db, None)
+    self.assertEqual(len(source.cards()), 4)
+    parameters = {}
+
+    # Closed early, and again at the end
+    with QuerySource(directory, "deck.sqlite#white") as source:
+      source.next_card()
+    self.assertEqual(source.db, None)
+    self.assertEqual(source.next_card(), None)
+
+    # Errors are reported, and the source is simply empty
+    source = QuerySource(directory, "deck.sqlite#nosuchtable")
+    self.assertEqual(source.readline(), "")
+    self.assertEqual(source.db, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import unittest
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+# Startup benchmark for the command line tool.
+# Measures how long it takes to show --help and to render a tiny deck,
+# which is mostly time spent importing modules and setting up the template.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, "Cardcinogen.py")
+
+# Modules which have no business being loaded just to parse the command line
+HEAVY_MODULES = [ "PIL", "tkinter", "sysfont", "compat", "content", "card" ]
+
+
+def time_command(args, runs):
+  """ Best wall-clock time (seconds) of running the tool with the given arguments """
+  best = None
+  for i in range(runs):
+    started = time.perf_counter()
+    subprocess.run([ sys.executable, SCRIPT ] + args, cwd=tempfile.gettempdir(),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - started
+    if (best is None or elapsed < best):
+      best = elapsed
+  return best
+
+def benchmark(runs=5):
+  """ Returns a dict of timings, in milliseconds """
+  output = os.path.join(tempfile.mkdtemp(), "startup_")
+  render = [ "-t", os.path.join(HERE, "fluxx", "fluxx.json"),
+             "-d", os.path.join(HERE, "fluxx", "cards"),
+             "-o", output ]
+
+  return {
+    "help": round(time_command([ "--help" ], runs) * 1000, 1),
+    "render-uncached": round(time_command(render + [ "--no-cache" ], runs) * 1000, 1),
+    "render-cached": round(time_command(render + [ "--cache-dir", os.path.dirname(output) ], runs) * 1000, 1),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure the startup time of Cardcinogen")
+
+  parser.add_argument("--runs", metavar="N", default=5, type=int,
+                      help="Run each command N times and keep the best time.")
+
+  parser.add_argument("--record", metavar="FILE", default=None,
+                      help="Append the results to this file, one JSON object per line.")
+
+  parser.add_argument("--budget", metavar="MS", default=None, type=float,
+                      help="Fail if --help takes longer than this many milliseconds.")
+
+  conf = parser.parse_args()
+
+  timings = benchmark(conf.runs)
+  for name, ms in timings.items():
+    print("%-16s %8.1f ms" % (name, ms))
+
+  if (conf.record is not None):
+    entry = dict(timings)
+    entry["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    entry["python"] = sys.version.split()[0]
+    with open(conf.record, "a", encoding="utf-8") as handle:
+      handle.write(json.dumps(entry) + "\n")
+
+  if (conf.budget is not None and timings["help"] > conf.budget):
+    print("Over budget: --help took %.1f ms, the budget is %.1f ms" % (timings["help"], conf.budget))
+    return 1
+
+  return 0
+
+
+#
+# Unit tests
+#
+class TestStartup(unittest.TestCase):
+
+  def test_light_imports(self):
+    # Loading the CLI module must not pull in imaging, fonts or the GUI
+    code = "import sys; import Cardcinogen; print(' '.join(m for m in %r if m in sys.modules))" % HEAVY_MODULES
+    result = subprocess.run([ sys.executable, "-c", code ], cwd=HERE,
+                            stdout=subprocess.PIPE, check=True)
+    self.assertEqual(result.stdout.decode("utf-8").strip(), "")
+
+  def test_lazy_font(self):
+    from content import TextLabel
+    lab = TextLabel({ "font-face": "No Such Font" })
+    self.assertEqual(lab._font, None)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,13 +1,11 @@
 """OS-specific font detection."""
 import os
 import sys
-from subprocess import Popen, PIPE
-from compat import ISPYTHON2, stringify
 
 import log
 
 if sys.platform in ("win32", "cli"):
-    if ISPYTHON2:
+    if sys.version_info[0] < 3:
         import _winreg as winreg
     else:
         import winreg
@@ -97,13 +95,14 @@ def _cache_fonts_darwin():
 
 def _cache_fonts_fontconfig():
     """Caches font on POSIX-alike platforms."""
+    from subprocess import Popen, PIPE
     try:
         command = "fc-list : file family style fullname fullnamelang"
         proc = Popen(command, stdout=PIPE, shell=True, stderr=PIPE)
         pout = proc.communicate()[0]
-        output = stringify(pout, "utf-8")
+        output = pout.decode("utf-8")
     except OSError:
-        log.log.write("Unable to execute fc-list. Please install fontconfig.\n")
+        log.error("fontconfig", "Unable to execute fc-list. Please install fontconfig.")
         return
 
     for entry in output.split(os.linesep):
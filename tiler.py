@@ -2,6 +2,12 @@ import unittest
 
 from PIL import Image
 
+# Tabletop Simulator decks are a grid of 10x7 cards.
+# The last slot holds the hidden card face.
+COLUMNS = 10
+ROWS = 7
+CARDS_PER_SHEET = COLUMNS * ROWS - 1
+
 class CardTiler:
   """ Takes individual card faces and builds the 10x7 tiled image for Tabletop """
   def __init__(self):
@@ -10,8 +16,8 @@ class CardTiler:
 
 
   def empty_tiling(self, hidden):
-    w = 10 * hidden.width
-    h = 7 * hidden.height
+    w = COLUMNS * hidden.width
+    h = ROWS * hidden.height
 
     # A flat image
     ret = Image.new("RGB", (w, h), self.backcolor)
@@ -21,6 +27,18 @@ class CardTiler:
 
     return ret
 
+  def tile_band(self, cards, row, hidden):
+    """ A single row of a sheet, with up to COLUMNS card faces. The same pixels as that row of a tiling. """
+    band = Image.new("RGB", (COLUMNS * hidden.width, hidden.height), self.backcolor)
+
+    for xc,face in enumerate(cards):
+      band.paste(face, (xc * hidden.width, 0))
+
+    if (row == ROWS - 1):
+      band.paste(hidden, (band.width - hidden.width, 0))
+
+    return band
+
   def tile(self, cards, hidden):
     """ List of card face images, a single hidden-card face image of the same size """
     ret = []
@@ -33,8 +51,8 @@ class CardTiler:
       face = cards.pop(0)
 
       # Coordinates of this card in the grid
-      yc = index // 10
-      xc = index % 10
+      yc = index // COLUMNS
+      xc = index % COLUMNS
 
       # Pixel coordinates of this card's upper-left corner
       x = xc * hidden.width
@@ -46,7 +64,7 @@ class CardTiler:
       index += 1
 
       # Starting a new 69-card image
-      if (index >= 69):
+      if (index >= CARDS_PER_SHEET):
         ret.append(tiling)
         tiling = self.empty_tiling(hidden)
         index = 0
@@ -111,6 +129,17 @@ class TestTiler(unittest.TestCase):
     self.assertEqual(tilings[1].getpixel((269, 349)), (0, 255, 0))      # Face of card 69, there's no card there.
     self.assertEqual(tilings[1].getpixel((1, 1)), self.cc(69))          # There's a card in the first slot
 
+  def test_band(self):
+    # Rows tiled one at a time make up the same sheet
+    tiler = CardTiler()
+    faces = [ Image.new("RGB", (30, 50), self.cc(i)) for i in range(65) ]
+    hidden = Image.new("RGB", faces[0].size, (255, 0, 255))
+    sheet = tiler.tile(list(faces), hidden)[0]
+
+    for row in range(ROWS):
+      band = tiler.tile_band(faces[row * COLUMNS:(row + 1) * COLUMNS], row, hidden)
+      self.assertEqual(band.tobytes(), sheet.crop((0, row * 50, 300, (row + 1) * 50)).tobytes())
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,130 @@
+import unittest
+
+import os
+import json
+import time
+import tempfile
+import threading
+import contextlib
+
+
+# Returned by span() when nothing is traced, so leaving tracing off costs next to nothing
+NOTHING = contextlib.nullcontext()
+
+class Span:
+  """ A timed piece of work, recorded as a complete ("X") event when it ends """
+
+  def __init__(self, tracer, name, category, args):
+    self.tracer = tracer
+    self.name = name
+    self.category = category
+    self.args = args
+
+  def __enter__(self):
+    self.started = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.tracer.complete(self.name, self.category, self.started, time.perf_counter(), self.args)
+    return False
+
+
+class Tracer:
+  """ Collects spans from every thread, and writes them in the Chrome trace event format
+      (chrome://tracing, Perfetto, speedscope and others open it) """
+
+  def __init__(self, path):
+    self.path = path
+    self.origin = time.perf_counter()
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+    self.events = []
+    self.threads = {}
+
+  def complete(self, name, category, started, ended, args):
+    tid = threading.get_ident()
+    event = {
+      "name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": tid,
+      "ts": round((started - self.origin) * 1e6, 1),
+      "dur": round((ended - started) * 1e6, 1),
+    }
+    if (args):
+      event["args"] = args
+
+    with self.lock:
+      if (tid not in self.threads):
+        self.threads[tid] = threading.current_thread().name
+      self.events.append(event)
+
+  def write(self):
+    """ Write the trace file. Returns the number of events. """
+    with self.lock:
+      events = list(self.events)
+      for tid, name in self.threads.items():
+        events.append({ "name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": { "name": name } })
+
+    with open(self.path, "w", encoding="utf-8") as handle:
+      json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, handle)
+    return len(self.events)
+
+
+# The tracer spans are recorded with, if any. See configure().
+tracer = None
+
+def configure(path):
+  """ Record spans from here on, to be written to path by close() """
+  global tracer
+  tracer = Tracer(path)
+  return tracer
+
+def span(name, category="render", **args):
+  """ with tracing.span("tile", sheet=3): ... records how long the block took, if tracing is on """
+  if (tracer is None):
+    return NOTHING
+  return Span(tracer, name, category, args)
+
+def close():
+  """ Write the trace, if there is one. Returns its filename. """
+  global tracer
+  if (tracer is None):
+    return None
+  done = tracer
+  tracer = None
+  done.write()
+  return done.path
+
+
+#
+# Unit tests
+#
+class TestTrace(unittest.TestCase):
+
+  def test_off(self):
+    self.assertTrue(span("card") is NOTHING)
+
+  def test_spans(self):
+    path = os.path.join(tempfile.mkdtemp(), "trace.json")
+    configure(path)
+
+    with span("sheet", category="write", serial=1):
+      thread = threading.Thread(target=lambda: span("card", number=5).__enter__().__exit__(None, None, None), name="render")
+      thread.start()
+      thread.join()
+
+    self.assertEqual(close(), path)
+    self.assertEqual(tracer, None)
+
+    with open(path, "r", encoding="utf-8") as handle:
+      events = json.load(handle)["traceEvents"]
+    spans = { e["name"]: e for e in events if e["ph"] == "X" }
+    self.assertEqual(spans["sheet"]["args"], { "serial": 1 })
+    self.assertEqual(spans["card"]["cat"], "render")
+    self.assertTrue(spans["sheet"]["dur"] >= spans["card"]["dur"])
+    self.assertNotEqual(spans["sheet"]["tid"], spans["card"]["tid"])
+
+    names = [ e["args"]["name"] for e in events if e["ph"] == "M" ]
+    self.assertTrue("render" in names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 import unittest
+import os
 import sys
+import math
+import tempfile
 
 from PIL import Image
 import log
@@ -13,6 +16,33 @@ def get_default(dic, k, fallback, cast=None):
   if (cast is not None): retval = cast(retval)
   return retval
 
+def default_cache_dir():
+  """ Where to keep caches between runs, unless told otherwise """
+  base = os.environ.get("XDG_CACHE_HOME", None)
+  if (base is None and sys.platform in ("win32", "cli")):
+    base = os.environ.get("LOCALAPPDATA", None)
+  if (base is None):
+    base = os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(base, "cardcinogen")
+
+def write_replacing(path, write):
+  """ Write a file by way of a temporary file of its own, which then replaces it.
+      Runs sharing a cache never see half a file, or write into each other's.
+      write(handle) gets the temporary file, opened for binary writing. """
+  directory = os.path.dirname(path) or "."
+  os.makedirs(directory, exist_ok=True)
+  fd, temporary = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as handle:
+      write(handle)
+    os.replace(temporary, path)
+  except BaseException:
+    try:
+      os.remove(temporary)
+    except OSError:
+      pass
+    raise
+
 # If the image can't be loaded, return a default of the specified dimensions
 # If accept_dimension is specified, scale non-matching image to that size
 def default_image(path, default_dimension=(300,800), accept_dimension=None):
@@ -20,17 +50,36 @@ def default_image(path, default_dimension=(300,800), accept_dimension=None):
     loaded = Image.open(path)
     loaded.load()
   except:
-    log.log.write("Unable to load image %s. Falling back to plain.\n" % path)
+    log.warning("image-default", "Unable to load image %s. Falling back to plain.", path)
     return Image.new("RGBA", default_dimension, (230, 230, 255, 255))
 
   if (accept_dimension != None):
     if (loaded.size != accept_dimension):
-      log.log.write("Image sizes not matching. Resizing to %d x %d\n" % accept_dimension)
+      log.warning("image-resize", "Image sizes not matching. Resizing to %d x %d", *accept_dimension)
       return loaded.resize(accept_dimension, Image.BICUBIC)
 
   # Image is good enough as it is.
   return loaded
 
+def scaled(value, scale):
+  """ Scale a pixel measurement, e.g. for a preview render """
+  return int(round(value * scale))
+
+def rotated_size(size, rotation):
+  """ The bounding box of a w*h rectangle after rotation by the given angle (degrees) """
+  if (rotation == 0): return size
+
+  w, h = size
+  angle = math.radians(rotation)
+  c = abs(math.cos(angle))
+  s = abs(math.sin(angle))
+  return (int(round(w*c + h*s)), int(round(w*s + h*c)))
+
+def scaled_image(image, scale):
+  """ Resize a PIL image by a scale factor, e.g. for a preview render """
+  size = (max(1, scaled(image.width, scale)), max(1, scaled(image.height, scale)))
+  return image.resize(size, Image.BILINEAR)
+
 def rotate_image(image, rotation):
   """ Rotate a PIL image, returning a minimal bounding image """
 
@@ -193,6 +242,18 @@ class TestUtils(unittest.TestCase):
     self.assertEqual(dims, (10, 40))
 
 
+  def test_rotated_size(self):
+    self.assertEqual(rotated_size((80, 40), 0), (80, 40))
+    self.assertEqual(rotated_size((80, 40), 90), (40, 80))
+    self.assertEqual(rotated_size((80, 40), -90), (40, 80))
+    self.assertEqual(rotated_size((80, 40), 180), (80, 40))
+    self.assertEqual(rotated_size((10, 10), 45), (14, 14))
+
+  def test_scaled(self):
+    self.assertEqual(scaled(100, 0.25), 25)
+    self.assertEqual(scaled(-10, 0.25), -2)
+    self.assertEqual(scaled(7, 0.5), 4)
+
   def test_rotate_image(self):
     # A block that's pink on one side and blue on the other
     pink = (255, 50, 200, 255)
@@ -211,6 +272,20 @@ class TestUtils(unittest.TestCase):
     self.assertEqual(fall.getpixel((0,0)), pink)
     self.assertEqual(fall.getpixel((0,79)), blue)
 
+  def test_write_replacing(self):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "cache", "entry")
+    write_replacing(path, lambda handle: handle.write(b"first"))
+    write_replacing(path, lambda handle: handle.write(b"second"))
+    with open(path, "rb") as handle:
+      self.assertEqual(handle.read(), b"second")
+
+    def fail(handle):
+      handle.write(b"half")
+      raise ValueError("broken")
+    self.assertRaises(ValueError, write_replacing, path, fail)
+    self.assertEqual(os.listdir(os.path.dirname(path)), [ "entry" ])
+
 
 if __name__ == '__main__':
     unittest.main()
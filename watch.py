@@ -0,0 +1,207 @@
+import unittest
+
+import os
+import json
+import time
+import tempfile
+
+from PIL import Image
+
+import log
+import layoutcache
+from compiler import compile_template, TemplateCache
+from deckindex import DeckIndex, ReplayGenerator
+from sheets import SheetWriter, write_sheets
+
+
+def stamp(path):
+  """ Size and modification time of a file, or None if it doesn't exist """
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_size, st.st_mtime_ns)
+
+def snapshot(paths, directory, ignore_prefix=None):
+  """ Stamps of the given files and of every file below a directory """
+  stamps = {}
+  for path in paths:
+    stamps[path] = stamp(path)
+
+  for root, dirs, files in os.walk(directory):
+    for name in files:
+      path = os.path.join(root, name)
+      if (ignore_prefix is not None and os.path.abspath(path).startswith(ignore_prefix)):
+        # Our own output, in case it's written into the deck directory
+        continue
+      stamps[path] = stamp(path)
+
+  return stamps
+
+
+class DeckWatcher:
+  """ Keeps a template and deck loaded, and re-renders the cards that change whenever the files do """
+
+  def __init__(self, template_path, deck, output_prefix, preview_scale=1.0, cache_dir=None,
+               optimize=False, quantize=None, stream=False):
+    self.template_path = template_path
+    self.deck = deck
+    self.output_prefix = output_prefix
+    self.preview_scale = preview_scale
+    self.optimize = optimize
+    self.quantize = quantize
+    self.stream = stream
+
+    self.cache = None
+    if (cache_dir is not None):
+      self.cache = TemplateCache(cache_dir)
+
+    self.tmpl = None
+
+    # Card signature -> rendered face, from the last pass
+    self.faces = {}
+
+  def load_template(self):
+    with open(self.template_path, "r", encoding="utf-8-sig") as handle:
+      try:
+        spec = json.load(handle)
+      except ValueError as e:
+        log.error("template-json", "JSON error in %s: %s", self.template_path, e)
+        return None
+
+    return compile_template(spec, os.path.dirname(self.template_path), scale=self.preview_scale, cache=self.cache)
+
+  def watched_files(self):
+    files = [ self.template_path ]
+    if (self.tmpl is not None):
+      files += self.tmpl.dependencies()
+    return files
+
+  def signature(self, index, card):
+    """ Everything that goes into a card: the layout, its texts and the files of its images """
+    parts = [ card["layout"] ]
+
+    if ("card" in card):
+      # Complex layout. Any value may name an image file.
+      content = index.read_json(card["source"], card["card"])
+      parts.append(content)
+      for value in content.values():
+        if (isinstance(value, str)):
+          parts.append(stamp(os.path.join(self.deck, value)))
+      return json.dumps(parts, sort_keys=True)
+
+    for entry in card["images"]:
+      if ("static" in entry):
+        filename = entry["static"]
+      else:
+        filename = index.read_line(entry["source"], entry["line"])
+      parts.append([ filename, stamp(os.path.join(self.deck, filename)) ])
+
+    for entry in card["texts"]:
+      parts.append(index.read_line(entry["source"], entry["line"]))
+
+    return json.dumps(parts)
+
+  def render(self, template_changed=True):
+    """ Render the deck, reusing every card whose contents haven't changed. Returns the number of cards rendered. """
+    started = time.time()
+
+    if (template_changed or self.tmpl is None):
+      self.tmpl = self.load_template()
+      self.faces = {}
+      if (self.tmpl is None):
+        return 0
+
+    index = DeckIndex(self.deck)
+    total = index.build(self.tmpl)
+    textgen = ReplayGenerator(index)
+
+    faces = []
+    numbers = []
+    rendered = {}
+    count = 0
+    for number in range(total):
+      sig = self.signature(index, index.cards[number])
+      face = rendered.get(sig, None) or self.faces.get(sig, None)
+      if (face is None):
+        face = index.render(self.tmpl, number, textgen)
+        count += 1
+      if (face is None):
+        continue
+      rendered[sig] = face
+      faces.append(face)
+      numbers.append(number + 1)
+
+    self.faces = rendered
+
+    writer = SheetWriter(self.output_prefix, self.tmpl.hidden, optimize=self.optimize, quantize=self.quantize,
+                         stream=self.stream)
+    write_sheets(writer, faces, numbers)
+
+    if (layoutcache.cache is not None):
+      layoutcache.cache.flush()
+
+    log.info("watch", "Rendered %d of %d cards, wrote %d sheets in %.2f s.",
+             count, total, writer.written, time.time() - started)
+    return count
+
+  def run(self, interval=0.5, cancel=None):
+    """ Render, then keep rendering whenever the template or deck changes. Stops when cancel is set. """
+    ignore = os.path.abspath(self.output_prefix)
+
+    self.render()
+    template_files = self.watched_files()
+    last = snapshot(template_files, self.deck, ignore)
+    log.info("watch", "Watching %s and %s for changes. Press Ctrl-C to stop.", self.template_path, self.deck)
+
+    while (cancel is None or not cancel.is_set()):
+      time.sleep(interval)
+
+      current = snapshot(template_files, self.deck, ignore)
+      if (current == last):
+        continue
+
+      template_changed = any([ current.get(f) != last.get(f) for f in template_files ])
+      last = current
+
+      log.info("watch", "Change detected, rendering.")
+      self.render(template_changed)
+      template_files = self.watched_files()
+      last = snapshot(template_files, self.deck, ignore)
+
+
+#
+# Unit tests
+#
+class TestWatch(unittest.TestCase):
+
+  def test_incremental(self):
+    deck = tempfile.mkdtemp()
+    names = []
+    for i in range(5):
+      names.append("img%d.png" % i)
+      Image.new("RGBA", (8, 8), (i, 0, 0, 255)).save(os.path.join(deck, names[-1]))
+    with open(os.path.join(deck, "images.txt"), "w", encoding="utf-8") as handle:
+      handle.write("\n".join(names) + "\n")
+
+    template = os.path.join(tempfile.mkdtemp(), "tmpl.json")
+    with open(template, "w", encoding="utf-8") as handle:
+      json.dump({ "layouts": [ { "images": [ { "source": "images.txt", "x": 0, "y": 0 } ] } ] }, handle)
+
+    prefix = os.path.join(tempfile.mkdtemp(), "deck_")
+    watcher = DeckWatcher(template, deck, prefix)
+    self.assertEqual(watcher.render(), 5)
+    self.assertEqual(watcher.render(False), 0)
+
+    # Only the card showing the changed image is redrawn
+    Image.new("RGBA", (8, 8), (0, 255, 0, 255)).save(os.path.join(deck, "img3.png"))
+    os.utime(os.path.join(deck, "img3.png"), ns=(1, 1))
+    self.assertEqual(watcher.render(False), 1)
+    self.assertEqual(Image.open(prefix + "01.png").getpixel((3 * watcher.tmpl.front.width + 1, 1)), (0, 255, 0))
+
+    # A different template redraws everything
+    self.assertEqual(watcher.render(True), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()